@@ -0,0 +1,62 @@
+"""
+Measure the latency of starting a child against the size of the parent
+
+USAGE:
+
+    python benchmarks/spawn.py [-n CALLS] [SIZE_MB ...]
+
+For each size the parent grows its heap by that many megabytes (and
+touches every page) before timing `CALLS` runs of `true` with each
+available launcher.
+"""
+from __future__ import absolute_import
+
+import argparse
+import resource
+import time
+
+import pxul.subprocess
+
+
+def launchers():
+    yield 'fork'
+    if pxul.subprocess._libc is not None:
+        yield 'posix_spawn'
+
+
+def latency(launcher, calls):
+    "Mean seconds per call of `true`"
+    start = time.time()
+    for _ in xrange(calls):
+        pxul.subprocess.call(['true'], launcher=launcher)
+    return (time.time() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--calls', type=int, default=200)
+    parser.add_argument('sizes', type=int, nargs='*',
+                        default=[0, 256, 1024, 2048])
+    opts = parser.parse_args()
+
+    names = list(launchers())
+    print '{:>10} {:>10}'.format('size (MB)', 'rss (MB)') + \
+        ''.join(' {:>14}'.format(n + ' (ms)') for n in names)
+
+    ballast = []
+    grown = 0
+    for size in sorted(opts.sizes):
+        block = bytearray(max(0, size - grown) * 1024 * 1024)
+        for i in xrange(0, len(block), resource.getpagesize()):
+            block[i] = 1
+        ballast.append(block)
+        grown = max(grown, size)
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        times = [latency(name, opts.calls) * 1000 for name in names]
+        print '{:>10} {:>10.0f}'.format(size, rss) + \
+            ''.join(' {:>14.3f}'.format(t) for t in times)
+
+
+if __name__ == '__main__':
+    main()
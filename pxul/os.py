@@ -5,6 +5,17 @@ AUTHORS:
  - Badi' Abdul-Wahid
 
 CHANGES:
+ - 2026-10-16:
+     - `source` can run in a `pxul.subprocess.Coprocess`
+     - add `SourceCache` to reuse the environments defined by `source`
+     - add `source_many` to source many sets of files concurrently
+     - add `PathHash` to look up executables without searching `PATH`
+       every time
+     - `find_in_root` reads directories in parallel and learned
+       `exclude`, `max_depth`, and `one_filesystem`
+     - add `search_root` to find many executables in one traversal
+     - add `FileIndex` to search a tree without traversing it again,
+       and `index` to `find_in_root`
  - 2016-06-24:
      - Add `source` (issue #33)
  - 2015-06-11:
@@ -33,10 +44,23 @@ from __future__ import absolute_import
 
 from . import subprocess as pxul_subprocess
 
+import collections
 import os
+import cPickle as pickle
+import fnmatch
 import glob
+import hashlib
+import itertools
+import multiprocessing
+import pipes
+import Queue
 import shutil
+import stat
+import sys
 import tempfile
+import threading
+import time
+import zlib
 
 import logging
 logger = logging.getLogger('pxul')
@@ -166,7 +190,7 @@ class env(object):
         self.__exit__()
 
 
-def _source_shlike(paths, shell):
+def _source_shlike(paths, shell, coprocess=None):
     """Implementation of :func:`source` for sh-like shells
     """
 
@@ -181,8 +205,11 @@ def _source_shlike(paths, shell):
     fullpaths = map(fullpath, paths)
     cmds = ['source {} 1>&2'.format(p) for p in fullpaths] + ['env']
     script = ';'.join(cmds)
-    torun  = [shell, '-c', script]
-    result = pxul_subprocess.run(torun, capture='both', raises=False)
+    if coprocess is not None:
+        result = coprocess.script(script, raises=False)
+    else:
+        torun  = [shell, '-c', script]
+        result = pxul_subprocess.run(torun, capture='both', raises=False)
 
     if not result.ret == 0:
         msg = 'Failed to run %r:\n%s' % (script, result.err)
@@ -198,27 +225,225 @@ def _source_shlike(paths, shell):
     return env
 
 
-def source(paths, shell='sh'):
+class SourceCache(object):
+    """Remember the environments defined by :func:`source`
+
+    An environment is identified by the shell, the sourced paths, the
+    fingerprint of each file, and the environment it was sourced in.
+    The fingerprints are the size and modification time of each file
+    or, if `hash` is set, digests of their contents. Changing any of
+    these sources the files again.
+
+    Environments are kept in memory and, if `path` is given, in that
+    directory so that they are shared between processes.
+
+    >>> cache = SourceCache('~/.cache/pxul/source')
+    >>> with source(['/opt/suite/setup.sh'], cache=cache):
+    ...   run_the_suite()
+
+    .. warning::
+       Files sourced by the given files are not part of the key.
+
+    :param str path: the directory to store environments in
+    :param bool hash: fingerprint files by their contents
+    """
+
+    def __init__(self, path=None, hash=False):
+        self.path = fullpath(path) if path is not None else None
+        self.hash = hash
+        self._memory = dict()
+        self._lock = threading.Lock()
+
+    def key(self, paths, shell, environ=None, format='env'):
+        """Identify the environment defined by sourcing `paths`
+
+        :param dict environ: the environment they are sourced in
+                             (defaults to :data:`os.environ`)
+        :param str format: how the environment was read: `env` for the
+                           lines of :func:`source`, `env0` for the NUL
+                           separated entries of :func:`source_many`
+        :returns: a hex digest
+        :rtype: :class:`str`
+        """
+        environ = os.environ if environ is None else environ
+        fingerprints = [pxul_subprocess._fingerprint(fullpath(p), self.hash)
+                        for p in paths]
+        ident = (shell, fingerprints, sorted(environ.iteritems()), format)
+        return hashlib.sha1(pickle.dumps(ident, 2)).hexdigest()
+
+    def get(self, key):
+        """Look up an environment
+
+        :returns: the environment or ``None`` if not present
+        :rtype: :class:`dict`
+        """
+        with self._lock:
+            envdict = self._memory.get(key)
+        if envdict is None and self.path is not None:
+            try:
+                path = pxul_subprocess._entry_path(self.path, key)
+                with open(path, 'rb') as fd:
+                    envdict = pickle.load(fd)
+            except (IOError, OSError, EOFError, ValueError,
+                    pickle.PickleError):
+                return None
+            with self._lock:
+                self._memory[key] = envdict
+        if envdict is not None:
+            logger.debug('Source cache hit %s', key)
+            return dict(envdict)
+        return None
+
+    def put(self, key, envdict):
+        "Store an environment"
+        with self._lock:
+            self._memory[key] = dict(envdict)
+        if self.path is not None:
+            pxul_subprocess._write_entry(
+                pxul_subprocess._entry_path(self.path, key),
+                pickle.dumps(dict(envdict), 2))
+
+    def clear(self):
+        "Forget all environments"
+        with self._lock:
+            self._memory.clear()
+        if self.path is not None and os.path.isdir(self.path):
+            remove_children(self.path)
+
+
+def source(paths, shell='sh', coprocess=None, cache=None):
     """Source these files and return a new environment
 
+    Given a :class:`pxul.subprocess.Coprocess`, the files are sourced
+    by its shell instead of a new one. This saves starting a shell for
+    every call. Given a :class:`SourceCache`, the environment is only
+    defined once for the same files and environment. The cache is not
+    used with a coprocess, whose shell keeps whatever earlier commands
+    changed in its environment.
+
     :param paths: paths that define changes to the environment
     :type  paths: :class:`list` of :class:`str` filepaths
     :param shell: the shell program to use
     :type  shell: :class:`str`
+    :param coprocess: a running sh-like shell to use instead
+    :type  coprocess: :class:`pxul.subprocess.Coprocess`
+    :param cache: where to look up and store the environment
+    :type  cache: :class:`SourceCache`
     :returns: the new environment definition
     :rtype: :class:`env`
     """
 
-    if shell == 'sh' or shell == 'bash':
-        envdict = _source_shlike(paths, shell)
-    else:
+    if coprocess is None and shell != 'sh' and shell != 'bash':
         msg = 'Unsupported shell %r' % shell
         logger.error(msg)
         raise NotImplementedError(msg)
 
+    if coprocess is not None:
+        if cache is not None:
+            logger.debug('Not caching environments sourced in a coprocess')
+        return env(**_source_shlike(paths, 'sh', coprocess=coprocess))
+
+    if cache is not None:
+        key = cache.key(paths, shell)
+        envdict = cache.get(key)
+        if envdict is not None:
+            return env(**envdict)
+
+    envdict = _source_shlike(paths, shell)
+    if cache is not None:
+        cache.put(key, envdict)
     return env(**envdict)
 
 
+def _source_script(paths):
+    """A script that sources `paths` and prints the resulting
+    environment separated by NUL bytes. It stops at the first file
+    that fails, which ``bash`` would otherwise carry on after.
+    """
+    cmds = ['. {} 1>&2'.format(pipes.quote(fullpath(p))) for p in paths]
+    return ' && '.join(cmds + ['env -0'])
+
+
+def _parse_env0(output):
+    """Parse the output of ``env -0``, which keeps values containing
+    newlines intact
+    """
+    envdict = dict()
+    for entry in output.split('\0'):
+        if '=' not in entry:
+            continue
+        var, val = entry.split('=', 1)
+        envdict[var] = val
+    return envdict
+
+
+def source_many(path_sets, shell='sh', jobs=None, cache=None):
+    """Source many independent sets of files concurrently
+
+    Each set of paths is sourced by its own shell, with at most `jobs`
+    shells running at the same time. Unlike :func:`source`, values
+    containing newlines are kept intact.
+
+    >>> envs = source_many({'gcc': ['/opt/gcc/setup.sh'],
+    ...                     'cuda': ['/opt/cuda/env.sh']})
+    >>> with envs['cuda']:
+    ...   run_on_gpu()
+
+    :param path_sets: the paths to source together, by name
+    :type  path_sets: :class:`dict` of :class:`list` of :class:`str`,
+                      or a :class:`list` of them named by :class:`tuple`
+    :param shell: the shell program to use
+    :type  shell: :class:`str`
+    :param int jobs: the maximum number of concurrent shells
+                     (defaults to the number of CPUs)
+    :param cache: where to look up and store the environments
+    :type  cache: :class:`SourceCache`
+    :returns: the new environment definitions by name
+    :rtype: :class:`dict` of :class:`env`
+    :raises: :class:`ValueError` if sourcing a set fails
+    """
+
+    if shell != 'sh' and shell != 'bash':
+        msg = 'Unsupported shell %r' % shell
+        logger.error(msg)
+        raise NotImplementedError(msg)
+
+    if isinstance(path_sets, dict):
+        items = path_sets.items()
+    else:
+        items = [(tuple(paths), paths) for paths in path_sets]
+
+    envs = dict()
+    todo = []
+    for name, paths in items:
+        key = cache.key(paths, shell, format='env0') \
+            if cache is not None else None
+        envdict = cache.get(key) if cache is not None else None
+        if envdict is not None:
+            envs[name] = env(**envdict)
+        else:
+            todo.append((name, paths, key))
+
+    cmds = [[shell, '-c', _source_script(paths)] for _, paths, _ in todo]
+    results = pxul_subprocess.run_many(cmds, jobs=jobs, capture='both',
+                                       raises=False)
+    try:
+        for (name, paths, key), result in itertools.izip(todo, results):
+            if not result.ret == 0:
+                msg = 'Failed to source %r:\n%s' % (paths, result.err)
+                logger.error(msg)
+                raise ValueError(msg)
+
+            envdict = _parse_env0(result.out)
+            if cache is not None:
+                cache.put(key, envdict)
+            envs[name] = env(**envdict)
+    finally:
+        results.close()
+
+    return envs
+
+
 def remove_children(dirpath):
     """
     Recursively delete everything under `dirpath`
@@ -260,16 +485,125 @@ def ensure_file(path):
     open(path, 'w').close()
 
 
-def find_in_path(exe, search=None):
+class PathHash(object):
+    """Remember the names in the directories of a search path, like
+    the ``hash`` builtin of a shell.
+
+    Looking up an executable then only needs to check the permissions
+    of the files that have the right name. The names in a directory
+    are listed again when its modification time changes, or when it
+    was within a second of the last listing, as changes in the same
+    tick cannot be told apart. A directory is checked at most every
+    `interval` seconds, and :meth:`rehash` forgets them all.
+
+    >>> paths = PathHash()
+    >>> find_in_path('gcc', hash=paths)
+    '/usr/bin/gcc'
+    >>> paths.find_all(['gcc', 'nvcc'])
+    {'gcc': '/usr/bin/gcc', 'nvcc': None}
+
+    :param float interval: seconds between checks of a directory
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._dirs = dict()
+        self._lock = threading.Lock()
+
+    def rehash(self):
+        "Forget all directories"
+        with self._lock:
+            self._dirs.clear()
+
+    def _names(self, prefix):
+        "The names in the directory `prefix`"
+        now = time.time()
+        with self._lock:
+            entry = self._dirs.get(prefix)
+        if entry is not None and now - entry[2] < self.interval:
+            return entry[1]
+
+        try:
+            mtime = os.stat(prefix or os.curdir).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is None:
+            names = frozenset()
+        elif entry is not None and entry[0] == mtime:
+            names = entry[1]
+        else:
+            try:
+                names = frozenset(os.listdir(prefix or os.curdir))
+            except OSError:
+                names = frozenset()
+            # changes within the same tick as the listing could be missed
+            if now - mtime < 1:
+                mtime = None
+        with self._lock:
+            self._dirs[prefix] = (mtime, names, now)
+        return names
+
+    def find_all(self, exes, search=None):
+        """Locate many executables in one pass over the search paths
+
+        :param exes: the executable names
+        :type  exes: :class:`list` of :class:`str`
+        :param list of str search: search paths (as in :func:`find_in_path`)
+        :returns: the full path to each executable, if found
+        :rtype: :class:`dict` of :class:`str` to :class:`None` or
+                :class:`str`
+        """
+        search = search \
+            if search is not None\
+            else os.environ['PATH'].split(os.pathsep)
+
+        found = dict((exe, None) for exe in exes)
+        missing = set(found)
+        # names with a directory part are not simple directory entries
+        nested = set(exe for exe in missing if os.sep in exe)
+        for prefix in search:
+            if not missing:
+                break
+            names = self._names(prefix)
+            for exe in list(missing):
+                if exe in nested:
+                    path = os.path.join(prefix, exe)
+                    if not (os.path.exists(path)
+                            and os.access(path, os.X_OK)):
+                        continue
+                elif exe in names:
+                    path = os.path.join(prefix, exe)
+                    if not os.access(path, os.X_OK):
+                        continue
+                else:
+                    continue
+                found[exe] = path
+                missing.discard(exe)
+        return found
+
+    def find(self, exe, search=None):
+        """Locate an executable (as :func:`find_in_path`)
+
+        :rtype: :class:`None` or :class:`str`
+        """
+        return self.find_all([exe], search=search)[exe]
+
+
+def find_in_path(exe, search=None, hash=None):
     """Attempts to locate the given executable in the provided search
     paths. If `search` is ``None``, then the ``PATH`` environment
     variables is used.
 
     :param str exe: the executable name
     :param list of str search: search paths
+    :param hash: the names in the search paths
+    :type hash: :class:`PathHash`
     :returns: the full path to the executable
     :rtype: :class:`None` or :class:`str`
     """
+    if hash is not None:
+        return hash.find(exe, search=search)
+
     search = search \
         if search is not None\
         else os.environ['PATH'].split(os.pathsep)
@@ -280,16 +614,445 @@ def find_in_path(exe, search=None):
             return path
 
 
-def find_in_root(exe, root='/'):
+def _lstat_entries(path):
+    """Entries of `path` like those of :func:`os.scandir`, for when it
+    is not available
+    """
+    for name in os.listdir(path):
+        yield _DirEntry(path, name)
+
+
+class _DirEntry(object):
+    "The parts of :class:`os.DirEntry` used by :func:`search_root`"
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            return os.stat(self.path)
+        return self._lstat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+try:
+    _scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = _lstat_entries
+
+
+def _excluded(entry, exclude):
+    "Does a pattern in `exclude` match the name or path of `entry`"
+    for pattern in exclude:
+        target = entry.path if os.sep in pattern else entry.name
+        if fnmatch.fnmatch(target, pattern):
+            return True
+    return False
+
+
+class _Failure(object):
+    "An exception raised in a thread of :func:`_walk`"
+
+    def __init__(self, info):
+        self.info = info
+
+
+def _walk(root, visit, jobs=None):
+    """Visit the directories below `root` from `jobs` threads
+
+    ``visit(path, depth, stop)`` returns the directories to visit next
+    and a list of results, which are generated as they come. An
+    exception raised by `visit` stops the walk and is raised by the
+    generator. Closing the generator sets the `stop` event and waits
+    for the threads.
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    todo = Queue.Queue()
+    found = Queue.Queue()
+    stop = threading.Event()
+    lock = threading.Lock()
+    pending = [1]
+    done = object()
+
+    def worker():
+        while True:
+            item = todo.get()
+            if item is None:
+                return
+            try:
+                if not stop.is_set():
+                    path, depth = item
+                    subdirs, results = visit(path, depth, stop)
+                    with lock:
+                        pending[0] += len(subdirs)
+                    for subdir in subdirs:
+                        todo.put((subdir, depth + 1))
+                    for result in results:
+                        found.put(result)
+            except Exception:
+                stop.set()
+                found.put(_Failure(sys.exc_info()))
+            finally:
+                with lock:
+                    pending[0] -= 1
+                    finished = pending[0] == 0
+                if finished:
+                    found.put(done)
+
+    todo.put((root, 0))
+    threads = []
+    for _ in xrange(jobs):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        while True:
+            try:
+                # a timeout keeps the wait interruptible
+                item = found.get(True, 1)
+            except Queue.Empty:
+                continue
+            if item is done:
+                break
+            if isinstance(item, _Failure):
+                raise item.info[0], item.info[1], item.info[2]
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            todo.put(None)
+        for thread in threads:
+            thread.join()
+
+
+def search_root(exes, root='/', exclude=None, max_depth=None,
+                one_filesystem=False, jobs=None):
+    """Find executables by traversing the directory structure starting
+    at `root`.
+
+    The directories are read by `jobs` threads at the same time, so
+    the results come in no particular order. They are generated as
+    they are found: the traversal stops once the generator is closed.
+    Symbolic links to directories are not followed.
+
+    >>> for name, path in search_root(['gcc', 'nvcc'], root='/opt',
+    ...                               exclude=['.git', '/opt/old/*']):
+    ...   print name, path
+
+    :param exes: the executable names
+    :type  exes: :class:`str` or :class:`list` of :class:`str`
+    :param str root: prefix to start the search from
+    :param exclude: glob patterns of names to skip, or of paths if the
+                    pattern contains a directory separator
+    :type  exclude: :class:`list` of :class:`str`
+    :param int max_depth: do not enter directories more than this many
+                          levels below `root`
+    :param bool one_filesystem: do not enter other filesystems
+    :param int jobs: the number of threads reading directories
+                     (defaults to the number of CPUs)
+    :returns: pairs of executable names and their full paths
+    :rtype: generator of :class:`tuple` of (:class:`str`, :class:`str`)
+    """
+    if isinstance(exes, basestring):
+        exes = [exes]
+    exes = frozenset(exes)
+    exclude = list(exclude or [])
+    root = fullpath(root)
+    device = os.stat(root).st_dev if one_filesystem else None
+
+    def visit(path, depth, stop):
+        subdirs, found = [], []
+        try:
+            entries = list(_scandir(path))
+        except OSError, e:
+            logger.debug('Skipping %s: %s', path, e)
+            return subdirs, found
+        for entry in entries:
+            if stop.is_set():
+                break
+            if exclude and _excluded(entry, exclude):
+                continue
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_dir:
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                if device is not None:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if st.st_dev != device:
+                        continue
+                subdirs.append(entry.path)
+            elif entry.name in exes and not entry.is_dir() \
+                    and os.access(entry.path, os.X_OK):
+                found.append((entry.name, entry.path))
+        return subdirs, found
+
+    return _walk(root, visit, jobs)
+
+
+class FileIndex(object):
+    """An index of the files below `root`, like ``locate``.
+
+    The name and mode of every entry are recorded with the
+    modification time of its directory, and kept compressed in the
+    file `path`. :meth:`update` only reads the directories whose
+    modification time changed, and stats the others. Queries only use
+    the index, so they do not touch the tree.
+
+    >>> index = FileIndex('~/.cache/pxul/opt.index', root='/opt',
+    ...                   exclude=['.git'])
+    >>> index.update()
+    >>> index.find('gcc')
+    ['/opt/gcc/4.9/bin/gcc', '/opt/gcc/5.3/bin/gcc']
+    >>> find_in_root('nvcc', root='/opt/cuda', index=index)
+    '/opt/cuda/bin/nvcc'
+
+    .. warning::
+       Changing the mode of a file does not change the modification
+       time of its directory. Use ``update(full=True)`` to read every
+       directory again.
+
+    :param str path: the file to store the index in
+    :param str root: the directory to index
+    :param exclude: patterns of names or paths not to index
+                    (as in :func:`search_root`)
+    :type  exclude: :class:`list` of :class:`str`
+    :param bool one_filesystem: do not enter other filesystems
+    :param int jobs: the number of threads reading directories
+                     (defaults to the number of CPUs)
+    """
+
+    #: the version of the format of the index file
+    FORMAT = 1
+
+    def __init__(self, path, root='/', exclude=None, one_filesystem=False,
+                 jobs=None):
+        self.path = fullpath(path)
+        self.root = fullpath(root)
+        self.exclude = list(exclude or [])
+        self.one_filesystem = one_filesystem
+        self.jobs = jobs
+        self._dirs = dict()
+        self._names = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def _settings(self):
+        return (self.FORMAT, self.root, self.exclude, self.one_filesystem)
+
+    def load(self):
+        """Read the index from `path`, if it was made with the same
+        settings
+        """
+        try:
+            with open(self.path, 'rb') as fd:
+                settings, dirs = pickle.loads(zlib.decompress(fd.read()))
+        except (IOError, OSError, EOFError, ValueError, TypeError,
+                zlib.error, pickle.PickleError):
+            return
+        if settings != self._settings():
+            logger.debug('Ignoring index %s of other settings', self.path)
+            return
+        with self._lock:
+            self._dirs = dirs
+            self._names = None
+
+    def save(self):
+        "Write the index to `path`"
+        with self._lock:
+            data = pickle.dumps((self._settings(), self._dirs), 2)
+        pxul_subprocess._write_entry(self.path, zlib.compress(data))
+
+    def update(self, full=False, save=True):
+        """Bring the index up to date with the tree
+
+        :param bool full: read every directory again
+        :param bool save: write the index to `path` afterwards
+        :returns: the number of directories that were read
+        :rtype: :class:`int`
+        """
+        old = dict() if full else self._dirs
+        exclude = self.exclude
+        device = os.stat(self.root).st_dev if self.one_filesystem else None
+        started = time.time()
+
+        def visit(path, depth, stop):
+            try:
+                mtime = os.lstat(path).st_mtime
+            except OSError, e:
+                logger.debug('Skipping %s: %s', path, e)
+                return [], []
+            record = old.get(path)
+            if record is not None and record[0] == mtime:
+                names, modes = record[1], record[2]
+                subdirs = [os.path.join(path, name)
+                           for name, mode in itertools.izip(names, modes)
+                           if stat.S_ISDIR(mode)]
+                return subdirs, [(path, record, False)]
+
+            names, modes, subdirs = [], [], []
+            try:
+                entries = list(_scandir(path))
+            except OSError, e:
+                logger.debug('Skipping %s: %s', path, e)
+                return [], []
+            for entry in entries:
+                if exclude and _excluded(entry, exclude):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    if device is not None and st.st_dev != device:
+                        continue
+                    subdirs.append(entry.path)
+                names.append(entry.name)
+                modes.append(st.st_mode)
+            # changes within the same tick as the scan could be missed
+            if started - mtime < 1:
+                mtime = None
+            record = (mtime, tuple(names), tuple(modes))
+            return subdirs, [(path, record, True)]
+
+        dirs = dict()
+        read = 0
+        for path, record, scanned in _walk(self.root, visit, self.jobs):
+            dirs[path] = record
+            read += scanned
+        logger.debug('Read %d of %d directories below %s', read, len(dirs),
+                     self.root)
+
+        with self._lock:
+            self._dirs = dirs
+            self._names = None
+        if save:
+            self.save()
+        return read
+
+    def _by_name(self):
+        "The directories containing each name"
+        with self._lock:
+            if self._names is None:
+                names = collections.defaultdict(list)
+                for path, (_, entries, modes) in self._dirs.iteritems():
+                    for name, mode in itertools.izip(entries, modes):
+                        names[name].append((path, mode))
+                self._names = names
+            return self._names
+
+    def find(self, name):
+        """The paths of the entries called `name`
+
+        :rtype: :class:`list` of :class:`str`
+        """
+        return sorted(os.path.join(path, name)
+                      for path, _ in self._by_name().get(name, ()))
+
+    def glob(self, pattern):
+        """The paths of the entries matching a glob `pattern`, of their
+        name or, if the pattern contains a directory separator, of their
+        path
+
+        :rtype: :class:`list` of :class:`str`
+        """
+        names = self._by_name()
+        if os.sep in pattern:
+            paths = (os.path.join(path, name)
+                     for name, dirs in names.iteritems()
+                     for path, _ in dirs)
+            return sorted(fnmatch.filter(paths, pattern))
+        return sorted(os.path.join(path, name)
+                      for name in fnmatch.filter(names, pattern)
+                      for path, _ in names[name])
+
+    def search(self, exes):
+        """Find executables (as :func:`search_root`)
+
+        Regular files are executable if any execute bit is set in the
+        index. The targets of symbolic links are checked with
+        :func:`os.access`.
+
+        :param exes: the executable names
+        :type  exes: :class:`str` or :class:`list` of :class:`str`
+        :returns: pairs of executable names and their full paths
+        :rtype: :class:`list` of :class:`tuple` of (:class:`str`,
+                :class:`str`)
+        """
+        if isinstance(exes, basestring):
+            exes = [exes]
+        names = self._by_name()
+        found = []
+        for exe in exes:
+            for path, mode in names.get(exe, ()):
+                path = os.path.join(path, exe)
+                if stat.S_ISREG(mode):
+                    if not mode & 0111:
+                        continue
+                elif stat.S_ISLNK(mode):
+                    if os.path.isdir(path) or not os.access(path, os.X_OK):
+                        continue
+                else:
+                    continue
+                found.append((exe, path))
+        return sorted(found)
+
+
+def find_in_root(exe, root='/', index=None, **kws):
     """Attempts to find the executable name by traversing the directory
     structure starting at `root`.
 
+    Accepts the same keyword arguments as :func:`search_root`. As the
+    directories are read in parallel, the executable found first is not
+    necessarily the first in the order of :func:`os.walk`. Given an
+    index of `root`, it is searched instead of the directories.
+
     :param str exe: executable name
     :param str root: prefix to start the search from
+    :param index: an index of the files below `root`
+    :type index: :class:`FileIndex`
     :returns: full path to the executable
     :rtype: :class:`None` or :class:`str`
+    :raises: :class:`ValueError` if `root` is not in the `index`, or
+             given `exclude`, `max_depth`, or `one_filesystem` with an
+             `index`
     """
-    for dirpath, dirnames, filenames in os.walk(root):
-        path = os.path.join(dirpath, exe)
-        if exe in filenames and os.access(path, os.X_OK):
+    if index is not None:
+        if kws.get('exclude') or kws.get('max_depth') is not None \
+           or kws.get('one_filesystem'):
+            raise ValueError('Cannot exclude, limit the depth, or stay on '
+                             'one filesystem when searching an index')
+        prefix = os.path.join(fullpath(root), '')
+        if not prefix.startswith(os.path.join(index.root, '')):
+            raise ValueError('{} is not below the root {} of the index'
+                             .format(root, index.root))
+        for _, path in index.search([exe]):
+            if path.startswith(prefix):
+                return path
+        return None
+
+    results = search_root([exe], root=root, **kws)
+    try:
+        for _, path in results:
             return path
+    finally:
+        results.close()
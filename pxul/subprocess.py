@@ -5,6 +5,34 @@ AUTHOR:
  - Badi' Abdul-Wahid
 
 CHANGES:
+ - 2026-10-16:
+     - add `run_many` for running batches of commands concurrently
+     - add `stream` to iterate over the output of a running command
+     - add `Process`, `acall`, `arun`, and `Builder.acall` to run
+       commands without blocking
+     - add `Pipeline` to connect `Builder`s with OS pipes using `|`
+     - add `timeout` and `deadline` to `call`, `run`, and `run_many`
+     - record the resource `Usage` of children in `Result`
+     - add `Cache` to reuse the results of deterministic commands
+     - add the `posix_spawn` launcher, selected by `LAUNCHER` or per call
+     - add `env` and `cwd` to `call` and `run`
+     - add `ForkServer` to start children from a small helper process
+     - add `Builder.map_args` to run a command over many arguments
+     - add `Reactor` to drive many children from one thread,
+       `run_many` no longer needs a thread per job
+     - `input` may be a file, a descriptor, or an iterable of chunks
+     - add `spill` and `tail` to bound the memory used to capture output
+     - add `into` to read stdout straight into a caller's buffer
+     - add `Scheduler` to run a graph of dependent `Builder` tasks
+     - add `Coprocess` to run many small commands in one shell
+     - add `coalesce` to `run` and `Builder` to share the result of
+       identical commands running at the same time
+     - add `Sched` to set the CPU affinity, nice level, I/O priority,
+       and resource limits of children
+     - add `Governor` to adapt the number of concurrent commands of
+       `run_many` and `Scheduler` to the load and free memory
+     - add `Journal` so that restarted `run_many` batches skip the
+       commands that already succeeded
  - 2015-06-12:
      - return Result from `call` (issue #26)
      - add `run` (issue #27)
@@ -23,9 +51,32 @@ CHANGES:
 from __future__ import absolute_import
 
 import collections
+import cPickle as pickle
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import functools
+import hashlib
+import io
+import itertools
+import math
+import multiprocessing
+import os
 import pipes
+import platform
+import resource
+import select
+import signal
+import socket
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import types
+import mmap
 import logging
 logger = logging.getLogger('pxul')
 
@@ -33,6 +84,12 @@ logger = logging.getLogger('pxul')
 PIPE = subprocess.PIPE
 DEVNULL = open('/dev/null', 'w')
 
+#: seconds between terminating a child that timed out and killing it
+GRACE = 5
+
+#: how children are started by default (see :func:`_popen`)
+LAUNCHER = 'auto'
+
 
 class ArgumentsError(Exception):
     "Indicates that parameters to a subprocess were malformed"
@@ -69,11 +126,16 @@ class CalledProcessError(Exception):
     stderr and stdout
     """
 
-    def __init__(self, cmd, retcode, stdout=None, stderr=None):
+    def __init__(self, cmd, retcode, stdout=None, stderr=None, usage=None):
         self._cmd = cmd
         self._retcode = retcode
         self._stdout = stdout
         self._stderr = stderr
+        self._usage = usage
+
+    def __reduce__(self):
+        return (self.__class__, (self._cmd, self._retcode, self._stdout,
+                                 self._stderr, self._usage))
 
     @property
     def cmd(self):
@@ -95,131 +157,3231 @@ class CalledProcessError(Exception):
         "The stderr captured from the child process"
         return self._stderr
 
+    @property
+    def usage(self):
+        "The :class:`Usage` of the child process, if known"
+        return self._usage
 
-Result = collections.namedtuple('Result', ['out', 'err', 'ret'])
+    def __str__(self):
+        message = 'Command {} returned {}'.format(self._cmd, self._retcode)
+        if self._stderr:
+            message += '\n' + str(self._stderr)
+        return message
 
 
-def call(cmd, stdin=None, stdout=None, stderr=None, buffer=-1, input=None):
-    """Call an external command.
+class TimeoutExpired(CalledProcessError):
+    """Raised when a child did not finish within its time limit.
 
-    :param cmd: the command to run
-    :type cmd: :class:`list` or *iterable* of strings
-    :param stdin: where to read stdin from
-    :param stdout: where to write stdout to
-    :param stderr: where to write stderr to
-    :param buffer: the buffer size when communicating with the subprocess
-    :param input: initial input to pass to stdin
-    :returns: the stdout, stderr, and returncode as a namedtuple
-    :rtype: :class:`Result`
-    :raises: :class:`ArgumentsError`
-             if the arguments are malformed (see :func:`check_cmd`)
-    :raises: :class:`CalledProcessError` of the subprocess fails
+    The child has been terminated by the time this is raised. Any
+    output captured before then is available as `stdout` and `stderr`.
     """
-    logger.debug('Got command {}'.format(cmd))
-    check_cmd(cmd)
-    pretty = ' '.join(map(pipes.quote, cmd))
-    logger.debug('Calling: {}'.format(pretty))
-    proc = subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr,
-                            bufsize=buffer)
 
+    def __init__(self, cmd, retcode, timeout, stdout=None, stderr=None,
+                 usage=None):
+        super(TimeoutExpired, self).__init__(cmd, retcode, stdout=stdout,
+                                             stderr=stderr, usage=usage)
+        self._timeout = timeout
+
+    def __reduce__(self):
+        return (self.__class__, (self._cmd, self._retcode, self._timeout,
+                                 self._stdout, self._stderr, self._usage))
+
+    @property
+    def timeout(self):
+        "The number of seconds the child was allowed to run"
+        return self._timeout
+
+
+class Usage(collections.namedtuple('Usage', ['wall', 'utime', 'stime',
+                                             'maxrss', 'nvcsw', 'nivcsw'])):
+    """The resources used by a child process
+
+    - `wall`: elapsed seconds between starting and reaping the child
+    - `utime`: seconds of CPU time spent in user mode
+    - `stime`: seconds of CPU time spent in kernel mode
+    - `maxrss`: maximum resident set size in kilobytes
+    - `nvcsw`: number of voluntary context switches
+    - `nivcsw`: number of involuntary context switches
+    """
+
+    __slots__ = ()
+
+
+#: the number of the ioprio_set system call by architecture
+_IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+               'armv7l': 314, 'ppc64le': 273, 'ppc64': 273, 's390x': 282}
+
+_IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+
+class Sched(collections.namedtuple('Sched', ['cpus', 'nice', 'ionice',
+                                             'rlimits'])):
+    """How a child process is scheduled
+
+    The settings are applied in the child before it runs the command,
+    so the parent is not affected. This needs the `fork` launcher,
+    which is used automatically.
+
+    - `cpus`: the CPUs the child may run on
+    - `nice`: added to the nice level of the child (as ``nice -n``)
+    - `ionice`: the I/O scheduling class (`realtime`, `best-effort`,
+      or `idle`), optionally with a level as ``(class, level)``
+    - `rlimits`: :mod:`resource` limits as a :class:`dict` of
+      ``RLIMIT_*`` to ``(soft, hard)``
+
+    >>> sched = Sched(cpus=[2, 3], nice=10, ionice='idle',
+    ...               rlimits={resource.RLIMIT_AS: (2 ** 30, 2 ** 30)})
+    >>> run(['make', '-j2'], sched=sched)
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, cpus=None, nice=None, ionice=None, rlimits=None):
+        if cpus is not None:
+            cpus = tuple(sorted(set(cpus)))
+            if not cpus:
+                raise ValueError('Need at least one CPU')
+        if ionice is not None:
+            name, level = (ionice, 0) if isinstance(ionice, basestring) \
+                else ionice
+            if name not in _IOPRIO_CLASSES:
+                raise ValueError('Unknown I/O scheduling class {!r}'
+                                 .format(name))
+            ionice = (name, level)
+        if rlimits is not None:
+            rlimits = tuple(sorted(dict(rlimits).iteritems()))
+        return super(Sched, cls).__new__(cls, cpus, nice, ionice, rlimits)
+
+    def apply(self):
+        "Apply the settings to the calling process"
+        self._preexec()()
+
+    def _preexec(self):
+        """Prepare to apply the settings in a child before it runs the
+        command. Everything is computed in the parent so that the child
+        only makes system calls.
+
+        :rtype: :func:`callable`
+        """
+        mask = _affinity_mask(self.cpus) if self.cpus is not None else None
+        prio = None
+        if self.ionice is not None:
+            name, level = self.ionice
+            prio = (_IOPRIO_CLASSES[name] << 13) | level
+            if _IOPRIO_NUMBER is None:
+                raise OSError(errno.ENOSYS, 'ioprio_set is not known on {}'
+                              .format(platform.machine()))
+        nice, rlimits = self.nice, self.rlimits or ()
+
+        def preexec():
+            if mask is not None:
+                _check_libc(_sched_setaffinity(0, ctypes.sizeof(mask), mask))
+            if nice is not None:
+                os.nice(nice)
+            if prio is not None:
+                # IOPRIO_WHO_PROCESS, the calling process
+                _check_libc(_syscall(_IOPRIO_NUMBER, 1, 0, prio))
+            for limit, value in rlimits:
+                resource.setrlimit(limit, value)
+
+        return preexec
+
+
+class _StageSched(Sched):
+    """A :class:`Sched` that also restores the default action of
+    SIGPIPE, which Python ignores, so that a stage of a
+    :class:`Pipeline` stops once the next one stops reading
+    """
+
+    __slots__ = ()
+
+    def _preexec(self):
+        apply = super(_StageSched, self)._preexec()
+
+        def preexec():
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            apply()
+
+        return preexec
+
+
+def _load_libc():
+    """The C library, loaded once in the parent so that forked
+    children do not need to look for it
+
+    :returns: the C library or ``None``
+    """
     try:
-        out, err = proc.communicate(input=input)
-    except KeyboardInterrupt:
-        logger.debug('Caught SIGINT, terminating subprocess')
-        proc.terminate()
-        proc.kill()
-        raise
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.sched_setaffinity, libc.syscall
+    except (OSError, AttributeError):
+        return None, None
 
-    logger.debug('Subprocess finished with {}'.format(proc.returncode))
-    if proc.returncode is not 0:
-        raise CalledProcessError(pretty, proc.returncode,
-                                 stdout=out,
-                                 stderr=err)
-    result = Result(out=out, err=err, ret=proc.returncode)
+_sched_setaffinity, _syscall = _load_libc()
+
+#: the number of the ioprio_set system call on this machine
+_IOPRIO_NUMBER = _IOPRIO_SET.get(platform.machine())
+
+
+def _affinity_mask(cpus):
+    "The CPU set of `cpus` for :c:func:`sched_setaffinity`"
+    if _sched_setaffinity is None:
+        raise OSError(errno.ENOSYS, 'sched_setaffinity is not available')
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (max(cpus) // bits + 1))()
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    return mask
+
+
+def _check_libc(status):
+    "Raise the error of a C library call that returned `status`"
+    if status != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+class Result(collections.namedtuple('Result', ['out', 'err', 'ret'])):
+    """The stdout, stderr, and return code of a child process
+
+    The :class:`Usage` of the child is available as `usage` when it
+    is known.
+    """
+
+    usage = None
+
+    def __reduce__(self):
+        return (_restore_result, (self.__class__, tuple(self), self.__dict__))
+
+
+def _restore_result(cls, fields, state):
+    "Unpickle a :class:`Result` (or subclass) with its attributes"
+    result = tuple.__new__(cls, fields)
+    result.__dict__.update(state)
     return result
 
 
-def run(cmd, capture=None, raises=True, buffer=-1, input=None):
-    """Wrapper over :func:`call` with a simpler interface
+def _error_result(error):
+    """Convert a :class:`CalledProcessError` into a :class:`Result`"""
+    result = Result(out=error.stdout, err=error.stderr, ret=error.retcode)
+    result.usage = error.usage
+    return result
 
-    **Capture Options**
 
+class JournaledResult(Result):
+    """The :class:`Result` of a command that was skipped because a
+    :class:`Journal` records that it succeeded before
 
-    - `stdout`: capture the standard output
-    - `stderr`: capture the standard error
-    - `both`: capture both stdout and stderr
-    - `silent`: hide all output of the child process
+    Its output is not known, but the `digest` of its stdout is if the
+    journal keeps them.
+    """
 
-    :param list of str cmd: the command to call (as in :func:`call`)
-    :param str capture: capture options
-    :param bool raises: raise an exception on non-zero return of child
-    :param int buffer: buffer size (as in :class:`subprocess.Popen`)
-    :param str input: input value (as in :class:`subprocess.Popen.communicate`)
-    :returns: the result
-    :rtype: :class:`Result`
+    def __new__(cls, ret, digest=None):
+        self = Result.__new__(cls, None, None, ret)
+        self.digest = digest
+        return self
+
+
+class PipelineResult(Result):
+    """A :class:`Result` that also holds the return code of every stage
+    of a :class:`Pipeline` as `rets`
     """
-    kws = _capture_keywords(capture)
 
+    def __new__(cls, out, err, ret, rets):
+        self = Result.__new__(cls, out, err, ret)
+        self.rets = rets
+        return self
+
+
+class Spooled(object):
+    """Output of a child that was spilled to a temporary file
+
+    The contents are only mapped into memory (with :mod:`mmap`) when
+    they are accessed, and can be sliced like a string without
+    reading all of them. Converting to :class:`str` reads everything.
+
+    >>> res = run(['cat', 'huge.log'], capture='stdout', spill=1024 ** 2)
+    >>> res.out[:100]
+    """
+
+    def __init__(self, fd):
+        self.file = fd
+        self._map = None
+
+    @property
+    def mmap(self):
+        "The contents mapped into memory"
+        if self._map is None:
+            self._map = mmap.mmap(self.file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        return self._map
+
+    def __len__(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def __getitem__(self, index):
+        return self.mmap[index]
+
+    def __str__(self):
+        return self.mmap[:]
+
+    def __eq__(self, other):
+        if isinstance(other, Spooled):
+            other = str(other)
+        return str(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        return (str, (str(self),))
+
+    def close(self):
+        "Release the temporary file"
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self.file.close()
+
+
+class _Sink(object):
+    """Where the captured output of a child is kept
+
+    Subclasses keep the data given to `write(data)` and return the
+    output as given to the :class:`Result` from `value()`.
+    """
+
+    def read(self, fd):
+        """Read what is available from `fd`
+
+        :returns: ``False`` at end of file
+        """
+        data = _retry(os.read, fd, _CHUNK)
+        if data:
+            self.write(data)
+        return bool(data)
+
+
+class _Buffer(_Sink):
+    "Keep all the output of a child in memory"
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(data)
+
+    def value(self):
+        return ''.join(self._chunks)
+
+
+class _Spill(_Sink):
+    """Keep the output of a child in memory until it grows beyond
+    `limit` bytes, and in a temporary file from then on
+    """
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._chunks = []
+        self._size = 0
+        self._file = None
+
+    def write(self, data):
+        if self._file is None:
+            self._chunks.append(data)
+            self._size += len(data)
+            if self._size <= self._limit:
+                return
+            self._file = tempfile.TemporaryFile()
+            data = ''.join(self._chunks)
+            self._chunks = []
+        self._file.write(data)
+
+    def value(self):
+        if self._file is None:
+            return ''.join(self._chunks)
+        self._file.flush()
+        return Spooled(self._file)
+
+
+class _Tail(_Sink):
+    "Keep only the last `size` bytes of the output of a child"
+
+    def __init__(self, size):
+        self._ring = bytearray(size)
+        self._end = 0
+        self._full = False
+
+    def write(self, data):
+        size = len(self._ring)
+        if not size:
+            return
+        if len(data) >= size:
+            self._ring[:] = data[-size:]
+            self._end = 0
+            self._full = True
+            return
+
+        first = min(len(data), size - self._end)
+        self._ring[self._end:self._end + first] = data[:first]
+        self._ring[:len(data) - first] = data[first:]
+        if self._end + len(data) >= size:
+            self._full = True
+        self._end = (self._end + len(data)) % size
+
+    def value(self):
+        if self._full:
+            return str(self._ring[self._end:] + self._ring[:self._end])
+        return str(self._ring[:self._end])
+
+
+class _Into(_Sink):
+    """Read the output of a child straight into `target`
+
+    A :class:`bytearray` is grown as needed (and trimmed back
+    afterwards), any other writable buffer has to be large enough.
+    """
+
+    def __init__(self, target):
+        self._target = target
+        self._size = len(target)
+        self._end = 0
+        self._stream = None
+
+    def read(self, fd):
+        if self._stream is None:
+            self._stream = io.FileIO(fd, 'r', closefd=False)
+        if self._end == len(self._target):
+            if not isinstance(self._target, bytearray):
+                if not _retry(os.read, fd, 1):
+                    return False
+                raise BufferError('Output does not fit in {} bytes'
+                                  .format(self._size))
+            self._target.extend(bytearray(max(_CHUNK, len(self._target))))
+
+        view = memoryview(self._target)[self._end:]
+        count = _retry(self._stream.readinto, view)
+        # a bytearray cannot grow while it is being viewed
+        del view
+        self._end += count or 0
+        return count != 0
+
+    def value(self):
+        if isinstance(self._target, bytearray):
+            del self._target[max(self._size, self._end):]
+        return memoryview(self._target)[:self._end]
+
+
+def _check_resizable(target):
+    """Raise :class:`ValueError` if the :class:`bytearray` `target`
+    cannot be resized, because a :class:`memoryview` of it is alive
+    """
     try:
-        return call(cmd, buffer=buffer, input=input, **kws)
-    except CalledProcessError, e:
-        if raises:
-            raise
+        target.append(0)
+    except BufferError:
+        raise ValueError('Cannot read into a bytearray that is still '
+                         'viewed, release the output of earlier results '
+                         'read into it first')
+    del target[-1]
+
+
+def _load_posix_spawn():
+    """Find :c:func:`posix_spawnp` in the C library
+
+    :returns: the C library if it provides the functions needed
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        for name in ['posix_spawnp',
+                     'posix_spawn_file_actions_init',
+                     'posix_spawn_file_actions_destroy',
+                     'posix_spawn_file_actions_adddup2',
+                     'posix_spawn_file_actions_addclose']:
+            getattr(libc, name)
+        ctypes.POINTER(ctypes.c_char_p).in_dll(libc, 'environ')
+    except (OSError, TypeError, AttributeError, ValueError):
+        return None
+    if not hasattr(libc, 'posix_spawn_file_actions_addchdir_np'):
+        libc.posix_spawn_file_actions_addchdir_np = None
+    return libc
+
+_libc = _load_posix_spawn()
+
+
+class _SpawnPopen(subprocess.Popen):
+    """A :class:`subprocess.Popen` that starts the child with
+    :c:func:`posix_spawnp` instead of :func:`os.fork`.
+
+    Forking copies the page tables of the parent and runs Python code
+    in the child before it can exec, which gets slower the larger the
+    parent is. The C library can instead start the child with vfork
+    (or the equivalent), whose cost does not depend on the parent.
+    """
+
+    # generously sized to hold posix_spawn_file_actions_t
+    _ACTIONS_SIZE = 64
+
+    def _execute_child(self, args, executable, preexec_fn, close_fds,
+                       cwd, env, universal_newlines,
+                       startupinfo, creationflags, shell, to_close,
+                       p2cread, p2cwrite,
+                       c2pread, c2pwrite,
+                       errread, errwrite):
+        args = list(args)
+        if shell:
+            args = ['/bin/sh', '-c'] + args
+        if executable is None:
+            executable = args[0]
+
+        argv = (ctypes.c_char_p * (len(args) + 1))(*(args + [None]))
+        if env is None:
+            envp = ctypes.POINTER(ctypes.c_char_p).in_dll(_libc, 'environ')
         else:
-            return Result(out=e.stdout, err=e.stderr, ret=e.retcode)
+            pairs = ['{}={}'.format(k, v) for k, v in env.iteritems()]
+            envp = (ctypes.c_char_p * (len(pairs) + 1))(*(pairs + [None]))
 
+        actions = (ctypes.c_long * self._ACTIONS_SIZE)()
+        _libc.posix_spawn_file_actions_init(actions)
+        try:
+            # like the fork implementation: close the parent's ends,
+            # move the child's ends into place, then close the originals
+            for fd in (p2cwrite, c2pread, errread):
+                if fd is not None:
+                    _libc.posix_spawn_file_actions_addclose(actions, fd)
+            for fd, target in ((p2cread, 0), (c2pwrite, 1), (errwrite, 2)):
+                if fd is not None and fd != target:
+                    _libc.posix_spawn_file_actions_adddup2(actions, fd, target)
+            for fd in set([p2cread, c2pwrite, errwrite]) - set([None]):
+                if fd > 2:
+                    _libc.posix_spawn_file_actions_addclose(actions, fd)
+            if cwd is not None:
+                _libc.posix_spawn_file_actions_addchdir_np(actions, cwd)
 
-def _capture_keywords(capture):
-    """Generate the keywords to capture the output of a subprocess
+            pid = ctypes.c_int()
+            error = _libc.posix_spawnp(ctypes.byref(pid), executable, actions,
+                                       None, argv, envp)
+        finally:
+            _libc.posix_spawn_file_actions_destroy(actions)
 
-    :param capture: one of {stdout | stderr | both}
-    :returns: the keyword arguments
-    :rtype: :class:`dict`
+            for fd, parent_end in ((p2cread, p2cwrite), (c2pwrite, c2pread),
+                                   (errwrite, errread)):
+                if fd is not None and parent_end is not None:
+                    os.close(fd)
+                    to_close.remove(fd)
+
+        if error != 0:
+            raise OSError(error, os.strerror(error))
+        self.pid = pid.value
+        self._child_created = True
+
+
+def _can_spawn(stdin, stdout, stderr, kws):
+    """Whether the child can be started by :class:`_SpawnPopen`"""
+    if _libc is None:
+        return False
+    if kws.get('preexec_fn') or kws.get('close_fds'):
+        return False
+    if kws.get('cwd') is not None \
+       and _libc.posix_spawn_file_actions_addchdir_np is None:
+        return False
+    # the descriptors would need to be shuffled around the standard ones
+    for target, handle in enumerate((stdin, stdout, stderr)):
+        if isinstance(handle, file):
+            handle = handle.fileno()
+        if isinstance(handle, int) and handle in (0, 1, 2) \
+           and handle != target:
+            return False
+    return True
+
+
+def _popen(cmd, stdin=None, stdout=None, stderr=None, buffer=-1,
+           launcher=None, **kws):
+    """Validate `cmd` and start the child process
+
+    **Launchers**
+
+    - `fork`: :class:`subprocess.Popen`
+    - `posix_spawn`: :c:func:`posix_spawnp` from the C library
+    - `auto`: `posix_spawn` if available and able to start the child,
+      otherwise `fork`
+    - `forkserver`: :func:`run` sends the command to the
+      :class:`ForkServer` started by :func:`start_forkserver`, other
+      functions, and :func:`run` when the server cannot run the
+      command, use `auto` and log that they do
+
+    :param str launcher: how to start the child (defaults to
+                         :data:`LAUNCHER`)
+    :returns: the child process and the pretty-printed command
+    :rtype: :class:`tuple` of (:class:`subprocess.Popen`, :class:`str`)
+    :raises: :class:`ValueError` if the launcher is not known or
+             cannot start the child
     """
-    kws = {}
-    if capture == 'stdout' or capture == 'both':
-        kws['stdout'] = PIPE
+    logger.debug('Got command {}'.format(cmd))
+    check_cmd(cmd)
+    pretty = ' '.join(map(pipes.quote, cmd))
 
-    if capture == 'stderr' or capture == 'both':
-        kws['stderr'] = PIPE
+    launcher = launcher or LAUNCHER
+    if launcher == 'forkserver':
+        logger.info('Not using the fork server for {}: only run() can'
+                    .format(pretty))
+    if launcher in ('auto', 'forkserver'):
+        spawn = _can_spawn(stdin, stdout, stderr, kws)
+    elif launcher == 'posix_spawn':
+        if not _can_spawn(stdin, stdout, stderr, kws):
+            raise ValueError('Cannot use posix_spawn to call {}'.format(pretty))
+        spawn = True
+    elif launcher == 'fork':
+        spawn = False
+    else:
+        raise ValueError('Unknown launcher {!r}'.format(launcher))
 
-    if capture == 'silent':
-        kws['stdout'] = DEVNULL
-        kws['stderr'] = DEVNULL
+    Popen = _SpawnPopen if spawn else subprocess.Popen
+    logger.debug('Calling: {}'.format(pretty))
+    proc = Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr,
+                 bufsize=buffer, **kws)
+    return proc, pretty
 
-    return kws
 
+#: the number of bytes read from, or written to, a child at once
+_CHUNK = 64 * 1024
 
-class Builder(object):
-    """Utility for building commands which can be called with more
-    specific arguments later.
 
-    Instances of :class:`Builder` are :func:`callable`. This is the
-    intended usage when invoking a :class:`Builder` to call the
-    subprocess.
+def _retry(function, *args):
+    """Call `function`, restarting it if interrupted by a signal"""
+    while True:
+        try:
+            return function(*args)
+        except (OSError, IOError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
 
-    >>> echo = Builder(['echo', 'hello', capture='stdout')
-    >>> print echo()[0].strip()
+
+def _ready(readers, writers, timeout):
+    """Wait up to `timeout` seconds (``None`` for no limit) until some
+    of the descriptors can be read or written.
+
+    Unlike :func:`select.select`, :func:`select.poll` is not limited to
+    descriptors below ``FD_SETSIZE``.
+
+    :returns: the descriptors that are ready to read and to write
+    :rtype: :class:`tuple` of :class:`list`
+    """
+    poller = select.poll()
+    for fd in readers:
+        poller.register(fd, select.POLLIN | select.POLLHUP | select.POLLERR)
+    for fd in writers:
+        poller.register(fd, select.POLLOUT | select.POLLERR)
+    if timeout is not None:
+        # round up so that short waits do not become busy loops
+        timeout = int(math.ceil(timeout * 1000))
+    events = _retry(poller.poll, timeout)
+    ready_r = [fd for fd, _ in events if fd in readers]
+    ready_w = [fd for fd, _ in events if fd in writers]
+    return ready_r, ready_w
+
+
+class Process(object):
+    """A child process that is driven without blocking the caller.
+
+    The child's pipes are serviced by :meth:`pump`, which only
+    transfers data that can be read or written immediately (or within
+    the given timeout). This makes it possible to run many children
+    from a single thread, either by polling :meth:`done` or by
+    watching the descriptors from :meth:`readers` and :meth:`writers`
+    in an event loop and calling :meth:`pump` when they are ready.
+
+    >>> proc = Process(['echo', 'hello'], stdout=PIPE)
+    >>> while not proc.done():
+    ...   do_something_else()
+    >>> print proc.wait().out.strip()
     hello
-    >>> print echo('world')[0].strip()
-    hello world
-    >>> print echo('universe')[0].strip()
-    hello universe
+
+    If the child is still running after `timeout` seconds or at the
+    `deadline` (in seconds since the epoch, as :func:`time.time`) it
+    is sent SIGTERM, and SIGKILL if it is still running `grace`
+    seconds later. It then fails with :class:`TimeoutExpired`.
+    Deadlines are only enforced while the process is being pumped.
+
+    Accepts the same arguments as :func:`call`, as well as `raises`
+    (as in :func:`run`).
     """
 
-    def __init__(self, cmd, capture=None):
-        check_cmd(cmd)
-        self.cmd = cmd
-        self.capture = capture
+    def __init__(self, cmd, stdin=None, stdout=None, stderr=None,
+                 buffer=-1, input=None, raises=True,
+                 timeout=None, deadline=None, grace=GRACE, launcher=None,
+                 env=None, cwd=None, spill=None, tail=None, into=None,
+                 sched=None):
+        if into is not None and stdout is not PIPE:
+            raise ValueError('Reading into a buffer requires stdout=PIPE')
+        if isinstance(into, bytearray):
+            _check_resizable(into)
+        handle, source = _input_source(input)
+        if handle is not None and stdin is None:
+            stdin = handle
+        kws = dict(preexec_fn=sched._preexec()) if sched is not None \
+            else {}
+        self._proc, self.cmd = _popen(cmd, stdin=stdin, stdout=stdout,
+                                      stderr=stderr, buffer=buffer,
+                                      launcher=launcher, env=env, cwd=cwd,
+                                      **kws)
+        self.pid = self._proc.pid
+        self._raises = raises
+        self._result = None
 
-    def add_args(self, args):
-        check_cmd(args)
-        self.cmd.extend(args)
+        self._started = time.time()
+        self._deadline = _deadline(self._started, timeout, deadline)
+        self._timeout = timeout
+        if deadline is not None and deadline == self._deadline:
+            self._timeout = deadline - self._started
+        self._grace = grace
+        self._expired = False
+        self._kill_at = None
+        self._usage = None
 
-    def __call__(self, *args, **call_kws):
-        check_cmd(args)
-        cmd = list(self.cmd) + list(args)
+        self._source = source
+        self._pending = ''
+        self._written = 0
+        self._writer = None
+        if self._proc.stdin:
+            if self._source is not None:
+                self._writer = self._proc.stdin.fileno()
+                flags = fcntl.fcntl(self._writer, fcntl.F_GETFL)
+                fcntl.fcntl(self._writer, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            else:
+                self._proc.stdin.close()
 
-        kws = _capture_keywords(self.capture)
-        call_kws.update(kws)
-        return call(cmd, **call_kws)
+        self._pipes = dict()
+        self._sinks = dict()
+        self._handlers = dict()
+        for pipe in (self._proc.stdout, self._proc.stderr):
+            if pipe:
+                self._pipes[pipe.fileno()] = pipe
+                if into is not None and pipe is self._proc.stdout:
+                    self._sinks[pipe] = _Into(into)
+                elif tail is not None and pipe is self._proc.stderr:
+                    self._sinks[pipe] = _Tail(tail)
+                elif spill is not None:
+                    self._sinks[pipe] = _Spill(spill)
+                else:
+                    self._sinks[pipe] = _Buffer()
+        self._readers = list(self._pipes.keys())
+
+    def readers(self):
+        "The descriptors of the child's output that are still open"
+        return list(self._readers)
+
+    def writers(self):
+        "The descriptors of the child's input that are still open"
+        return [self._writer] if self._writer is not None else []
+
+    def _read(self, fd):
+        pipe = self._pipes[fd]
+        handler = self._handlers.get(pipe)
+        if handler is not None:
+            data = _retry(os.read, fd, _CHUNK)
+            if data:
+                handler(data)
+            more = bool(data)
+        else:
+            try:
+                more = self._sinks[pipe].read(fd)
+            except BufferError:
+                self.terminate()
+                self._close_pipes()
+                raise
+        if not more:
+            self._readers.remove(fd)
+            pipe.close()
+
+    def _write(self, fd):
+        # only take the next chunk once the child has read the last one
+        while self._written >= len(self._pending):
+            self._pending = next(self._source, None)
+            self._written = 0
+            if self._pending is None:
+                self._writer = None
+                self._proc.stdin.close()
+                return
+
+        chunk = buffer(self._pending, self._written, _CHUNK)
+        try:
+            self._written += _retry(os.write, fd, chunk)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            elif e.errno != errno.EPIPE:
+                raise
+            # the child does not want any more input
+            self._source = iter([])
+            self._pending = ''
+            self._written = 0
+
+    def pump(self, timeout=0):
+        """Transfer any data that is ready and check if the child exited
+
+        :param float timeout: the number of seconds to wait for data
+                              (``None`` to wait until some arrives)
+        :returns: whether the child has finished
+        :rtype: :class:`bool`
+        """
+        if self._result is not None:
+            return True
+
+        timeout = self._until_enforced(timeout)
+        readers, writers = self.readers(), self.writers()
+        if readers or writers:
+            ready_r, ready_w = _ready(readers, writers, timeout)
+            for fd in ready_w:
+                self._write(fd)
+            for fd in ready_r:
+                self._read(fd)
+            timeout = 0
+        return self._settle(timeout)
+
+    def _settle(self, timeout=0):
+        """Check if the child exited once its pipes have been serviced,
+        without touching the pipes themselves
+
+        :param float timeout: the number of seconds to wait for the
+                              child to exit if its pipes are closed
+        :returns: whether the child has finished
+        :rtype: :class:`bool`
+        """
+        if self._result is not None:
+            return True
+
+        if self._readers or self._writer is not None:
+            if self._expired and self._wait4(os.WNOHANG):
+                # descendants of the child may hold on to the pipes
+                self._close_pipes()
+            if self._readers or self._writer is not None:
+                self._enforce()
+                return False
+            timeout = 0
+
+        if self._reap(timeout):
+            self._finish()
+            return True
+        self._enforce()
+        return False
+
+    def _until_enforced(self, timeout):
+        "Limit `timeout` to the time left until the deadline is enforced"
+        if self._expired:
+            # check frequently whether the child has gone
+            when = min(self._kill_at, time.time() + 0.05) \
+                if self._kill_at is not None else time.time() + 0.05
+        else:
+            when = self._deadline
+        if when is None:
+            return timeout
+        remaining = max(0, when - time.time())
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def _enforce(self):
+        "Terminate, and later kill, the child if past the deadline"
+        now = time.time()
+        try:
+            if self._deadline is not None and not self._expired \
+               and now >= self._deadline:
+                logger.debug('Timed out, terminating {}'.format(self.cmd))
+                self._expired = True
+                self._kill_at = now + self._grace
+                if self._proc.returncode is None:
+                    self._proc.terminate()
+            elif self._kill_at is not None and now >= self._kill_at:
+                logger.debug('Grace period over, killing {}'.format(self.cmd))
+                self._kill_at = None
+                if self._proc.returncode is None:
+                    self._proc.kill()
+        except OSError:
+            # the child exited in the meantime
+            pass
+
+    def _close_pipes(self):
+        for fd in self._readers:
+            self._pipes[fd].close()
+        self._readers = []
+        if self._writer is not None:
+            self._writer = None
+            self._proc.stdin.close()
+
+    def _wait4(self, options):
+        """Reap the child, recording its resource usage
+
+        :returns: whether the child has exited
+        """
+        if self._proc.returncode is not None:
+            return True
+        try:
+            pid, status, rusage = _retry(os.wait4, self.pid, options)
+        except OSError, e:
+            if e.errno != errno.ECHILD:
+                raise
+            # already reaped elsewhere, let Popen sort it out
+            return self._proc.poll() is not None
+        if pid == 0:
+            return False
+
+        self._proc._handle_exitstatus(status)
+        self._usage = Usage(wall=time.time() - self._started,
+                            utime=rusage.ru_utime, stime=rusage.ru_stime,
+                            maxrss=rusage.ru_maxrss,
+                            nvcsw=rusage.ru_nvcsw, nivcsw=rusage.ru_nivcsw)
+        return True
+
+    def _reap(self, timeout):
+        "Wait up to `timeout` seconds for the child to exit"
+        if timeout is None:
+            return self._wait4(0)
+        deadline = time.time() + timeout
+        delay = 0.0005
+        while not self._wait4(os.WNOHANG):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(2 * delay, 0.05)
+        return True
+
+    def _output(self, pipe):
+        if pipe is None:
+            return None
+        return self._sinks[pipe].value()
+
+    def _finish(self):
+        out = self._output(self._proc.stdout)
+        err = self._output(self._proc.stderr)
+        ret = self._proc.returncode
+        self._sinks.clear()
+
+        logger.debug('Subprocess finished with {}'.format(ret))
+        if self._expired:
+            self._result = TimeoutExpired(self.cmd, ret, self._timeout,
+                                          stdout=out, stderr=err,
+                                          usage=self._usage)
+        elif ret is not 0:
+            self._result = CalledProcessError(self.cmd, ret,
+                                              stdout=out, stderr=err,
+                                              usage=self._usage)
+        else:
+            self._result = Result(out=out, err=err, ret=ret)
+            self._result.usage = self._usage
+
+    def done(self):
+        """Check if the child has finished without blocking
+
+        :rtype: :class:`bool`
+        """
+        return self.pump(timeout=0)
+
+    def wait(self):
+        """Block until the child has finished
+
+        :returns: the stdout, stderr, and returncode as a namedtuple
+        :rtype: :class:`Result`
+        :raises: :class:`CalledProcessError` if the subprocess fails
+                 and the process was created with `raises` set
+        :raises: :class:`TimeoutExpired` if the subprocess timed out
+                 and the process was created with `raises` set
+        """
+        while not self.pump(timeout=None):
+            pass
+        return self.result()
+
+    def result(self):
+        """The result of a finished child
+
+        :rtype: :class:`Result`
+        :raises: :class:`CalledProcessError` if the subprocess failed
+                 and the process was created with `raises` set
+        :raises: :class:`ValueError` if the child is still running
+        """
+        if self._result is None:
+            raise ValueError('{} is still running'.format(self.cmd))
+        if isinstance(self._result, CalledProcessError):
+            if self._raises:
+                raise self._result
+            return _error_result(self._result)
+        return self._result
+
+    def terminate(self):
+        "Terminate, then kill, the child if it is still running"
+        _terminate(self._proc)
+
+
+def _input_source(input):
+    """Work out how to pass `input` to a child
+
+    - a string is written to the child
+    - a descriptor, or a file with one, becomes the stdin of the child
+    - anything else with a `read` method is read in chunks and written
+      to the child
+    - any other iterable generates the chunks to write
+
+    :returns: what to use as stdin and the chunks to write, if any
+    :rtype: :class:`tuple`
+    """
+    if input is None:
+        return None, None
+    if isinstance(input, basestring):
+        return PIPE, iter([input] if input else [])
+    if isinstance(input, (int, long)):
+        return input, None
+    try:
+        input.fileno()
+    except (AttributeError, IOError, ValueError):
+        pass
+    else:
+        return input, None
+    if hasattr(input, 'read'):
+        return PIPE, iter(functools.partial(input.read, _CHUNK), '')
+    return PIPE, iter(input)
+
+
+def _deadline(start, timeout, deadline):
+    """The earlier of `start` + `timeout` and `deadline`, if any"""
+    if timeout is not None:
+        timeout = start + timeout
+        return timeout if deadline is None else min(timeout, deadline)
+    return deadline
+
+
+class Reactor(object):
+    """Drive the pipes of many :class:`Process`\ es from one thread.
+
+    The pipes of all the children are watched with a single
+    :func:`select.epoll` (or :func:`select.poll` where that is not
+    available), so any number of children can be captured at once
+    without a thread each. Output is either collected in the
+    :class:`Result` of each child as usual, or handed to the
+    `on_stdout` and `on_stderr` callbacks as it arrives. Once a child
+    has finished, `on_exit` is called with its :class:`Process`.
+
+    >>> reactor = Reactor()
+    >>> for cmd in cmds:
+    ...   proc = acall(cmd, stdout=PIPE)
+    ...   reactor.add(proc, on_stdout=lambda proc, data: log(data),
+    ...               on_exit=lambda proc: report(proc.result()))
+    >>> reactor.run()
+    """
+
+    def __init__(self):
+        self._epoll = hasattr(select, 'epoll')
+        if self._epoll:
+            self._poller = select.epoll()
+            self._read_events = select.EPOLLIN | select.EPOLLHUP \
+                | select.EPOLLERR
+            self._write_events = select.EPOLLOUT | select.EPOLLERR
+        else:
+            self._poller = select.poll()
+            self._read_events = select.POLLIN | select.POLLHUP \
+                | select.POLLERR
+            self._write_events = select.POLLOUT | select.POLLERR
+        self._fds = dict()
+        self._owned = dict()
+        self._exits = dict()
+        self._watched = dict()
+        self._delay = 0
+
+    def __len__(self):
+        "The number of children that have not finished"
+        return len(self._exits)
+
+    def processes(self):
+        """The children that have not finished
+
+        :rtype: :class:`list` of :class:`Process`
+        """
+        return list(self._exits)
+
+    def add(self, proc, on_stdout=None, on_stderr=None, on_exit=None):
+        """Drive a child
+
+        :param proc: the child
+        :type proc: :class:`Process`
+        :param on_stdout: called with the child and data from its stdout
+        :param on_stderr: called with the child and data from its stderr
+        :param on_exit: called with the child once it has finished
+        """
+        for pipe, handler in ((proc._proc.stdout, on_stdout),
+                              (proc._proc.stderr, on_stderr)):
+            if pipe is not None and handler is not None:
+                proc._handlers[pipe] = functools.partial(handler, proc)
+
+        self._exits[proc] = on_exit
+        self._owned[proc] = set()
+        self._sync(proc)
+
+    def watch(self, fd, on_ready):
+        """Also watch a descriptor that is not a child's pipe
+
+        :param int fd: the descriptor to watch for reading
+        :param on_ready: called without arguments when `fd` is readable
+        """
+        self._watched[fd] = on_ready
+        self._poller.register(fd, self._read_events)
+
+    def unwatch(self, fd):
+        "Stop watching a descriptor given to :meth:`watch`"
+        if self._watched.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    def _sync(self, proc):
+        "Watch exactly the descriptors the child still has open"
+        readers, writers = set(proc.readers()), set(proc.writers())
+        owned = self._owned[proc]
+        for fd in owned - readers - writers:
+            del self._fds[fd]
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError, KeyError):
+                # closed descriptors are dropped by epoll already
+                pass
+        for fd in (readers | writers) - owned:
+            self._fds[fd] = proc
+            events = self._read_events if fd in readers \
+                else self._write_events
+            self._poller.register(fd, events)
+        self._owned[proc] = readers | writers
+
+    def _timeout(self, timeout):
+        "Limit `timeout` so that deadlines and exits are noticed"
+        for proc, fds in self._owned.iteritems():
+            timeout = proc._until_enforced(timeout)
+            if not fds:
+                # only exits without open pipes need to be polled for
+                self._delay = min(max(2 * self._delay, 0.0005), 0.05)
+                timeout = self._delay if timeout is None \
+                    else min(timeout, self._delay)
+        return timeout
+
+    def poll(self, timeout=None):
+        """Transfer the data that is ready and handle finished children
+
+        :param float timeout: the number of seconds to wait for data
+                              (``None`` to wait until some arrives)
+        """
+        if not self._exits and not self._watched:
+            return
+
+        timeout = self._timeout(timeout)
+        if not self._epoll:
+            timeout = None if timeout is None else int(timeout * 1000)
+        elif timeout is None:
+            timeout = -1
+        events = _retry(self._poller.poll, timeout)
+
+        for fd, _ in events:
+            on_ready = self._watched.get(fd)
+            if on_ready is not None:
+                on_ready()
+                continue
+            proc = self._fds.get(fd)
+            if proc is None:
+                continue
+            if fd == proc._writer:
+                proc._write(fd)
+            else:
+                proc._read(fd)
+            self._sync(proc)
+
+        for proc in list(self._exits):
+            if self._owned[proc] and not proc._expired:
+                proc._enforce()
+            elif proc._settle():
+                self._sync(proc)
+                del self._owned[proc]
+                on_exit = self._exits.pop(proc)
+                self._delay = 0
+                if on_exit is not None:
+                    on_exit(proc)
+            else:
+                self._sync(proc)
+
+    def run(self, timeout=None):
+        """Drive the children until they have all finished
+
+        :param float timeout: return after this many seconds even if
+                              some children are still running
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self._exits:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+            self.poll(remaining)
+
+    def terminate(self):
+        "Terminate, then kill, all children that are still running"
+        for proc in self._exits:
+            proc.terminate()
+
+    def close(self):
+        "Release the resources used to watch the children"
+        if self._epoll:
+            self._poller.close()
+
+
+def _wait_all(procs):
+    """Wait for all the processes, servicing their pipes concurrently
+
+    :param procs: the running children
+    :type procs: :class:`list` of :class:`Process`
+    """
+    reactor = Reactor()
+    try:
+        for proc in procs:
+            reactor.add(proc)
+        reactor.run()
+    finally:
+        reactor.close()
+
+
+def _terminate(proc):
+    """Terminate, then kill, the child if it is still running"""
+    if proc.returncode is not None:
+        return
+    try:
+        proc.terminate()
+        proc.kill()
+    except OSError:
+        # the child exited in the meantime
+        pass
+
+
+class _Flights(object):
+    """Share the outcome of identical calls made at the same time
+
+    The first caller for a key runs the function while later ones wait
+    for its outcome, which can be kept for `ttl` seconds afterwards.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = dict()
+        self._recent = dict()
+
+    def do(self, key, function, ttl=0):
+        while True:
+            with self._lock:
+                now = time.time()
+                for other, (expires, _) in self._recent.items():
+                    if expires <= now:
+                        del self._recent[other]
+                if key in self._recent:
+                    return self._outcome(self._recent[key][1])
+                flight = self._running.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._running[key] = [threading.Event(), None]
+
+            if not leader:
+                flight[0].wait()
+                if flight[1] is not None:
+                    return self._outcome(flight[1])
+                # the leader was interrupted, try again
+                continue
+
+            outcome = None
+            try:
+                outcome = (True, function())
+            except Exception:
+                outcome = (False, sys.exc_info())
+            finally:
+                with self._lock:
+                    del self._running[key]
+                    flight[1] = outcome
+                    if ttl and outcome is not None:
+                        self._recent[key] = (time.time() + ttl, outcome)
+                flight[0].set()
+            return self._outcome(outcome)
+
+    def _outcome(self, outcome):
+        ok, value = outcome
+        if ok:
+            return value
+        raise value[0], value[1], value[2]
+
+
+_flights = _Flights()
+
+
+def _coalesced(function, coalesce, cmd, capture, raises, input, env, cwd,
+               **options):
+    """Call `function`, sharing its outcome with identical calls if
+    `coalesce` is set (see :func:`run`)
+
+    The other `options` of the call, such as the `timeout` or `spill`,
+    must match as well, since they change the outcome.
+    """
+    if not coalesce or not (input is None or isinstance(input, basestring)):
+        return function()
+    env = tuple(sorted(env.iteritems())) if env is not None else None
+    key = (tuple(cmd), capture, raises, input, env, cwd,
+           tuple(sorted(options.iteritems())))
+    ttl = 0 if coalesce is True else coalesce
+    return _flights.do(key, function, ttl=ttl)
+
+
+def call(cmd, stdin=None, stdout=None, stderr=None, buffer=-1, input=None,
+         timeout=None, deadline=None, grace=GRACE, launcher=None,
+         env=None, cwd=None, spill=None, tail=None, into=None, sched=None):
+    """Call an external command.
+
+    :param cmd: the command to run
+    :type cmd: :class:`list` or *iterable* of strings
+    :param stdin: where to read stdin from
+    :param stdout: where to write stdout to
+    :param stderr: where to write stderr to
+    :param buffer: the buffer size when communicating with the subprocess
+    :param input: initial input to pass to stdin: a string, a file or
+                  descriptor to read stdin from, or an iterable of
+                  strings which are written as the child reads them
+    :param float timeout: seconds the subprocess is allowed to run
+    :param float deadline: time (as :func:`time.time`) by which the
+                           subprocess must be finished
+    :param float grace: seconds between terminating and killing a
+                        subprocess that timed out
+    :param str launcher: how to start the subprocess (see :func:`_popen`)
+    :param dict env: the environment of the subprocess
+                     (defaults to that of the caller)
+    :param str cwd: the working directory of the subprocess
+    :param int spill: bytes of captured output to keep in memory,
+                      the rest is written to a temporary file and
+                      returned as :class:`Spooled`
+    :param int tail: only keep the last `tail` bytes of captured stderr
+    :param into: read the captured stdout into this :class:`bytearray`
+                 (grown as needed) or writable :class:`memoryview`,
+                 the stdout of the result is then a :class:`memoryview`
+                 of the part that was written
+    :param sched: how to schedule the subprocess
+    :type sched: :class:`Sched`
+    :returns: the stdout, stderr, and returncode as a namedtuple
+    :rtype: :class:`Result`
+    :raises: :class:`ArgumentsError`
+             if the arguments are malformed (see :func:`check_cmd`)
+    :raises: :class:`CalledProcessError` of the subprocess fails
+    :raises: :class:`TimeoutExpired` if the subprocess timed out
+    :raises: :class:`BufferError` if the stdout does not fit in `into`
+    :raises: :class:`ValueError` if `into` is a :class:`bytearray`
+             that is still viewed, such as by an earlier result
+    """
+    proc = Process(cmd, stdin=stdin, stdout=stdout, stderr=stderr,
+                   buffer=buffer, input=input, timeout=timeout,
+                   deadline=deadline, grace=grace, launcher=launcher,
+                   env=env, cwd=cwd, spill=spill, tail=tail, into=into,
+                   sched=sched)
+
+    try:
+        return proc.wait()
+    except KeyboardInterrupt:
+        logger.debug('Caught SIGINT, terminating subprocess')
+        proc.terminate()
+        raise
+
+
+def acall(cmd, stdin=None, stdout=None, stderr=None, buffer=-1, input=None,
+          timeout=None, deadline=None, grace=GRACE, launcher=None,
+          env=None, cwd=None, spill=None, tail=None, into=None, sched=None):
+    """Start an external command without waiting for it to finish.
+
+    Accepts the same arguments as :func:`call`. The :class:`Result` is
+    obtained from the returned :class:`Process` once it is done.
+
+    >>> procs = [acall(['sleep', '1']) for _ in xrange(10)]
+    >>> results = [p.wait() for p in procs]
+
+    :returns: the running child
+    :rtype: :class:`Process`
+    :raises: :class:`ArgumentsError`
+             if the arguments are malformed (see :func:`check_cmd`)
+    """
+    return Process(cmd, stdin=stdin, stdout=stdout, stderr=stderr,
+                   buffer=buffer, input=input, timeout=timeout,
+                   deadline=deadline, grace=grace, launcher=launcher,
+                   env=env, cwd=cwd, spill=spill, tail=tail, into=into,
+                   sched=sched)
+
+
+def run(cmd, capture=None, raises=True, buffer=-1, input=None,
+        timeout=None, deadline=None, grace=GRACE, cache=None, inputs=(),
+        launcher=None, env=None, cwd=None, spill=None, tail=None,
+        into=None, coalesce=False, sched=None):
+    """Wrapper over :func:`call` with a simpler interface
+
+    **Capture Options**
+
+
+    - `stdout`: capture the standard output
+    - `stderr`: capture the standard error
+    - `both`: capture both stdout and stderr
+    - `silent`: hide all output of the child process
+
+    Given a :class:`Cache`, a successful result is stored and returned
+    by later runs of the same command with the same `capture`, `input`,
+    `env`, `cwd`, and (unmodified) `inputs` without starting a process.
+    Relative `inputs` are found in `cwd`.
+
+    The memory used for captured output can be bounded: past `spill`
+    bytes the output is kept in a temporary file instead, and with
+    `tail` only the end of stderr is kept for error messages. Binary
+    output can be read straight into a buffer given as `into`.
+
+    >>> res = run(['make'], capture='both', spill=1024 ** 2, tail=4096)
+    >>> frame = bytearray(640 * 480 * 3)
+    >>> view = run(['grab-frame'], capture='stdout', into=frame).out
+
+    With `coalesce` set, a command that is already running with the
+    same arguments and options (apart from `buffer` and `cache`) is not
+    started again: the caller waits for the running one and gets the
+    same :class:`Result` (or exception). Given a number of seconds
+    instead of ``True``, the result is also reused for that long.
+
+    >>> gpus = run(['nvidia-smi', '-L'], capture='stdout', coalesce=5)
+
+    :param list of str cmd: the command to call (as in :func:`call`)
+    :param str capture: capture options
+    :param bool raises: raise an exception on non-zero return of child
+    :param int buffer: buffer size (as in :class:`subprocess.Popen`)
+    :param input: input value (as in :func:`call`)
+    :param float timeout: time limit in seconds (as in :func:`call`)
+    :param float deadline: time limit as :func:`time.time` (as in :func:`call`)
+    :param float grace: time to terminate (as in :func:`call`)
+    :param cache: where to look up and store the result
+    :type cache: :class:`Cache`
+    :param inputs: paths of files read by the command
+    :type inputs: :class:`list` of :class:`str`
+    :param str launcher: how to start the child (as in :func:`call`)
+    :param dict env: the environment of the child (as in :func:`call`)
+    :param str cwd: the working directory of the child
+    :param int spill: bytes of output to keep in memory (as in :func:`call`)
+    :param int tail: bytes of stderr to keep (as in :func:`call`)
+    :param into: buffer to read stdout into (as in :func:`call`)
+    :param coalesce: share the result with identical running commands
+    :type coalesce: :class:`bool` or :class:`float` seconds
+    :param sched: how to schedule the child (as in :func:`call`)
+    :type sched: :class:`Sched`
+    :returns: the result
+    :rtype: :class:`Result`
+    """
+    kws = _capture_keywords(capture)
+
+    def _run():
+        try:
+            return call(cmd, buffer=buffer, input=input, timeout=timeout,
+                        deadline=deadline, grace=grace, launcher=launcher,
+                        env=env, cwd=cwd, spill=spill, tail=tail,
+                        into=into, sched=sched, **kws)
+        except CalledProcessError, e:
+            if raises:
+                raise
+            else:
+                return _error_result(e)
+
+    if (launcher or LAUNCHER) == 'forkserver':
+        if _forkserver_usable(cmd, input, spill, tail, into, sched):
+            def _run():
+                return _forkserver.run(cmd, capture=capture, raises=raises,
+                                       input=input, timeout=timeout,
+                                       deadline=deadline, grace=grace,
+                                       env=env, cwd=cwd)
+        else:
+            # the reason was logged already
+            launcher = 'auto'
+
+    if coalesce and into is None:
+        check_cmd(cmd)
+        run_once = _run
+
+        def _run():
+            return _coalesced(run_once, coalesce, cmd, capture, raises,
+                              input, env, cwd, timeout=timeout,
+                              deadline=deadline, grace=grace, spill=spill,
+                              tail=tail, sched=sched, launcher=launcher)
+
+    if cache is None:
+        return _run()
+    check_cmd(cmd)
+    return cache.fetch(cmd, _run, capture=capture, input=input, inputs=inputs,
+                       env=env, cwd=cwd)
+
+
+def arun(cmd, capture=None, raises=True, buffer=-1, input=None,
+         timeout=None, deadline=None, grace=GRACE, launcher=None,
+         env=None, cwd=None, spill=None, tail=None, into=None, sched=None):
+    """Like :func:`run`, but without waiting for the command to finish
+
+    :returns: the running child
+    :rtype: :class:`Process`
+    """
+    kws = _capture_keywords(capture)
+    return Process(cmd, buffer=buffer, input=input, raises=raises,
+                   timeout=timeout, deadline=deadline, grace=grace,
+                   launcher=launcher, env=env, cwd=cwd, spill=spill,
+                   tail=tail, into=into, sched=sched, **kws)
+
+
+def _send(sock, message):
+    "Write a length-prefixed pickled `message` to `sock`"
+    data = pickle.dumps(message, 2)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def _recv(sock):
+    """Read a message written by :func:`_send` from `sock`
+
+    :returns: the message or ``None`` if the socket was closed
+    """
+    def exactly(size):
+        chunks = []
+        while size:
+            try:
+                chunk = sock.recv(size)
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    header = exactly(4)
+    if header is None:
+        return None
+    data = exactly(struct.unpack('!I', header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+def _serve(sock):
+    """The main loop of a :class:`ForkServer`
+
+    Commands received on `sock` are started as :class:`Process`\ es
+    and their results are sent back as they finish. All children are
+    driven by a :class:`Reactor` from this single thread: SIGCHLD wakes
+    it up through :func:`signal.set_wakeup_fd` when a child exits.
+    """
+    wake_r, wake_w = os.pipe()
+    for fd in (wake_r, wake_w):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        _set_cloexec(fd)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    procs = dict()
+    reactor = Reactor()
+    serving = [True]
+
+    def drain():
+        try:
+            while os.read(wake_r, _CHUNK):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def receive():
+        message = _recv(sock)
+        if message is None:
+            serving[0] = False
+        else:
+            _serve_request(sock, reactor, procs, message)
+
+    reactor.watch(wake_r, drain)
+    reactor.watch(sock.fileno(), receive)
+    try:
+        while serving[0]:
+            try:
+                reactor.poll()
+            except KeyboardInterrupt:
+                # the children got the SIGINT as well
+                continue
+    finally:
+        reactor.terminate()
+        reactor.close()
+
+
+def _serve_request(sock, reactor, procs, message):
+    "Handle a `message` sent to a :class:`ForkServer`"
+    kind, ident = message[:2]
+    if kind == 'run':
+        cmd, capture, input, timeout, grace, env, cwd = message[2:]
+        try:
+            proc = Process(cmd, input=input, raises=False,
+                           timeout=timeout, grace=grace, env=env, cwd=cwd,
+                           **_capture_keywords(capture))
+        except Exception, e:
+            _send(sock, ('error', ident, e))
+            return
+
+        def on_exit(proc):
+            del procs[ident]
+            _send(sock, ('result', ident, proc._result))
+
+        procs[ident] = proc
+        reactor.add(proc, on_exit=on_exit)
+    elif kind == 'cancel' and ident in procs:
+        procs[ident].terminate()
+
+
+def _set_cloexec(fd):
+    "Keep `fd` from being inherited by children"
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class ForkServer(object):
+    """A small helper process that starts children on behalf of its
+    parent.
+
+    Forking a large process, and running Python code in the copy
+    before exec, gets slower as the process grows. Started early,
+    while the program is still small, the server is unaffected by
+    whatever the parent does later. Commands (along with their input,
+    environment, and working directory) are sent to the server over a
+    local socket, and it sends back the :class:`Result`\ s. The server
+    exits, terminating its children, when the parent goes away.
+
+    >>> server = ForkServer().start()
+    >>> server.run(['echo', 'hello'], capture='stdout').out
+    'hello\\n'
+
+    Any number of threads may use the server at once, and it runs
+    their commands concurrently. See also :func:`start_forkserver` to
+    have :func:`run` use a server.
+    """
+
+    def __init__(self):
+        self.pid = None
+        self._sock = None
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        self._replies = dict()
+        self._reading = False
+        self._cond = threading.Condition()
+
+    def start(self):
+        """Fork the server
+
+        :returns: the server
+        :rtype: :class:`ForkServer`
+        """
+        parent, child = socket.socketpair()
+        # neither the children of the server nor those of the parent
+        # may keep the connection open
+        for end in (parent, child):
+            _set_cloexec(end.fileno())
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                parent.close()
+                _serve(child)
+                status = 0
+            except BaseException:
+                logger.exception('Fork server failed')
+            finally:
+                os._exit(status)
+
+        child.close()
+        self.pid = pid
+        self._sock = parent
+        logger.debug('Started fork server {}'.format(pid))
+        return self
+
+    def stop(self):
+        "Stop the server, terminating any children it is still running"
+        global _forkserver
+        if _forkserver is self:
+            _forkserver = None
+        if self._sock is None:
+            return
+        self._sock.close()
+        self._sock = None
+        _retry(os.waitpid, self.pid, 0)
+        logger.debug('Stopped fork server {}'.format(self.pid))
+
+    def submit(self, cmd, capture=None, input=None, timeout=None,
+               deadline=None, grace=GRACE, env=None, cwd=None):
+        """Ask the server to start a command
+
+        Accepts the same arguments as :func:`run`.
+
+        :returns: an identifier to obtain the result with
+        :rtype: :class:`int`
+        """
+        check_cmd(cmd)
+        if self._sock is None:
+            raise ValueError('The fork server is not running')
+        if deadline is not None:
+            timeout = _deadline(0, timeout, deadline - time.time())
+        ident = next(self._ids)
+        message = ('run', ident, list(cmd), capture, input, timeout, grace,
+                   env, cwd)
+        with self._send_lock:
+            _send(self._sock, message)
+        return ident
+
+    def cancel(self, ident):
+        "Terminate the command started by :meth:`submit`"
+        with self._send_lock:
+            _send(self._sock, ('cancel', ident))
+
+    def _reply(self, ident):
+        with self._cond:
+            while ident not in self._replies:
+                if self._reading:
+                    self._cond.wait()
+                    continue
+
+                # read on behalf of all waiting threads
+                self._reading = True
+                self._cond.release()
+                try:
+                    message = _recv(self._sock)
+                finally:
+                    self._cond.acquire()
+                    self._reading = False
+                    self._cond.notify_all()
+                if message is None:
+                    raise IOError(errno.EPIPE, 'The fork server exited')
+                self._replies[message[1]] = message
+            return self._replies.pop(ident)
+
+    def result(self, ident, raises=True):
+        """Wait for the result of a command started by :meth:`submit`
+
+        :param bool raises: raise an exception on non-zero return of child
+        :rtype: :class:`Result`
+        :raises: :class:`CalledProcessError` if the command fails
+        """
+        kind, _, value = self._reply(ident)
+        if kind == 'error':
+            raise value
+        if isinstance(value, CalledProcessError):
+            if raises:
+                raise value
+            return _error_result(value)
+        return value
+
+    def run(self, cmd, capture=None, raises=True, input=None, timeout=None,
+            deadline=None, grace=GRACE, env=None, cwd=None):
+        """Run a command in the server
+
+        Accepts the same arguments as :func:`run`.
+
+        :rtype: :class:`Result`
+        """
+        ident = self.submit(cmd, capture=capture, input=input,
+                            timeout=timeout, deadline=deadline, grace=grace,
+                            env=env, cwd=cwd)
+        try:
+            return self.result(ident, raises=raises)
+        except KeyboardInterrupt:
+            logger.debug('Caught SIGINT, terminating subprocess')
+            self.cancel(ident)
+            raise
+
+
+_forkserver = None
+
+
+def _forkserver_usable(cmd, input, spill, tail, into, sched):
+    """Whether :func:`run` can send a command to the fork server,
+    logging why not
+    """
+    if _forkserver is None:
+        reason = 'it was not started'
+    elif not (input is None or isinstance(input, basestring)):
+        reason = 'the input is streamed'
+    elif spill is not None or tail is not None or into is not None:
+        reason = 'the output is spilled or read into a buffer'
+    elif sched is not None:
+        reason = 'the child is scheduled'
+    else:
+        return True
+    logger.info('Not using the fork server for {}: {}'.format(cmd, reason))
+    return False
+
+
+def start_forkserver():
+    """Start the :class:`ForkServer` used by :func:`run` when the
+    launcher is `forkserver`
+
+    Call this early, while the program is still small.
+
+    >>> start_forkserver()
+    >>> LAUNCHER = 'forkserver'
+
+    :rtype: :class:`ForkServer`
+    """
+    global _forkserver
+    if _forkserver is None:
+        _forkserver = ForkServer().start()
+    return _forkserver
+
+
+def stream(cmd, stdin=None, stderr=None, buffer=-1, chunk=None):
+    """Iterate over the standard output of a command while it runs
+
+    Output is generated line by line or, if `chunk` is given, in
+    pieces of at most `chunk` bytes as soon as they are written by the
+    child. Nothing but the current line or chunk is kept in memory.
+
+    Passing :data:`PIPE` as `stderr` collects the standard error in a
+    temporary file so that it can be reported if the command fails.
+
+    >>> for line in stream(['seq', '3']):
+    ...   print line.strip()
+    1
+    2
+    3
+
+    :param cmd: the command to run (as in :func:`call`)
+    :param stdin: where to read stdin from
+    :param stderr: where to write stderr to
+    :param int buffer: buffer size (as in :class:`subprocess.Popen`)
+    :param int chunk: generate chunks of this size instead of lines
+    :returns: the output of the child
+    :rtype: *generator* of :class:`str`
+    :raises: :class:`ArgumentsError`
+             if the arguments are malformed (see :func:`check_cmd`)
+    :raises: :class:`CalledProcessError` once the output is exhausted
+             if the subprocess fails
+    """
+    spool = tempfile.TemporaryFile() if stderr is PIPE else None
+    proc, pretty = _popen(cmd, stdin=stdin, stdout=PIPE,
+                          stderr=spool or stderr, buffer=buffer)
+    return _stream(proc, pretty, spool, chunk)
+
+
+def _stream(proc, pretty, spool, chunk):
+    """Implementation of :func:`stream`"""
+    try:
+        if chunk is None:
+            for line in iter(proc.stdout.readline, ''):
+                yield line
+        else:
+            fd = proc.stdout.fileno()
+            for data in iter(lambda: os.read(fd, chunk), ''):
+                yield data
+        proc.wait()
+    except KeyboardInterrupt:
+        logger.debug('Caught SIGINT, terminating subprocess')
+        raise
+    finally:
+        # abandoned early or interrupted
+        if proc.returncode is None:
+            _terminate(proc)
+            proc.wait()
+        proc.stdout.close()
+
+    logger.debug('Subprocess finished with {}'.format(proc.returncode))
+    if proc.returncode is not 0:
+        err = None
+        if spool is not None:
+            spool.seek(0)
+            err = spool.read()
+            spool.close()
+        raise CalledProcessError(pretty, proc.returncode, stderr=err)
+
+    if spool is not None:
+        spool.close()
+
+
+class Decision(collections.namedtuple('Decision', [
+        'time', 'load', 'free', 'rss', 'running', 'jobs', 'action'])):
+    """A decision made by a :class:`Governor`
+
+    - `time`: when it was made, as :func:`time.time`
+    - `load`: the one minute load average
+    - `free`: bytes of memory available
+    - `rss`: bytes of memory used by the running children
+    - `running`: the number of running children
+    - `jobs`: the number of children allowed from now on
+    - `action`: one of `grow`, `shrink`, or `hold`
+    """
+
+    __slots__ = ()
+
+
+class Governor(object):
+    """Adapt the number of concurrent commands to the machine
+
+    Given as `jobs` to :func:`run_many` (or :class:`Scheduler`), the
+    governor is asked every `interval` seconds how many commands may
+    run. It allows one more if all allowed commands are running, the
+    load average is below `max_load`, and starting another command of
+    the average size so far leaves `min_free` bytes of memory. If the
+    load or free memory are past their targets, it allows one fewer
+    than are running. Running commands are never stopped. As the load
+    average follows the number of runnable processes slowly, the
+    `interval` should not be too short.
+
+    The state of the machine and every decision are kept in `history`
+    to help choose the targets.
+
+    >>> governor = Governor(max_load=16, min_free=4 * 1024 ** 3)
+    >>> results = list(run_many(cmds, jobs=governor))
+    >>> for decision in governor.history:
+    ...   print decision.load, decision.free, decision.jobs
+
+    :param int jobs: the number of commands allowed at first
+                     (defaults to the number of CPUs)
+    :param int min_jobs: never allow fewer commands
+    :param int max_jobs: never allow more commands
+                         (defaults to four times the number of CPUs)
+    :param float max_load: the highest load average to grow at
+                           (defaults to the number of CPUs)
+    :param int min_free: bytes of memory to keep available (defaults
+                         to a tenth of the memory of the machine)
+    :param float interval: seconds between decisions
+    :param int keep: the number of decisions to keep
+    """
+
+    def __init__(self, jobs=None, min_jobs=1, max_jobs=None, max_load=None,
+                 min_free=None, interval=1.0, keep=1000):
+        cpus = multiprocessing.cpu_count()
+        self.min_jobs = min_jobs
+        self.max_jobs = max_jobs or 4 * cpus
+        if not 1 <= self.min_jobs <= self.max_jobs:
+            raise ValueError('Need 1 <= min_jobs <= max_jobs, got {} and {}'
+                             .format(self.min_jobs, self.max_jobs))
+        self.max_load = max_load if max_load is not None else cpus
+        if min_free is None:
+            total = self._meminfo().get('MemTotal')
+            min_free = total // 10 if total is not None else 0
+        self.min_free = min_free
+        self.interval = interval
+        self.jobs = max(self.min_jobs, min(jobs or cpus, self.max_jobs))
+        self.history = collections.deque(maxlen=keep)
+        self._checked = None
+
+    def _meminfo(self):
+        "The fields of ``/proc/meminfo`` in bytes"
+        info = dict()
+        try:
+            with open('/proc/meminfo') as fd:
+                for line in fd:
+                    fields = line.split()
+                    if len(fields) >= 2 and fields[1].isdigit():
+                        scale = 1024 if fields[2:] == ['kB'] else 1
+                        info[fields[0].rstrip(':')] = int(fields[1]) * scale
+        except IOError:
+            pass
+        return info
+
+    def load(self):
+        "The one minute load average"
+        try:
+            with open('/proc/loadavg') as fd:
+                return float(fd.read().split()[0])
+        except (IOError, ValueError, IndexError):
+            return os.getloadavg()[0]
+
+    def free(self):
+        "Bytes of memory available without swapping, if known"
+        info = self._meminfo()
+        if 'MemAvailable' in info:
+            return info['MemAvailable']
+        if 'MemFree' in info:
+            return info['MemFree'] + info.get('Cached', 0)
+        return None
+
+    def rss(self, pids):
+        "Bytes of memory used by the processes `pids`"
+        total = 0
+        page = resource.getpagesize()
+        for pid in pids:
+            try:
+                with open('/proc/{}/statm'.format(pid)) as fd:
+                    total += int(fd.read().split()[1]) * page
+            except (IOError, ValueError, IndexError):
+                # exited in the meantime
+                pass
+        return total
+
+    def update(self, procs):
+        """Decide how many commands may run
+
+        :param procs: the running commands
+        :type procs: :class:`list` of :class:`Process`
+        :returns: the number of commands allowed
+        :rtype: :class:`int`
+        """
+        now = time.time()
+        if self._checked is not None and now - self._checked < self.interval:
+            return self.jobs
+        self._checked = now
+
+        running = len(procs)
+        load, free = self.load(), self.free()
+        rss = self.rss([proc.pid for proc in procs])
+        size = rss // running if running else 0
+        low_memory = free is not None and free < self.min_free
+
+        action = 'hold'
+        if load > self.max_load or low_memory:
+            jobs = max(self.min_jobs, min(self.jobs, running) - 1)
+            if jobs < self.jobs:
+                action = 'shrink'
+        elif running >= self.jobs and self.jobs < self.max_jobs \
+                and load + 1 <= self.max_load \
+                and (free is None or free - size >= self.min_free):
+            jobs = self.jobs + 1
+            action = 'grow'
+        if action != 'hold':
+            logger.debug('Governor: {} to {} jobs (load {}, free {})'
+                         .format(action, jobs, load, free))
+            self.jobs = jobs
+
+        self.history.append(Decision(time=now, load=load, free=free, rss=rss,
+                                     running=running, jobs=self.jobs,
+                                     action=action))
+        return self.jobs
+
+
+class Journal(object):
+    """Record which commands of a batch have finished, so that the
+    batch can be resumed after a crash.
+
+    The key of each command, its return code, and optionally a digest
+    of its stdout are appended to the file at `path`, one line per
+    command. The file is flushed to disk (with :func:`os.fsync`) every
+    `sync_every` commands or `sync_interval` seconds, and when the
+    journal is closed. At worst the commands finished since the last
+    sync are run again.
+
+    >>> with Journal('batch.journal') as journal:
+    ...   for res in run_many(cmds, journal=journal):
+    ...     handle(res)
+
+    When the batch is run again with the same journal, commands that
+    succeeded are not started again and generate a
+    :class:`JournaledResult` instead.
+
+    :param str path: the journal file
+    :param bool digest: record the SHA-1 digest of stdout
+    :param int sync_every: the number of commands between syncs
+    :param float sync_interval: the number of seconds between syncs
+    """
+
+    def __init__(self, path, digest=False, sync_every=64, sync_interval=1.0):
+        self.path = path
+        self.digest = digest
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._entries, complete = self._load()
+        self._file = open(path, 'a')
+        if os.fstat(self._file.fileno()).st_size > complete:
+            # drop the torn last line of a crash, or the next record
+            # would be appended to it
+            os.ftruncate(self._file.fileno(), complete)
+        self._unsynced = 0
+        self._synced_at = time.time()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _load(self):
+        """Read the recorded commands
+
+        :returns: the entries and the size of the complete lines
+        """
+        entries = dict()
+        complete = 0
+        try:
+            with open(self.path) as fd:
+                for line in fd:
+                    # the last line may be incomplete after a crash
+                    if not line.endswith('\n'):
+                        break
+                    complete += len(line)
+                    fields = line.split()
+                    if len(fields) != 3:
+                        continue
+                    key, ret, digest = fields
+                    try:
+                        ret = int(ret) if ret != '-' else None
+                    except ValueError:
+                        continue
+                    entries[key] = (ret, digest if digest != '-' else None)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        return entries, complete
+
+    def key(self, cmd):
+        """Identify a command
+
+        :rtype: :class:`str`
+        """
+        return hashlib.sha1('\0'.join(cmd)).hexdigest()
+
+    def succeeded(self, cmd):
+        """Look up a command that succeeded before
+
+        :returns: the recorded result or ``None``
+        :rtype: :class:`JournaledResult`
+        """
+        entry = self._entries.get(self.key(cmd))
+        if entry is None or entry[0] != 0:
+            return None
+        return JournaledResult(ret=0, digest=entry[1])
+
+    def record(self, cmd, result):
+        """Record a finished command
+
+        :param result: what the command returned
+        :type result: :class:`Result` or :class:`CalledProcessError`
+        """
+        if isinstance(result, CalledProcessError):
+            ret, out = result.retcode, result.stdout
+        else:
+            ret, out = result.ret, result.out
+        digest = None
+        if self.digest and out is not None:
+            if isinstance(out, Spooled):
+                out = out.mmap
+            digest = hashlib.sha1(out).hexdigest()
+
+        key = self.key(cmd)
+        with self._lock:
+            self._entries[key] = (ret, digest)
+            self._file.write('{} {} {}\n'.format(
+                key, '-' if ret is None else ret, digest or '-'))
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every \
+               or time.time() - self._synced_at >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.time()
+
+    def sync(self):
+        "Flush the recorded commands to disk"
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        "Flush the recorded commands to disk and close the file"
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync()
+            self._file.close()
+
+
+def _job_limit(jobs, reactor):
+    """The number of commands that may run, and the number of seconds
+    before asking again (if it may change)
+    """
+    if isinstance(jobs, Governor):
+        return jobs.update(reactor.processes()), jobs.interval
+    return jobs, None
+
+
+class _Batch(object):
+    """Implementation of :func:`run_many`
+
+    Commands are started as long as fewer than `jobs` are running, and
+    all of them are driven by a :class:`Reactor` in the thread of the
+    consumer. The running children are terminated if the batch is
+    abandoned.
+    """
+
+    def __init__(self, cmds, jobs, capture, buffer, ordered,
+                 timeout, deadline, grace, sched=None, pin=False,
+                 journal=None):
+        self._todo = collections.deque()
+        self._done = collections.deque()
+        self._journal = journal
+        for index, cmd in enumerate(cmds):
+            check_cmd(cmd)
+            result = journal.succeeded(cmd) if journal is not None else None
+            if result is not None:
+                self._done.append((index, result))
+            else:
+                self._todo.append((index, cmd))
+
+        self._jobs = jobs
+        self._kws = _capture_keywords(capture)
+        self._buffer = buffer
+        self._ordered = ordered
+        self._limits = dict(timeout=timeout, deadline=deadline, grace=grace)
+        self._sched = sched
+        self._load = None
+        if pin:
+            self._sched = sched or Sched()
+            cpus = self._sched.cpus or xrange(multiprocessing.cpu_count())
+            self._load = dict((cpu, 0) for cpu in cpus)
+        self._reactor = None
+
+    def _start(self, index, cmd):
+        deadline = self._limits['deadline']
+        if deadline is not None and time.time() >= deadline:
+            # never started, so there is no return code
+            error = TimeoutExpired(' '.join(map(pipes.quote, cmd)), None, 0)
+            self._done.append((index, (TimeoutExpired, error, None)))
+            return
+
+        sched, cpu = self._sched, None
+        if self._load is not None:
+            # the least busy CPU, there may be more jobs than CPUs
+            cpu = min(self._load, key=lambda c: (self._load[c], c))
+            sched = sched._replace(cpus=(cpu,))
+
+        try:
+            proc = Process(cmd, buffer=self._buffer, sched=sched,
+                           **dict(self._kws, **self._limits))
+        except Exception:
+            self._done.append((index, sys.exc_info()))
+            return
+
+        if cpu is not None:
+            self._load[cpu] += 1
+        self._reactor.add(proc, on_exit=functools.partial(self._finished,
+                                                          index, cmd, cpu))
+
+    def _finished(self, index, cmd, cpu, proc):
+        if cpu is not None:
+            self._load[cpu] -= 1
+        try:
+            outcome = proc.result()
+            if self._journal is not None:
+                self._journal.record(cmd, outcome)
+        except CalledProcessError, e:
+            if self._journal is not None:
+                self._journal.record(cmd, e)
+            outcome = sys.exc_info()
+        except Exception:
+            outcome = sys.exc_info()
+        self._done.append((index, outcome))
+
+    def __iter__(self):
+        self._reactor = Reactor()
+        pending = dict()
+        next_index = 0
+        try:
+            while self._todo or self._reactor or self._done:
+                limit, interval = _job_limit(self._jobs, self._reactor)
+                while self._todo and len(self._reactor) < limit:
+                    self._start(*self._todo.popleft())
+                if not self._done:
+                    self._reactor.poll(interval)
+
+                while self._done:
+                    index, outcome = self._done.popleft()
+                    if self._ordered:
+                        pending[index] = outcome
+                        while next_index in pending:
+                            yield pending.pop(next_index)
+                            next_index += 1
+                    else:
+                        yield outcome
+        except KeyboardInterrupt:
+            logger.debug('Caught SIGINT, terminating subprocesses')
+            raise
+        finally:
+            if self._reactor:
+                logger.debug('Terminating {} subprocesses'
+                             .format(len(self._reactor)))
+            self._reactor.terminate()
+            self._reactor.close()
+
+
+def run_many(cmds, jobs=None, capture=None, raises=True, buffer=-1,
+             ordered=True, timeout=None, deadline=None, grace=GRACE,
+             sched=None, pin=False, journal=None):
+    """Run many commands with at most `jobs` of them at the same time
+
+    Results are generated as the commands finish, either in the order
+    of `cmds` or, if `ordered` is ``False``, in the order in which
+    they complete. If `raises` is set the first failing command raises
+    :class:`CalledProcessError`, otherwise its :class:`Result` is
+    generated like any other. Stopping the iteration early (or
+    CTRL-C) terminates all the commands that are still running.
+
+    Each command may run for at most `timeout` seconds, and the batch
+    as a whole has to finish by the `deadline`. Commands that have not
+    started by the deadline fail with :class:`TimeoutExpired` without
+    being run.
+
+    All commands are scheduled with `sched`. If `pin` is set each one
+    is also restricted to a single CPU (of those in `sched`, or of the
+    machine), using the CPU running the fewest commands of the batch.
+
+    Given a :class:`Journal`, every finished command is recorded, and
+    those recorded as successful are not run again. Their results are
+    :class:`JournaledResult`\ s.
+
+    >>> cmds = [['echo', str(i)] for i in xrange(100)]
+    >>> for res in run_many(cmds, jobs=4, capture='stdout'):
+    ...   print res.out.strip()
+
+    :param cmds: the commands to run (as in :func:`call`)
+    :type cmds: *iterable* of :class:`list` of :class:`str`
+    :param jobs: the maximum number of concurrent commands
+                 (defaults to the number of CPUs)
+    :type jobs: :class:`int` or :class:`Governor`
+    :param str capture: capture options (as in :func:`run`)
+    :param bool raises: raise an exception on non-zero return of child
+    :param int buffer: buffer size (as in :class:`subprocess.Popen`)
+    :param bool ordered: generate results in the order of `cmds`
+    :param float timeout: time limit in seconds for each command
+    :param float deadline: time limit as :func:`time.time` for all commands
+    :param float grace: time to terminate (as in :func:`call`)
+    :param sched: how to schedule the commands (as in :func:`call`)
+    :type sched: :class:`Sched`
+    :param bool pin: pin each command to one CPU
+    :param journal: where to record finished commands
+    :type journal: :class:`Journal`
+    :returns: the results of each command
+    :rtype: *generator* of :class:`Result`
+    :raises: :class:`ArgumentsError` if any command is malformed
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    if not isinstance(jobs, Governor) and jobs < 1:
+        raise ValueError('Need at least one job, got {}'.format(jobs))
+
+    batch = _Batch(cmds, jobs, capture, buffer, ordered,
+                   timeout, deadline, grace, sched=sched, pin=pin,
+                   journal=journal)
+    return _results(iter(batch), raises)
+
+
+def _results(outcomes, raises):
+    """Convert the outcomes of a batch into :class:`Result` values
+
+    Each outcome is either a :class:`Result` or the
+    :func:`sys.exc_info` of the exception raised when running the
+    command. Any commands still running are stopped when this
+    generator is finished.
+    """
+    try:
+        for outcome in outcomes:
+            if isinstance(outcome, Result):
+                yield outcome
+                continue
+
+            etype, error, tb = outcome
+            if isinstance(error, CalledProcessError) and not raises:
+                yield _error_result(error)
+            else:
+                raise etype, error, tb
+    finally:
+        outcomes.close()
+
+
+def _capture_keywords(capture):
+    """Generate the keywords to capture the output of a subprocess
+
+    :param capture: one of {stdout | stderr | both}
+    :returns: the keyword arguments
+    :rtype: :class:`dict`
+    """
+    kws = {}
+    if capture == 'stdout' or capture == 'both':
+        kws['stdout'] = PIPE
+
+    if capture == 'stderr' or capture == 'both':
+        kws['stderr'] = PIPE
+
+    if capture == 'silent':
+        kws['stdout'] = DEVNULL
+        kws['stderr'] = DEVNULL
+
+    return kws
+
+
+def _fingerprint(path, hash=False):
+    """Identify the state of the file at `path`: its size and
+    modification time or, if `hash` is set, a digest of its contents
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (path, None)
+    if not hash:
+        return (path, stat.st_size, stat.st_mtime)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(_CHUNK), ''):
+            digest.update(block)
+    return (path, digest.hexdigest())
+
+
+def _entry_path(root, key):
+    "Where the entry for the hex digest `key` is kept below `root`"
+    return os.path.join(root, key[:2], key)
+
+
+def _write_entry(path, data):
+    """Replace the file at `path` with `data` atomically, creating its
+    directory if needed
+    """
+    root = os.path.dirname(path)
+    if not os.path.isdir(root):
+        try:
+            os.makedirs(root)
+        except OSError:
+            if not os.path.isdir(root):
+                raise
+    fd, tmp = tempfile.mkstemp(dir=root)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    os.rename(tmp, path)
+
+
+# how full a Cache is after evicting, as a fraction of its limits
+_LOW_WATER = 0.9
+
+
+class Cache(object):
+    """Store the results of deterministic commands on disk.
+
+    A result is identified by the command, what is captured of it,
+    its input, environment, and working directory, and the
+    fingerprints of the files it reads. These are
+    either the size and modification time of each file, or, if `hash`
+    is set, a digest of their contents. Only successful results are
+    stored, and not those whose output was spilled to disk or read
+    into a buffer.
+
+    When the store grows beyond `max_size` bytes or `max_entries`
+    results, the least recently used ones are removed until it is
+    back to 90% of the limits, so that the store is not scanned again
+    on each of the following results.
+
+    >>> cache = Cache('/tmp/results')
+    >>> run(['md5sum', 'big.dat'], capture='stdout',
+    ...     cache=cache, inputs=['big.dat'])
+
+    :param str path: the directory of the store
+    :param int max_size: the maximum size of the store in bytes
+    :param int max_entries: the maximum number of results to keep
+    :param bool hash: fingerprint input files by their contents
+    """
+
+    def __init__(self, path=None, max_size=256 * 1024 * 1024,
+                 max_entries=None, hash=False):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.cache', 'pxul')
+        self.path = path
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.hash = hash
+        self._size = None
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def key(self, cmd, capture=None, input=None, inputs=(), env=None,
+            cwd=None):
+        """Identify the result of a command
+
+        Relative `inputs` are found in `cwd`. An inherited environment
+        (`env` of ``None``) is not part of the key.
+
+        :returns: a hex digest
+        :rtype: :class:`str`
+        """
+        cwd = os.path.abspath(cwd if cwd is not None else os.getcwd())
+        fingerprints = [_fingerprint(os.path.join(cwd, path), self.hash)
+                        for path in inputs]
+        env = sorted(env.iteritems()) if env is not None else None
+        ident = (list(cmd), capture, input, fingerprints, env, cwd)
+        return hashlib.sha1(pickle.dumps(ident, 2)).hexdigest()
+
+    def get(self, key):
+        """Look up a stored result
+
+        :returns: the result or ``None`` if not present
+        :rtype: :class:`Result`
+        """
+        path = _entry_path(self.path, key)
+        try:
+            with open(path, 'rb') as fd:
+                out, err, ret = pickle.load(fd)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, ValueError, pickle.PickleError):
+            return None
+        logger.debug('Cache hit {}'.format(key))
+        return Result(out=out, err=err, ret=ret)
+
+    def put(self, key, result):
+        "Store a result, evicting old ones as needed"
+        data = pickle.dumps(tuple(result), 2)
+        _write_entry(_entry_path(self.path, key), data)
+
+        with self._lock:
+            if self._size is None:
+                self._scan()
+            else:
+                self._size += len(data)
+                self._entries += 1
+            if self._full():
+                self._evict()
+
+    def _full(self, fraction=1):
+        "Whether the store is beyond the `fraction` of its limits"
+        return (self.max_size is not None
+                and self._size > self.max_size * fraction) \
+            or (self.max_entries is not None
+                and self._entries > self.max_entries * fraction)
+
+    def _stats(self):
+        for dirpath, _, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    pass
+
+    def _scan(self):
+        stats = list(self._stats())
+        self._size = sum(stat.st_size for _, stat in stats)
+        self._entries = len(stats)
+        return stats
+
+    def _evict(self):
+        stats = self._scan()
+        stats.sort(key=lambda (_, stat): stat.st_mtime)
+        for path, stat in stats:
+            if not self._full(_LOW_WATER):
+                break
+            logger.debug('Evicting {}'.format(path))
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self._size -= stat.st_size
+            self._entries -= 1
+
+    def fetch(self, cmd, compute, capture=None, input=None, inputs=(),
+              env=None, cwd=None):
+        """Get the result of a command, computing it if needed
+
+        :param compute: run the command if not stored
+        :type compute: :func:`callable` returning :class:`Result`
+        :rtype: :class:`Result`
+        """
+        if not (input is None or isinstance(input, basestring)):
+            # streamed input cannot be identified without consuming it
+            return compute()
+        key = self.key(cmd, capture=capture, input=input, inputs=inputs,
+                       env=env, cwd=cwd)
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            stored = isinstance(result.out, (basestring, types.NoneType)) \
+                and isinstance(result.err, (basestring, types.NoneType))
+            if result.ret == 0 and stored:
+                self.put(key, result)
+        return result
+
+    def clear(self):
+        "Remove all stored results"
+        with self._lock:
+            for path, _ in self._stats():
+                os.unlink(path)
+            self._size = 0
+            self._entries = 0
+
+
+class Builder(object):
+    """Utility for building commands which can be called with more
+    specific arguments later.
+
+    Instances of :class:`Builder` are :func:`callable`. This is the
+    intended usage when invoking a :class:`Builder` to call the
+    subprocess.
+
+    >>> echo = Builder(['echo', 'hello', capture='stdout')
+    >>> print echo()[0].strip()
+    hello
+    >>> print echo('world')[0].strip()
+    hello world
+    >>> print echo('universe')[0].strip()
+    hello universe
+
+    Keyword arguments when calling are passed on to :func:`call`. A
+    `timeout` given to the :class:`Builder` applies to every call that
+    does not specify its own.
+
+    Given a :class:`Cache`, results are reused as in :func:`run`. The
+    files read by a call are then passed as the `inputs` keyword.
+    Identical calls made at the same time share their result if
+    `coalesce` is set (as in :func:`run`). Like the `timeout`, `sched`
+    applies to every call that does not specify its own.
+    """
+
+    def __init__(self, cmd, capture=None, timeout=None, cache=None,
+                 coalesce=False, sched=None):
+        check_cmd(cmd)
+        self.cmd = cmd
+        self.capture = capture
+        self.timeout = timeout
+        self.cache = cache
+        self.coalesce = coalesce
+        self.sched = sched
+
+    def add_args(self, args):
+        check_cmd(args)
+        self.cmd.extend(args)
+
+    def __or__(self, other):
+        return Pipeline([self]) | other
+
+    def __call__(self, *args, **call_kws):
+        check_cmd(args)
+        cmd = list(self.cmd) + list(args)
+
+        inputs = call_kws.pop('inputs', ())
+        kws = _capture_keywords(self.capture)
+        call_kws.update(kws)
+        call_kws.setdefault('timeout', self.timeout)
+        call_kws.setdefault('sched', self.sched)
+
+        def _call():
+            coalesce = self.coalesce and 'into' not in call_kws
+            options = dict((name, value) for name, value in call_kws.items()
+                           if name not in ('input', 'env', 'cwd'))
+            return _coalesced(lambda: call(cmd, **call_kws), coalesce,
+                              cmd, self.capture, True, call_kws.get('input'),
+                              call_kws.get('env'), call_kws.get('cwd'),
+                              **options)
+
+        if self.cache is None:
+            return _call()
+        return self.cache.fetch(cmd, _call, capture=self.capture,
+                                input=call_kws.get('input'), inputs=inputs,
+                                env=call_kws.get('env'),
+                                cwd=call_kws.get('cwd'))
+
+    def acall(self, *args, **call_kws):
+        """Like calling the :class:`Builder`, but without waiting for the
+        command to finish (see :func:`acall`)
+
+        :rtype: :class:`Process`
+        """
+        check_cmd(args)
+        cmd = list(self.cmd) + list(args)
+
+        kws = _capture_keywords(self.capture)
+        call_kws.update(kws)
+        call_kws.setdefault('timeout', self.timeout)
+        call_kws.setdefault('sched', self.sched)
+        return acall(cmd, **call_kws)
+
+    def _batches(self, args, max_args):
+        "Pack `args` into lists that fit into the argument space"
+        limit = _arg_space() - sum(_arg_size(a) for a in self.cmd)
+        batch, size = [], 0
+        for arg in args:
+            cost = _arg_size(arg)
+            if cost > limit:
+                raise ArgumentsError('Argument too long: {}...'
+                                     .format(arg[:64]))
+            if batch and (size + cost > limit
+                          or (max_args and len(batch) >= max_args)):
+                yield batch
+                batch, size = [], 0
+            batch.append(arg)
+            size += cost
+        if batch:
+            yield batch
+
+    def map_args(self, args, max_args=None, jobs=1, merge=False,
+                 raises=True, pin=False):
+        """Call the command over many arguments, like ``xargs``.
+
+        The arguments are packed into as few calls as fit within the
+        system limit on the size of the arguments and environment of
+        a process (``ARG_MAX``), with at most `max_args` each. The
+        calls can run concurrently as with :func:`run_many`.
+
+        >>> md5sum = Builder(['md5sum'], capture='stdout')
+        >>> out = md5sum.map_args(paths, jobs=4, merge=True).out
+
+        :param args: the arguments
+        :type args: *iterable* of :class:`str`
+        :param int max_args: the maximum number of arguments per call
+        :param int jobs: the maximum number of concurrent calls
+        :param bool merge: combine the results into one
+        :param bool raises: raise an exception on non-zero return of a call
+        :param bool pin: pin each call to one CPU (as in :func:`run_many`)
+        :returns: the result of each call in order or, if `merge` is
+                  set, the concatenated output and the first non-zero
+                  return code of all calls
+        :rtype: :class:`list` of :class:`Result` or :class:`Result`
+        :raises: :class:`ArgumentsError` if an argument alone exceeds
+                 the limit
+        """
+        check_cmd(args)
+        cmds = [self.cmd + batch for batch in self._batches(args, max_args)]
+        results = list(run_many(cmds, jobs=jobs, capture=self.capture,
+                                raises=raises, timeout=self.timeout,
+                                sched=self.sched, pin=pin))
+        if not merge:
+            return results
+
+        def join(values):
+            values = [v for v in values if v is not None]
+            return ''.join(values) if values else None
+
+        rets = [r.ret for r in results if r.ret != 0]
+        return Result(out=join(r.out for r in results),
+                      err=join(r.err for r in results),
+                      ret=rets[0] if rets else 0)
+
+
+def _arg_size(arg):
+    "The space taken by `arg` in the arguments of a new process"
+    return len(arg) + 1 + struct.calcsize('P')
+
+
+def _arg_space():
+    """The space left for arguments when starting a process
+
+    This is the system limit (``ARG_MAX``), less the current
+    environment and some headroom, as in ``xargs``.
+    """
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        arg_max = 128 * 1024  # the POSIX minimum is 4096, Linux used this
+    env = sum(_arg_size(k + '=' + v) for k, v in os.environ.iteritems())
+    return arg_max - env - 2048
+
+
+class Pipeline(object):
+    """Commands whose standard output is connected to the standard
+    input of the next command by OS pipes, like a shell pipeline.
+
+    Instances are created by combining :class:`Builder`\ s with
+    ``|``. The data flowing between the stages never passes through
+    Python. The `capture` of the last stage determines what is
+    captured of the final output, while the stderr of any stage can
+    be captured.
+
+    >>> sort = Builder(['sort'])
+    >>> uniq = Builder(['uniq', '-c'], capture='stdout')
+    >>> print (sort | uniq)(input='b\\na\\nb\\n').out
+          1 a
+          2 b
+
+    The return code of every stage is available from the `rets` of
+    the :class:`PipelineResult`. Like the ``pipefail`` shell option,
+    the return code of the pipeline is that of the last failing stage.
+    As in a shell, a stage is killed by SIGPIPE when the next one
+    stops reading, as ``head`` does, which is not a failure.
+    """
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+    def __or__(self, other):
+        if isinstance(other, Builder):
+            other = [other]
+        elif isinstance(other, Pipeline):
+            other = other.stages
+        else:
+            return NotImplemented
+        return Pipeline(self.stages + list(other))
+
+    def __str__(self):
+        return ' | '.join(' '.join(map(pipes.quote, stage.cmd))
+                          for stage in self.stages)
+
+    def _spawn(self, input):
+        procs = []
+        stdin = None
+        try:
+            for i, stage in enumerate(self.stages):
+                last = i == len(self.stages) - 1
+                kws = _capture_keywords(stage.capture)
+                if not last:
+                    read, write = os.pipe()
+                    for fd in (read, write):
+                        # otherwise later stages inherit the pipe and
+                        # the readers never see end-of-file
+                        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+                    kws['stdout'] = write
+
+                try:
+                    procs.append(Process(stage.cmd, stdin=stdin,
+                                         input=input if i == 0 else None,
+                                         raises=False, sched=_StageSched(),
+                                         **kws))
+                finally:
+                    if stdin is not None:
+                        os.close(stdin)
+                        stdin = None
+                    if not last:
+                        os.close(write)
+                        stdin = read
+        except:
+            if stdin is not None:
+                os.close(stdin)
+            for proc in procs:
+                proc.terminate()
+            raise
+
+        return procs
+
+    def __call__(self, input=None):
+        """Run the pipeline
+
+        :param input: input to pass to the stdin of the first stage
+                      (as in :func:`call`)
+        :returns: the captured output and the return codes
+        :rtype: :class:`PipelineResult`
+        :raises: :class:`CalledProcessError` for the last stage that fails
+        """
+        logger.debug('Calling pipeline: {}'.format(self))
+        procs = self._spawn(input)
+
+        try:
+            _wait_all(procs)
+        except KeyboardInterrupt:
+            logger.debug('Caught SIGINT, terminating pipeline')
+            for proc in procs:
+                proc.terminate()
+            raise
+
+        results = [proc.result() for proc in procs]
+        errs = [r.err for r in results if r.err is not None]
+        err = ''.join(errs) if errs else None
+        out = results[-1].out
+        rets = [r.ret for r in results]
+
+        for i, (proc, res) in reversed(list(enumerate(zip(procs, results)))):
+            if res.ret is 0:
+                continue
+            if res.ret == -signal.SIGPIPE and i < len(procs) - 1:
+                # stopped by a later stage that stopped reading
+                continue
+            raise CalledProcessError(proc.cmd, res.ret,
+                                     stdout=out, stderr=err)
+
+        return PipelineResult(out=out, err=err, ret=0, rets=rets)
+
+
+class _Task(object):
+    "A command added to a :class:`Scheduler`"
+
+    def __init__(self, name, builder, args, deps, inputs, outputs, kws):
+        self.name = name
+        self.builder = builder
+        self.args = list(args)
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.kws = kws
+
+    def up_to_date(self):
+        """Whether all outputs exist and are newer than all inputs
+
+        Tasks without outputs are never up to date.
+        """
+        if not self.outputs:
+            return False
+        try:
+            built = min(os.stat(path).st_mtime for path in self.outputs)
+        except OSError:
+            return False
+        for path in self.inputs:
+            try:
+                if os.stat(path).st_mtime > built:
+                    return False
+            except OSError:
+                # let the command report the missing input
+                return False
+        return True
+
+
+class Scheduler(object):
+    """Run commands that depend on each other, like ``make``.
+
+    Each task is a :class:`Builder` with its arguments, the names of
+    the tasks it depends on, and the files it reads and writes. A task
+    is started once its dependencies have finished, and at most `jobs`
+    tasks run at the same time. A task whose `outputs` all exist and
+    are newer than its `inputs` is skipped.
+
+    When a task fails the running ones are terminated and nothing more
+    is started. If `keep_going` is set, tasks that do not depend on the
+    failed one are still run, like ``make -k``.
+
+    >>> cc = Builder(['cc'])
+    >>> sched = Scheduler(jobs=4)
+    >>> sched.add('a.o', cc, ['-c', 'a.c'], inputs=['a.c'], outputs=['a.o'])
+    >>> sched.add('b.o', cc, ['-c', 'b.c'], inputs=['b.c'], outputs=['b.o'])
+    >>> sched.add('prog', cc, ['-o', 'prog', 'a.o', 'b.o'],
+    ...           deps=['a.o', 'b.o'], inputs=['a.o', 'b.o'],
+    ...           outputs=['prog'])
+    >>> results = sched.run()
+
+    :param jobs: the maximum number of concurrent tasks
+                 (defaults to the number of CPUs)
+    :type jobs: :class:`int` or :class:`Governor`
+    :param bool keep_going: run the independent tasks after a failure
+    """
+
+    def __init__(self, jobs=None, keep_going=False):
+        self.jobs = jobs or multiprocessing.cpu_count()
+        if not isinstance(self.jobs, Governor) and self.jobs < 1:
+            raise ValueError('Need at least one job, got {}'
+                             .format(self.jobs))
+        self.keep_going = keep_going
+        self._tasks = collections.OrderedDict()
+
+    def add(self, name, builder, args=(), deps=(), inputs=(), outputs=(),
+            **call_kws):
+        """Add a task
+
+        :param str name: identifies the task
+        :param builder: the command to run
+        :type builder: :class:`Builder`
+        :param args: arguments to call the `builder` with
+        :type args: :class:`list` of :class:`str`
+        :param deps: the names of the tasks to run first
+        :type deps: :class:`list` of :class:`str`
+        :param inputs: the files read by the task
+        :type inputs: :class:`list` of :class:`str`
+        :param outputs: the files written by the task
+        :type outputs: :class:`list` of :class:`str`
+        :param call_kws: keywords for the call (as in :func:`acall`)
+        :returns: the `name`
+        :raises: :class:`ValueError` if the name is already taken
+        """
+        check_cmd(args)
+        if name in self._tasks:
+            raise ValueError('Task {} already added'.format(name))
+        self._tasks[name] = _Task(name, builder, args, deps, inputs, outputs,
+                                  call_kws)
+        return name
+
+    def _check(self):
+        "Make sure all dependencies are known and there are no cycles"
+        for task in self._tasks.itervalues():
+            for dep in task.deps:
+                if dep not in self._tasks:
+                    raise ValueError('Task {} depends on unknown task {}'
+                                     .format(task.name, dep))
+
+        state = dict()
+        for root in self._tasks:
+            if root in state:
+                continue
+            state[root] = 'visiting'
+            stack = [(root, iter(self._tasks[root].deps))]
+            while stack:
+                name, deps = stack[-1]
+                dep = next(deps, None)
+                if dep is None:
+                    state[name] = 'done'
+                    stack.pop()
+                elif state.get(dep) == 'visiting':
+                    raise ValueError('Dependency cycle through {}'
+                                     .format(dep))
+                elif dep not in state:
+                    state[dep] = 'visiting'
+                    stack.append((dep, iter(self._tasks[dep].deps)))
+
+    def run(self, raises=True):
+        """Run the tasks
+
+        :param bool raises: raise the first failure once the
+                            scheduler has stopped
+        :returns: the result of each task that ran, ``None`` for those
+                  that were up to date. Tasks that were not run because
+                  of a failure are left out, those that could not be
+                  started have a return code of ``None``.
+        :rtype: :class:`dict` of :class:`str` to :class:`Result`
+        :raises: :class:`ValueError` on unknown dependencies or cycles
+        :raises: :class:`CalledProcessError` for the first failing task,
+                 or the error of the first task that could not be started
+        """
+        self._check()
+        waiting = dict((name, set(task.deps))
+                       for name, task in self._tasks.iteritems())
+        dependents = collections.defaultdict(list)
+        for name, task in self._tasks.iteritems():
+            for dep in task.deps:
+                dependents[dep].append(name)
+
+        ready = collections.deque(name for name in self._tasks
+                                  if not waiting[name])
+        results = dict()
+        failures = []
+        finished = collections.deque()
+        reactor = Reactor()
+
+        def on_exit(name, proc):
+            try:
+                finished.append((name, proc.result()))
+            except CalledProcessError:
+                finished.append((name, sys.exc_info()))
+
+        def stopped():
+            return failures and not self.keep_going
+
+        try:
+            while (ready or reactor or finished) and not stopped():
+                limit, interval = _job_limit(self.jobs, reactor)
+                while ready and len(reactor) < limit:
+                    name = ready.popleft()
+                    task = self._tasks[name]
+                    if task.up_to_date():
+                        logger.debug('Task {} is up to date'.format(name))
+                        finished.append((name, None))
+                        continue
+                    logger.debug('Starting task {}'.format(name))
+                    try:
+                        proc = task.builder.acall(*task.args, **task.kws)
+                    except Exception:
+                        finished.append((name, sys.exc_info()))
+                        continue
+                    reactor.add(proc,
+                                on_exit=functools.partial(on_exit, name))
+                if not finished:
+                    reactor.poll(interval)
+
+                while finished:
+                    name, outcome = finished.popleft()
+                    if not (outcome is None or isinstance(outcome, Result)):
+                        # the sys.exc_info of a failure
+                        logger.debug('Task {} failed'.format(name))
+                        failures.append(outcome)
+                        error = outcome[1]
+                        if isinstance(error, CalledProcessError):
+                            results[name] = _error_result(error)
+                        else:
+                            # never started, so there is no return code
+                            results[name] = Result(out=None, err=None,
+                                                   ret=None)
+                        continue
+                    results[name] = outcome
+                    for other in dependents[name]:
+                        waiting[other].discard(name)
+                        if not waiting[other]:
+                            ready.append(other)
+        except KeyboardInterrupt:
+            logger.debug('Caught SIGINT, terminating tasks')
+            raise
+        finally:
+            if reactor:
+                logger.debug('Terminating {} tasks'.format(len(reactor)))
+            reactor.terminate()
+            reactor.close()
+
+        if failures and raises:
+            etype, error, tb = failures[0]
+            raise etype, error, tb
+        return results
+
+
+class Coprocess(object):
+    """A long-lived shell that runs the commands sent to it.
+
+    For small commands, starting a new process costs more than the
+    command itself. The coprocess keeps a shell running and sends it
+    each command over its stdin. The end of the command's stdout and
+    stderr is marked with a unique sentinel, followed by the exit
+    status. Each command runs in a subshell with stdin from
+    ``/dev/null``, so it cannot change the state of the shell for
+    later commands. If the shell dies, or a command runs out of time,
+    it is restarted for the next command.
+
+    >>> with Coprocess() as shell:
+    ...   for path in paths:
+    ...     print shell.run(['stat', '-c', '%s', path]).out.strip()
+
+    Any shell that understands POSIX ``sh`` syntax can be used. Any
+    number of threads may share a coprocess, but its commands run one
+    at a time.
+
+    :param shell: the shell to run
+    :type shell: :class:`list` of :class:`str`
+    :param dict env: the environment of the shell
+    :param str cwd: the working directory of the shell
+    """
+
+    def __init__(self, shell=None, env=None, cwd=None):
+        self.shell = list(shell or ['sh'])
+        check_cmd(self.shell)
+        self.env = env
+        self.cwd = cwd
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def pid(self):
+        "The process id of the shell, if running"
+        return self._proc.pid if self._proc is not None else None
+
+    def start(self):
+        """Start the shell if it is not running
+
+        :returns: the coprocess
+        :rtype: :class:`Coprocess`
+        """
+        if self._proc is not None and self._proc.poll() is None:
+            return self
+        self._proc, _ = _popen(self.shell, stdin=PIPE, stdout=PIPE,
+                               stderr=PIPE, env=self.env, cwd=self.cwd)
+        logger.debug('Started coprocess {}'.format(self._proc.pid))
+        return self
+
+    def close(self):
+        "Stop the shell"
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        for pipe in (proc.stdin, proc.stdout, proc.stderr):
+            pipe.close()
+        _terminate(proc)
+        proc.wait()
+        logger.debug('Stopped coprocess {}'.format(proc.pid))
+
+    def run(self, cmd, raises=True, timeout=None):
+        """Run a command in the shell
+
+        :param cmd: the command (as in :func:`call`), every argument
+                    is quoted
+        :param bool raises: raise an exception on non-zero return
+        :param float timeout: seconds the command is allowed to run
+        :rtype: :class:`Result`
+        :raises: :class:`CalledProcessError` if the command fails
+        :raises: :class:`TimeoutExpired` if the command timed out
+        """
+        check_cmd(cmd)
+        return self.script(' '.join(map(pipes.quote, cmd)), raises=raises,
+                           timeout=timeout)
+
+    def script(self, script, raises=True, timeout=None):
+        """Run shell code in the shell
+
+        Code that the shell cannot parse, such as an unbalanced quote,
+        makes the shell wait for more input. Without a `timeout` the
+        call then never returns.
+
+        :param str script: the code
+        :param bool raises: raise an exception on non-zero return
+        :param float timeout: seconds the code is allowed to run,
+                              after which the shell is stopped
+        :rtype: :class:`Result`
+        :raises: :class:`CalledProcessError` if the code fails
+        :raises: :class:`TimeoutExpired` if the code timed out
+        """
+        token = 'pxul-' + os.urandom(16).encode('hex')
+        message = ('(\n{}\n) </dev/null\n'
+                   'printf \'\\n%s %d\\n\' {} "$?"\n'
+                   'printf \'\\n%s\\n\' {} >&2\n'
+                   .format(script, token, token))
+        with self._lock:
+            out, err, ret, expired = self._send(message, token, timeout)
+
+        logger.debug('Coprocess command finished with {}'.format(ret))
+        if expired:
+            error = TimeoutExpired(script, ret, timeout, stdout=out,
+                                   stderr=err)
+            if raises:
+                raise error
+            return _error_result(error)
+        if ret is not 0:
+            error = CalledProcessError(script, ret, stdout=out, stderr=err)
+            if raises:
+                raise error
+            return _error_result(error)
+        return Result(out=out, err=err, ret=ret)
+
+    def _send(self, message, token, timeout):
+        for attempt in (1, 2):
+            self.start()
+            try:
+                self._proc.stdin.write(message)
+                self._proc.stdin.flush()
+                break
+            except IOError, e:
+                # the shell died since the last command
+                if e.errno != errno.EPIPE or attempt == 2:
+                    raise
+                self.close()
+        return self._receive(token, timeout)
+
+    def _receive(self, token, timeout):
+        """Read the output of a command up to the sentinels
+
+        :returns: the output, the exit status, and whether it timed out
+        """
+        deadline = _deadline(time.time(), timeout, None)
+        out_fd = self._proc.stdout.fileno()
+        err_fd = self._proc.stderr.fileno()
+        markers = {out_fd: '\n' + token + ' ', err_fd: '\n' + token + '\n'}
+        data = {out_fd: bytearray(), err_fd: bytearray()}
+        ends = dict()
+        ret = None
+        while len(ends) < 2:
+            readers = [fd for fd in markers if fd not in ends]
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            ready, _ = _ready(readers, [], remaining)
+            if not ready and deadline is not None \
+               and time.time() >= deadline:
+                logger.debug('Coprocess command timed out, stopping {}'
+                             .format(self._proc.pid))
+                proc = self._proc
+                self.close()
+                return (str(data[out_fd]), str(data[err_fd]),
+                        proc.returncode, True)
+            for fd in ready:
+                chunk = _retry(os.read, fd, _CHUNK)
+                if not chunk:
+                    # the shell died during the command
+                    ret = _retry(self._proc.wait)
+                    self.close()
+                    return str(data[out_fd]), str(data[err_fd]), ret, False
+                buf = data[fd]
+                start = max(0, len(buf) - len(markers[fd]) - 16)
+                buf.extend(chunk)
+                index = buf.find(markers[fd], start)
+                if index < 0:
+                    continue
+                if fd == out_fd:
+                    status = index + len(markers[fd])
+                    newline = buf.find('\n', status)
+                    if newline < 0:
+                        continue
+                    ret = int(str(buf[status:newline]))
+                ends[fd] = index
+        return (str(data[out_fd][:ends[out_fd]]),
+                str(data[err_fd][:ends[err_fd]]), ret, False)
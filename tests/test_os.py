@@ -1,7 +1,9 @@
 import pxul.os
+import pxul.subprocess
 import os
 import os.path
 import tempfile
+import time
 import shutil
 import uuid
 
@@ -135,6 +137,169 @@ class source_Test(TestCase):
                 self.assertEqual(os.environ['BAR'], 'world')
 
 
+    def test_source_coprocess(self):
+        "Sourcing paths in a coprocess should define a new environment"
+        with pxul.os.tmpdir():
+            with open('a.sh', 'w') as fd:
+                fd.write('export FOO=hello\nexport NOT_PRESENT=42\n'
+                         'unset NOT_PRESENT')
+            coprocess = pxul.subprocess.Coprocess(['bash'])
+            with coprocess:
+                with pxul.os.source(['a.sh'], coprocess=coprocess):
+                    self.assertEqual(os.environ['FOO'], 'hello')
+                    self.assertNotIn('NOT_PRESENT', os.environ)
+
+
+class SourceCache_Test(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmpdir, 'setup.sh')
+        self.log = os.path.join(self.tmpdir, 'log')
+        self.write('hello')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, value):
+        with open(self.script, 'w') as fd:
+            fd.write('echo x >> {}\nexport FOO={}\n'.format(self.log, value))
+        mtime = os.path.getmtime(self.script) + len(value)
+        os.utime(self.script, (mtime, mtime))
+
+    def sourced(self):
+        with open(self.log) as fd:
+            return len(fd.readlines())
+
+    def source(self, cache):
+        with pxul.os.source([self.script], shell='bash', cache=cache):
+            return os.environ['FOO']
+
+    def test_memory(self):
+        "Environments should be reused from memory"
+        cache = pxul.os.SourceCache()
+        self.assertEqual(self.source(cache), 'hello')
+        self.assertEqual(self.source(cache), 'hello')
+        self.assertEqual(self.sourced(), 1)
+
+    def test_disk(self):
+        "Environments should be reused from disk"
+        store = os.path.join(self.tmpdir, 'store')
+        self.assertEqual(self.source(pxul.os.SourceCache(store)), 'hello')
+        self.assertEqual(self.source(pxul.os.SourceCache(store)), 'hello')
+        self.assertEqual(self.sourced(), 1)
+
+    def test_changed_file(self):
+        "Changing a sourced file should source it again"
+        cache = pxul.os.SourceCache()
+        self.source(cache)
+        self.write('world')
+        self.assertEqual(self.source(cache), 'world')
+        self.assertEqual(self.sourced(), 2)
+
+    def test_changed_environment(self):
+        "Changing the environment should source the files again"
+        cache = pxul.os.SourceCache()
+        self.source(cache)
+        with pxul.os.env(SOURCE_CACHE_TEST='1'):
+            self.source(cache)
+        self.assertEqual(self.sourced(), 2)
+
+    def test_coprocess(self):
+        "Environments sourced in a coprocess should not be cached"
+        cache = pxul.os.SourceCache()
+        with pxul.subprocess.Coprocess(['bash']) as coprocess:
+            for _ in xrange(2):
+                with pxul.os.source([self.script], coprocess=coprocess,
+                                    cache=cache):
+                    self.assertEqual(os.environ['FOO'], 'hello')
+        self.assertEqual(self.sourced(), 2)
+
+    def test_clear(self):
+        "Cleared environments should be sourced again"
+        cache = pxul.os.SourceCache(os.path.join(self.tmpdir, 'store'))
+        self.source(cache)
+        cache.clear()
+        self.source(cache)
+        self.assertEqual(self.sourced(), 2)
+
+
+class source_many_Test(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def script(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fd:
+            fd.write(text)
+        return path
+
+    def test_many(self):
+        "Each set of paths should define its own environment"
+        a = self.script('a.sh', 'export SUITE=a\n')
+        b = self.script('b.sh', 'export SUITE=b\n')
+        extra = self.script('extra.sh', 'export EXTRA=1\n')
+        envs = pxul.os.source_many({'a': [a], 'b': [b, extra]}, jobs=2)
+        self.assertEqual(sorted(envs), ['a', 'b'])
+        with envs['a']:
+            self.assertEqual(os.environ['SUITE'], 'a')
+            self.assertNotIn('EXTRA', os.environ)
+        with envs['b']:
+            self.assertEqual(os.environ['SUITE'], 'b')
+            self.assertEqual(os.environ['EXTRA'], '1')
+
+    def test_list(self):
+        "Sets given as a list should be named by their paths"
+        a = self.script('a.sh', 'export SUITE=a\n')
+        envs = pxul.os.source_many([[a]])
+        self.assertEqual(list(envs), [(a,)])
+
+    def test_multiline(self):
+        "Values containing newlines should be kept intact"
+        path = self.script('m.sh', "export MULTI='one\ntwo=2\nthree'\n")
+        envs = pxul.os.source_many({'m': [path]})
+        with envs['m']:
+            self.assertEqual(os.environ['MULTI'], 'one\ntwo=2\nthree')
+            self.assertNotIn('two', os.environ)
+
+    def test_failure(self):
+        "Failing to source a set should raise ValueError"
+        missing = os.path.join(self.tmpdir, 'missing.sh')
+        self.assertRaises(ValueError, pxul.os.source_many, {'m': [missing]})
+
+    def test_failure_bash(self):
+        "A missing file should fail with bash as well"
+        a = self.script('a.sh', 'export SUITE=a\n')
+        missing = os.path.join(self.tmpdir, 'missing.sh')
+        self.assertRaises(ValueError, pxul.os.source_many,
+                          {'m': [missing, a]}, shell='bash')
+
+    def test_cache_source(self):
+        "Environments cached by source should not be reused"
+        path = self.script('m.sh', "export MULTI='one\ntwo=2\nthree'\n")
+        cache = pxul.os.SourceCache()
+        with pxul.os.source([path], shell='bash', cache=cache):
+            pass
+        envs = pxul.os.source_many({'m': [path]}, shell='bash', cache=cache)
+        with envs['m']:
+            self.assertEqual(os.environ['MULTI'], 'one\ntwo=2\nthree')
+            self.assertNotIn('two', os.environ)
+
+    def test_cache(self):
+        "Cached environments should not be sourced again"
+        log = os.path.join(self.tmpdir, 'log')
+        path = self.script('a.sh', 'echo x >> {}\nexport A=1\n'.format(log))
+        cache = pxul.os.SourceCache()
+        pxul.os.source_many({'a': [path]}, cache=cache)
+        envs = pxul.os.source_many({'a': [path]}, cache=cache)
+        with envs['a']:
+            self.assertEqual(os.environ['A'], '1')
+        with open(log) as fd:
+            self.assertEqual(len(fd.readlines()), 1)
+
+
 class remove_children_Test(TestCase):
     def test_cleanup(self):
         tmpdir = tempfile.mkdtemp()
@@ -245,3 +410,229 @@ class find_in_path_Test(TestCase):
         name = uuid.uuid4().hex
         path = pxul.os.find_in_path(name)
         self.assertIsNone(path)
+
+
+class Executables_Mixin(object):
+    "Run each test in a temporary directory to create executables in"
+
+    def setUp(self):
+        self._tmpdir = pxul.os.tmpdir()
+        self.tmpdir = self._tmpdir.__enter__()
+        self.root = self.tmpdir
+
+    def tearDown(self):
+        self._tmpdir.__exit__(None, None, None)
+
+    def makedirs(self, *paths):
+        for path in paths:
+            os.makedirs(os.path.join(self.root, path))
+
+    def executable(self, path, mode=0755):
+        "Create a script at `path`, relative to the `root`"
+        path = os.path.join(self.root, path)
+        with open(path, 'w') as fd:
+            fd.write('#!/bin/sh\n')
+        os.chmod(path, mode)
+        return path
+
+
+class PathHash_Test(Executables_Mixin, TestCase):
+    def setUp(self):
+        super(PathHash_Test, self).setUp()
+        self.makedirs('a', 'b')
+        self.dirs = [os.path.join(self.tmpdir, name) for name in 'ab']
+
+    def test_find(self):
+        "Should return the first executable in the search path"
+        self.executable('a/tool', mode=0644)
+        path = self.executable('b/tool')
+        paths = pxul.os.PathHash()
+        self.assertEqual(pxul.os.find_in_path('tool', search=self.dirs,
+                                              hash=paths), path)
+        self.assertIsNone(paths.find(uuid.uuid4().hex, search=self.dirs))
+
+    def test_find_all(self):
+        "Should locate many executables at once"
+        a = self.executable('a/a')
+        b = self.executable('b/b')
+        found = pxul.os.PathHash().find_all(['a', 'b', 'c'],
+                                            search=self.dirs)
+        self.assertEqual(found, {'a': a, 'b': b, 'c': None})
+
+    def test_mtime(self):
+        "New executables should be found once the directory changed"
+        paths = pxul.os.PathHash(interval=0)
+        self.assertIsNone(paths.find('tool', search=self.dirs))
+        path = self.executable('a/tool')
+        mtime = os.path.getmtime(self.dirs[0]) + 10
+        os.utime(self.dirs[0], (mtime, mtime))
+        self.assertEqual(paths.find('tool', search=self.dirs), path)
+
+    def test_same_tick(self):
+        "Executables added in the same mtime tick should be found"
+        paths = pxul.os.PathHash(interval=0)
+        mtime = os.path.getmtime(self.dirs[0])
+        self.assertIsNone(paths.find('tool', search=self.dirs))
+        path = self.executable('a/tool')
+        os.utime(self.dirs[0], (mtime, mtime))
+        self.assertEqual(paths.find('tool', search=self.dirs), path)
+
+    def test_rehash(self):
+        "New executables should be found after rehashing"
+        paths = pxul.os.PathHash(interval=3600)
+        self.assertIsNone(paths.find('tool', search=self.dirs))
+        path = self.executable('a/tool')
+        self.assertIsNone(paths.find('tool', search=self.dirs))
+        paths.rehash()
+        self.assertEqual(paths.find('tool', search=self.dirs), path)
+
+    def test_removed(self):
+        "Removed executables should not be found"
+        path = self.executable('a/tool')
+        paths = pxul.os.PathHash(interval=3600)
+        self.assertEqual(paths.find('tool', search=self.dirs), path)
+        os.unlink(path)
+        self.assertIsNone(paths.find('tool', search=self.dirs))
+
+    def test_environment(self):
+        "Should search PATH by default"
+        self.assertEqual(pxul.os.PathHash().find('sh'),
+                         pxul.os.find_in_path('sh'))
+
+
+class search_root_Test(Executables_Mixin, TestCase):
+    def setUp(self):
+        super(search_root_Test, self).setUp()
+        self.makedirs('a/b/c', 'd/.git', 'e')
+
+    def test_search(self):
+        "Should find every executable with one of the names"
+        c = self.executable('a/b/c/tool')
+        git = self.executable('d/.git/tool')
+        other = self.executable('e/other')
+        self.executable('e/tool', mode=0644)
+        found = sorted(pxul.os.search_root(['tool', 'other'],
+                                           root=self.tmpdir))
+        self.assertEqual(found, [('other', other), ('tool', c),
+                                 ('tool', git)])
+
+    def test_exclude(self):
+        "Should not enter excluded names or paths"
+        self.executable('a/b/c/tool')
+        git = self.executable('d/.git/tool')
+        e = self.executable('e/tool')
+        exclude = ['.git', os.path.join(self.tmpdir, 'a', '*')]
+        found = sorted(pxul.os.search_root('tool', root=self.tmpdir,
+                                           exclude=exclude))
+        self.assertEqual(found, [('tool', e)])
+
+    def test_max_depth(self):
+        "Should not enter directories below the maximum depth"
+        self.executable('a/b/c/tool')
+        e = self.executable('e/tool')
+        found = list(pxul.os.search_root('tool', root=self.tmpdir,
+                                         max_depth=1))
+        self.assertEqual(found, [('tool', e)])
+
+    def test_symlinks(self):
+        "Should not follow symbolic links to directories"
+        c = self.executable('a/b/c/tool')
+        os.symlink(os.path.join(self.tmpdir, 'a'),
+                   os.path.join(self.tmpdir, 'e', 'link'))
+        found = list(pxul.os.search_root('tool', root=self.tmpdir,
+                                         one_filesystem=True))
+        self.assertEqual(found, [('tool', c)])
+
+    def test_error(self):
+        "Errors in the threads should be raised by the generator"
+        def visit(path, depth, stop):
+            if depth:
+                raise RuntimeError(path)
+            return [os.path.join(path, name) for name in 'ade'], []
+
+        results = pxul.os._walk(self.tmpdir, visit, jobs=2)
+        self.assertRaises(RuntimeError, list, results)
+
+    def test_find_in_root(self):
+        "Should return the path to an executable or None"
+        e = self.executable('e/tool')
+        self.assertEqual(pxul.os.find_in_root('tool', root=self.tmpdir,
+                                              jobs=1), e)
+        self.assertIsNone(pxul.os.find_in_root(uuid.uuid4().hex,
+                                               root=self.tmpdir))
+
+
+class FileIndex_Test(Executables_Mixin, TestCase):
+    def setUp(self):
+        super(FileIndex_Test, self).setUp()
+        self.root = os.path.join(self.tmpdir, 'root')
+        self.makedirs('a/b', 'c/.git')
+        self.path = os.path.join(self.tmpdir, 'index')
+
+    def age(self):
+        "Make every directory look older than the index"
+        mtime = time.time() - 60
+        for dirpath, _, _ in os.walk(self.root):
+            os.utime(dirpath, (mtime, mtime))
+
+    def index(self):
+        return pxul.os.FileIndex(self.path, root=self.root,
+                                 exclude=['.git'])
+
+    def test_queries(self):
+        "Should answer name, glob, and executable queries"
+        tool = self.executable('a/b/tool')
+        data = self.executable('a/data', mode=0644)
+        self.executable('c/.git/tool')
+        index = self.index()
+        index.update()
+        self.assertEqual(index.find('tool'), [tool])
+        self.assertEqual(index.glob('*a*'), [os.path.join(self.root, 'a'),
+                                             data])
+        self.assertEqual(index.glob(os.path.join(self.root, '*', 'd*')),
+                         [data])
+        self.assertEqual(index.search(['tool', 'data']), [('tool', tool)])
+
+    def test_incremental(self):
+        "Should only read the directories that changed"
+        self.executable('a/b/tool')
+        self.age()
+        index = self.index()
+        self.assertEqual(index.update(), 4)
+        self.assertEqual(index.update(), 0)
+        path = self.executable('a/new')
+        self.assertEqual(index.update(), 1)
+        self.assertEqual(index.find('new'), [path])
+        self.assertEqual(index.update(full=True), 4)
+
+    def test_persistent(self):
+        "Should load the index saved by another instance"
+        tool = self.executable('a/b/tool')
+        self.age()
+        self.index().update()
+        index = self.index()
+        self.assertEqual(index.find('tool'), [tool])
+        self.assertEqual(index.update(), 0)
+        other = pxul.os.FileIndex(self.path, root=self.root)
+        self.assertEqual(other.find('tool'), [])
+
+    def test_find_in_root(self):
+        "find_in_root should search the index below root"
+        tool = self.executable('a/b/tool')
+        index = self.index()
+        index.update()
+        self.assertEqual(pxul.os.find_in_root('tool', root=self.root,
+                                              index=index), tool)
+        self.assertIsNone(pxul.os.find_in_root(
+            'tool', root=os.path.join(self.root, 'c'), index=index))
+
+    def test_find_in_root_invalid(self):
+        "find_in_root should refuse what the index cannot answer"
+        index = self.index()
+        index.update()
+        self.assertRaises(ValueError, pxul.os.find_in_root, 'tool',
+                          root=self.tmpdir, index=index)
+        for option in [dict(exclude=['a']), dict(max_depth=0),
+                       dict(one_filesystem=True)]:
+            self.assertRaises(ValueError, pxul.os.find_in_root, 'tool',
+                              root=self.root, index=index, **option)
@@ -1,7 +1,49 @@
 import pxul.subprocess
 
 from unittest import TestCase
+import StringIO
 import copy
+import fcntl
+import hashlib
+import logging
+import cPickle as pickle
+import os
+import resource
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import uuid
+
+
+class many_fds(object):
+    """Keep `count` descriptors open, so that new ones are above the
+    ``FD_SETSIZE`` limit of :func:`select.select`
+    """
+
+    def __init__(self, test, count=1100):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        needed = count + 64
+        if hard != resource.RLIM_INFINITY and hard < needed:
+            test.skipTest('at most {} descriptors may be open'.format(hard))
+        self.count = count
+        self.limits = soft, hard
+        self.needed = needed
+        self.fds = []
+
+    def __enter__(self):
+        soft, hard = self.limits
+        if soft != resource.RLIM_INFINITY and soft < self.needed:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (self.needed, hard))
+        self.fds = [os.open('/dev/null', os.O_RDONLY)
+                    for _ in xrange(self.count)]
+        return self
+
+    def __exit__(self, *args):
+        for fd in self.fds:
+            os.close(fd)
+        resource.setrlimit(resource.RLIMIT_NOFILE, self.limits)
 
 
 class call_Test(TestCase):
@@ -32,6 +74,48 @@ class call_Test(TestCase):
         self.assertEqual(result.err.strip(), '')
         self.assertEqual(result.ret, 0)
 
+    def test_usage(self):
+        "Should record the resource usage of the child"
+        cmd = ['sh', '-c', 'i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done']
+        result = pxul.subprocess.call(cmd)
+        self.assertIsInstance(result.usage, pxul.subprocess.Usage)
+        self.assertGreater(result.usage.wall, 0)
+        self.assertGreater(result.usage.utime + result.usage.stime, 0)
+        self.assertGreater(result.usage.maxrss, 0)
+        self.assertGreaterEqual(result.usage.nvcsw, 0)
+
+    def test_usage_failure(self):
+        "Should record the resource usage of a failing child"
+        with self.assertRaises(pxul.subprocess.CalledProcessError) as ctx:
+            pxul.subprocess.call(['false'])
+        self.assertIsInstance(ctx.exception.usage, pxul.subprocess.Usage)
+
+    def test_timeout(self):
+        "Should terminate the command and keep its partial output"
+        cmd = ['sh', '-c', 'echo started; sleep 60']
+        start = time.time()
+        with self.assertRaises(pxul.subprocess.TimeoutExpired) as ctx:
+            pxul.subprocess.call(cmd, stdout=pxul.subprocess.PIPE,
+                                 timeout=0.2)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(ctx.exception.stdout, 'started\n')
+        self.assertEqual(ctx.exception.timeout, 0.2)
+        self.assertLess(ctx.exception.retcode, 0)
+
+    def test_timeout_kill(self):
+        "Should kill the command if it ignores SIGTERM"
+        cmd = ['sh', '-c', 'trap "" TERM; sleep 60']
+        start = time.time()
+        with self.assertRaises(pxul.subprocess.TimeoutExpired) as ctx:
+            pxul.subprocess.call(cmd, timeout=0.1, grace=0.2)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(ctx.exception.retcode, -9)
+
+    def test_deadline(self):
+        "Should terminate the command at the deadline"
+        with self.assertRaises(pxul.subprocess.TimeoutExpired):
+            pxul.subprocess.call(['sleep', '60'], deadline=time.time() + 0.1)
+
 
 class run_Test(TestCase):
     def test_default_ok(self):
@@ -84,6 +168,22 @@ class run_Test(TestCase):
         self.assertTrue(res.err.startswith('touch: cannot touch'))
         self.assertNotEqual(res.ret, 0)
 
+    def test_raises_false_usage(self):
+        "A failing command should still report its resource usage"
+        res = pxul.subprocess.run(['false'], raises=False)
+        self.assertIsInstance(res.usage, pxul.subprocess.Usage)
+
+    def test_raises_false_timeout(self):
+        "A command that timed out should return non-zero exit code"
+        res = pxul.subprocess.run(['sleep', '60'], raises=False, timeout=0.1)
+        self.assertLess(res.ret, 0)
+
+    def test_many_descriptors(self):
+        "Should capture output when descriptors above 1024 are open"
+        with many_fds(self):
+            res = pxul.subprocess.run(['echo', 'x'], capture='stdout')
+        self.assertEqual(res.out, 'x\n')
+
 
 class Command_Test(TestCase):
     def test_init_check(self):
@@ -124,3 +224,1224 @@ class Command_Test(TestCase):
         original = copy.deepcopy(echo.__dict__)
         echo('hello', 'world')
         self.assertDictEqual(original, echo.__dict__)
+
+    def test_acall(self):
+        "acall should start the command without waiting"
+        echo = pxul.subprocess.Builder(['echo'], capture='both')
+        proc = echo.acall('hello', 'world')
+        self.assertIsInstance(proc, pxul.subprocess.Process)
+        self.assertEqual(proc.wait().out.strip(), 'hello world')
+
+    def test_timeout(self):
+        "The timeout of the Builder should apply unless overridden"
+        sleep = pxul.subprocess.Builder(['sleep'], timeout=0.1)
+        with self.assertRaises(pxul.subprocess.TimeoutExpired):
+            sleep('60')
+        self.assertEqual(sleep('0.2', timeout=5).ret, 0)
+
+
+class run_many_Test(TestCase):
+    def test_ordered(self):
+        "Results should be generated in the order of the commands"
+        cmds = [['echo', str(i)] for i in xrange(20)]
+        results = list(pxul.subprocess.run_many(cmds, jobs=4,
+                                                capture='stdout'))
+        self.assertEqual([r.out.strip() for r in results],
+                         [str(i) for i in xrange(20)])
+
+    def test_unordered(self):
+        "Unordered results should be generated as commands finish"
+        cmds = [['sh', '-c', 'sleep 0.3; echo slow'], ['echo', 'fast']]
+        results = list(pxul.subprocess.run_many(cmds, jobs=2,
+                                                capture='stdout',
+                                                ordered=False))
+        self.assertEqual([r.out.strip() for r in results], ['fast', 'slow'])
+
+    def test_bad_command(self):
+        "Should throw if any command is malformed"
+        with self.assertRaises(pxul.subprocess.ArgumentsError):
+            pxul.subprocess.run_many([['echo'], 'ls'])
+
+    def test_raises(self):
+        "A failing command should raise by default"
+        cmds = [['true'], ['false'], ['true']]
+        with self.assertRaises(pxul.subprocess.CalledProcessError):
+            list(pxul.subprocess.run_many(cmds, jobs=2))
+
+    def test_raises_false(self):
+        "A failing command should return non-zero exit code"
+        cmds = [['true'], ['false'], ['true']]
+        results = list(pxul.subprocess.run_many(cmds, jobs=2, raises=False))
+        self.assertEqual([r.ret for r in results], [0, 1, 0])
+
+    def test_stop_terminates(self):
+        "Abandoning the batch should terminate the running commands"
+        cmds = [['true']] + [['sleep', '60']] * 3
+        results = pxul.subprocess.run_many(cmds, jobs=4)
+        next(results)
+        results.close()
+
+    def test_deadline(self):
+        "Commands should not outlive the deadline of the batch"
+        cmds = [['sleep', '60']] * 4
+        start = time.time()
+        results = list(pxul.subprocess.run_many(
+            cmds, jobs=2, raises=False, deadline=time.time() + 0.2))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(r.ret != 0 for r in results))
+
+
+class stream_Test(TestCase):
+    def test_lines(self):
+        "Should generate the output line by line"
+        lines = list(pxul.subprocess.stream(['seq', '3']))
+        self.assertEqual(lines, ['1\n', '2\n', '3\n'])
+
+    def test_chunks(self):
+        "Chunks should be no larger than requested"
+        chunks = list(pxul.subprocess.stream(['seq', '1000'], chunk=16))
+        self.assertTrue(all(len(c) <= 16 for c in chunks))
+        self.assertEqual(''.join(chunks).split(),
+                         [str(i) for i in xrange(1, 1001)])
+
+    def test_raises(self):
+        "Should raise once the output is consumed if the command fails"
+        cmd = ['sh', '-c', 'echo hello; echo oops >&2; exit 3']
+        lines = pxul.subprocess.stream(cmd, stderr=pxul.subprocess.PIPE)
+        self.assertEqual(next(lines), 'hello\n')
+        with self.assertRaises(pxul.subprocess.CalledProcessError) as ctx:
+            next(lines)
+        self.assertEqual(ctx.exception.retcode, 3)
+        self.assertEqual(ctx.exception.stderr, 'oops\n')
+
+    def test_close(self):
+        "Abandoning the stream should terminate the command"
+        lines = pxul.subprocess.stream(['yes'])
+        self.assertEqual(next(lines), 'y\n')
+        lines.close()
+
+
+class acall_Test(TestCase):
+    def test_cmd_is_str(self):
+        "Should throw an exception if the command is a naked string"
+        with self.assertRaises(pxul.subprocess.ArgumentsError):
+            pxul.subprocess.acall('ls')
+
+    def test_many(self):
+        "Many children should run at the same time"
+        procs = [pxul.subprocess.acall(['sleep', '0.2']) for _ in xrange(10)]
+        start = time.time()
+        results = [p.wait() for p in procs]
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual([r.ret for r in results], [0] * 10)
+
+    def test_done(self):
+        "Polling should not block"
+        proc = pxul.subprocess.acall(['sleep', '0.2'])
+        self.assertFalse(proc.done())
+        with self.assertRaises(ValueError):
+            proc.result()
+        while not proc.done():
+            time.sleep(0.01)
+        self.assertEqual(proc.result().ret, 0)
+
+    def test_input(self):
+        "Input larger than a pipe should be written while reading"
+        data = 'x' * (1024 * 1024)
+        proc = pxul.subprocess.acall(['cat'], stdout=pxul.subprocess.PIPE,
+                                     input=data)
+        self.assertEqual(proc.wait().out, data)
+
+    def test_raises(self):
+        "A failing command should raise when waited for"
+        proc = pxul.subprocess.acall(['false'])
+        with self.assertRaises(pxul.subprocess.CalledProcessError):
+            proc.wait()
+
+
+class input_Test(TestCase):
+    def test_iterator(self):
+        "Chunks should be written as the child reads them"
+        chunks = ('{}\n'.format(i) for i in xrange(100000))
+        res = pxul.subprocess.run(['wc', '-l'], capture='stdout', input=chunks)
+        self.assertEqual(res.out.strip(), '100000')
+
+    def test_lazy(self):
+        "Chunks should not be taken before the child can read them"
+        taken = []
+
+        def chunks():
+            for i in xrange(1000):
+                taken.append(i)
+                yield 'x' * 1024
+
+        proc = pxul.subprocess.acall(['sh', '-c', 'sleep 0.2; wc -c'],
+                                     stdout=pxul.subprocess.PIPE,
+                                     input=chunks())
+        proc.pump(timeout=0.1)
+        self.assertLess(len(taken), 1000)
+        self.assertEqual(proc.wait().out.strip(), str(1000 * 1024))
+
+    def test_file(self):
+        "A file should be handed to the child"
+        with tempfile.TemporaryFile() as fd:
+            fd.write('hello\nworld\n')
+            fd.seek(0)
+            proc = pxul.subprocess.acall(['cat'], stdout=pxul.subprocess.PIPE,
+                                         input=fd)
+            self.assertEqual(proc.writers(), [])
+            self.assertEqual(proc.wait().out, 'hello\nworld\n')
+
+    def test_descriptor(self):
+        "A descriptor should be handed to the child"
+        read, write = os.pipe()
+        os.write(write, 'hello')
+        os.close(write)
+        try:
+            res = pxul.subprocess.run(['cat'], capture='stdout', input=read)
+        finally:
+            os.close(read)
+        self.assertEqual(res.out, 'hello')
+
+    def test_readable(self):
+        "Objects without a descriptor should be read in chunks"
+        data = StringIO.StringIO('x' * 1000000)
+        res = pxul.subprocess.run(['wc', '-c'], capture='stdout', input=data)
+        self.assertEqual(res.out.strip(), '1000000')
+
+    def test_early_exit(self):
+        "A child that stops reading should not fail the call"
+        chunks = ('x' * 1024 for _ in xrange(10000))
+        res = pxul.subprocess.run(['head', '-c', '10'], capture='stdout',
+                                  input=chunks)
+        self.assertEqual(res.out, 'x' * 10)
+
+
+class capture_Test(TestCase):
+    def test_spill_small(self):
+        "Output below the spill limit should be kept as a string"
+        res = pxul.subprocess.run(['echo', 'hello'], capture='stdout',
+                                  spill=1024)
+        self.assertEqual(res.out, 'hello\n')
+
+    def test_spill(self):
+        "Output beyond the spill limit should be kept in a file"
+        res = pxul.subprocess.run(['seq', '100000'], capture='stdout',
+                                  spill=1024)
+        expected = ''.join('{}\n'.format(i) for i in xrange(1, 100001))
+        self.assertIsInstance(res.out, pxul.subprocess.Spooled)
+        self.assertEqual(len(res.out), len(expected))
+        self.assertEqual(res.out[:8], '1\n2\n3\n4\n')
+        self.assertEqual(res.out, expected)
+        res.out.close()
+
+    def test_spill_pickle(self):
+        "Spilled output should be pickled as a string"
+        res = pxul.subprocess.run(['seq', '1000'], capture='stdout', spill=10)
+        copied = pickle.loads(pickle.dumps(res, 2))
+        self.assertEqual(copied.out, str(res.out))
+
+    def test_tail(self):
+        "Only the end of stderr should be kept"
+        script = 'seq 10000 >&2; exit 3'
+        with self.assertRaises(pxul.subprocess.CalledProcessError) as e:
+            pxul.subprocess.run(['sh', '-c', script], capture='both', tail=10)
+        self.assertEqual(e.exception.stderr, '999\n10000\n')
+        self.assertIn('10000', str(e.exception))
+
+    def test_tail_short(self):
+        "Output shorter than the tail should be kept whole"
+        res = pxul.subprocess.run(['sh', '-c', 'echo a >&2; echo b >&2'],
+                                  capture='stderr', tail=100)
+        self.assertEqual(res.err, 'a\nb\n')
+
+    def test_tail_ring(self):
+        "The tail should be correct whatever the sizes of the writes"
+        for size in (1, 3, 7, 16):
+            tail = pxul.subprocess._Tail(size)
+            data = ''
+            for i in xrange(50):
+                chunk = str(i) * (i % 5)
+                tail.write(chunk)
+                data += chunk
+                self.assertEqual(tail.value(), data[-size:])
+
+
+class into_Test(TestCase):
+    def test_bytearray(self):
+        "Output should be read into a bytearray"
+        target = bytearray(16)
+        res = pxul.subprocess.run(['printf', 'hello'], capture='stdout',
+                                  into=target)
+        self.assertIsInstance(res.out, memoryview)
+        self.assertEqual(res.out.tobytes(), 'hello')
+        self.assertEqual(target[:5], 'hello')
+        self.assertEqual(len(target), 16)
+
+    def test_grow(self):
+        "A bytearray should grow to hold all the output"
+        target = bytearray(10)
+        res = pxul.subprocess.run(['seq', '100000'], capture='stdout',
+                                  into=target)
+        expected = ''.join('{}\n'.format(i) for i in xrange(1, 100001))
+        self.assertEqual(res.out.tobytes(), expected)
+        self.assertEqual(len(target), len(expected))
+
+    def test_memoryview(self):
+        "Output should be read into part of a buffer"
+        target = bytearray('x' * 10)
+        res = pxul.subprocess.run(['printf', 'abc'], capture='stdout',
+                                  into=memoryview(target)[2:])
+        self.assertEqual(res.out.tobytes(), 'abc')
+        self.assertEqual(target, 'xxabcxxxxx')
+
+    def test_exact(self):
+        "Output that exactly fills a buffer should fit"
+        target = memoryview(bytearray(5))
+        res = pxul.subprocess.run(['printf', 'hello'], capture='stdout',
+                                  into=target)
+        self.assertEqual(res.out.tobytes(), 'hello')
+
+    def test_overflow(self):
+        "Output that does not fit should raise BufferError"
+        target = memoryview(bytearray(4))
+        with self.assertRaises(BufferError):
+            pxul.subprocess.run(['printf', 'hello'], capture='stdout',
+                                into=target)
+
+    def test_viewed(self):
+        "Reading into a bytearray that is still viewed should be refused"
+        target = bytearray(16)
+        res = pxul.subprocess.run(['printf', 'a'], capture='stdout',
+                                  into=target)
+        with self.assertRaises(ValueError):
+            pxul.subprocess.run(['printf', 'b'], capture='stdout',
+                                into=target)
+        del res
+        res = pxul.subprocess.run(['printf', 'b'], capture='stdout',
+                                  into=target)
+        self.assertEqual(res.out.tobytes(), 'b')
+
+    def test_requires_capture(self):
+        "Reading into a buffer should require capturing stdout"
+        with self.assertRaises(ValueError):
+            pxul.subprocess.run(['true'], capture='stderr',
+                                into=bytearray(1))
+
+
+class arun_Test(TestCase):
+    def test_capture_both(self):
+        "Should capture both stdout and stderr"
+        proc = pxul.subprocess.arun(['echo', 'hello'], capture='both')
+        res = proc.wait()
+        self.assertEqual(res.out.strip(), 'hello')
+        self.assertEqual(res.err.strip(), '')
+
+    def test_raises_false(self):
+        "A failing command should return non-zero exit code"
+        proc = pxul.subprocess.arun(['false'], raises=False)
+        self.assertEqual(proc.wait().ret, 1)
+
+
+class Pipeline_Test(TestCase):
+    def test_or(self):
+        "Combining Builders should create a Pipeline"
+        a = pxul.subprocess.Builder(['echo'])
+        b = pxul.subprocess.Builder(['cat'])
+        pipeline = a | b | a
+        self.assertIsInstance(pipeline, pxul.subprocess.Pipeline)
+        self.assertEqual(len(pipeline.stages), 3)
+
+    def test_call(self):
+        "Output of each stage should feed the next"
+        sort = pxul.subprocess.Builder(['sort'])
+        uniq = pxul.subprocess.Builder(['uniq', '-c'])
+        wc = pxul.subprocess.Builder(['wc', '-l'], capture='stdout')
+        res = (sort | uniq | wc)(input='b\na\nb\nc\n')
+        self.assertEqual(res.out.strip(), '3')
+        self.assertEqual(res.rets, [0, 0, 0])
+        self.assertEqual(res.ret, 0)
+
+    def test_large(self):
+        "Large outputs should not deadlock"
+        seq = pxul.subprocess.Builder(['seq', '200000'])
+        cat = pxul.subprocess.Builder(['cat'], capture='both')
+        res = (seq | cat)()
+        self.assertEqual(len(res.out.split()), 200000)
+
+    def test_failing_stage(self):
+        "Should raise naming the failing stage"
+        false = pxul.subprocess.Builder(['sh', '-c', 'exit 3'])
+        cat = pxul.subprocess.Builder(['cat'], capture='stdout')
+        with self.assertRaises(pxul.subprocess.CalledProcessError) as ctx:
+            (false | cat)()
+        self.assertEqual(ctx.exception.retcode, 3)
+        self.assertEqual(ctx.exception.cmd, "sh -c 'exit 3'")
+
+    def test_early_exit(self):
+        "A stage exiting early should stop the previous stage"
+        yes = pxul.subprocess.Builder(['yes'])
+        head = pxul.subprocess.Builder(['head', '-n', '2'], capture='stdout')
+        res = (yes | head)()
+        self.assertEqual(res.out, 'y\ny\n')
+        self.assertEqual(res.rets, [-signal.SIGPIPE, 0])
+        self.assertEqual(res.ret, 0)
+
+
+class Cache_Test(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = pxul.subprocess.Cache(os.path.join(self.tmpdir, 'cache'))
+        self.counter = os.path.join(self.tmpdir, 'counter')
+        self.cmd = ['sh', '-c', 'echo x >> {}; echo hello'.format(self.counter)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def calls(self):
+        with open(self.counter) as fd:
+            return len(fd.readlines())
+
+    def test_hit(self):
+        "A cached result should be returned without running the command"
+        res1 = pxul.subprocess.run(self.cmd, capture='stdout', cache=self.cache)
+        res2 = pxul.subprocess.run(self.cmd, capture='stdout', cache=self.cache)
+        self.assertEqual(res1, res2)
+        self.assertEqual(res2.out, 'hello\n')
+        self.assertEqual(self.calls(), 1)
+
+    def test_key(self):
+        "Different capture or input should miss"
+        pxul.subprocess.run(self.cmd, capture='stdout', cache=self.cache)
+        pxul.subprocess.run(self.cmd, capture='both', cache=self.cache)
+        pxul.subprocess.run(self.cmd, capture='both', cache=self.cache,
+                            input='x')
+        self.assertEqual(self.calls(), 3)
+
+    def test_env_cwd(self):
+        "Different environment or working directory should miss"
+        cmd = ['sh', '-c', 'echo x >> {}; echo $X; pwd'.format(self.counter)]
+        run = lambda **kws: pxul.subprocess.run(cmd, capture='stdout',
+                                                cache=self.cache, **kws).out
+        self.assertEqual(run(env={'X': '1'}, cwd='/'), '1\n/\n')
+        self.assertEqual(run(env={'X': '2'}, cwd='/'), '2\n/\n')
+        self.assertEqual(run(env={'X': '2'}, cwd=self.tmpdir),
+                         '2\n{}\n'.format(os.path.realpath(self.tmpdir)))
+        self.assertEqual(run(env={'X': '1'}, cwd='/'), '1\n/\n')
+        self.assertEqual(self.calls(), 3)
+
+    def test_inputs_cwd(self):
+        "Relative input files should be found in the working directory"
+        with open(os.path.join(self.tmpdir, 'data'), 'w') as fd:
+            fd.write('a')
+        for _ in xrange(2):
+            pxul.subprocess.run(self.cmd, cache=self.cache, inputs=['data'],
+                                cwd=self.tmpdir)
+        with open(os.path.join(self.tmpdir, 'data'), 'w') as fd:
+            fd.write('bb')
+        pxul.subprocess.run(self.cmd, cache=self.cache, inputs=['data'],
+                            cwd=self.tmpdir)
+        self.assertEqual(self.calls(), 2)
+
+    def test_inputs(self):
+        "Modifying an input file should miss"
+        path = os.path.join(self.tmpdir, 'data')
+        with open(path, 'w') as fd:
+            fd.write('a')
+        for _ in xrange(2):
+            pxul.subprocess.run(self.cmd, cache=self.cache, inputs=[path])
+        with open(path, 'w') as fd:
+            fd.write('bb')
+        pxul.subprocess.run(self.cmd, cache=self.cache, inputs=[path])
+        self.assertEqual(self.calls(), 2)
+
+    def test_inputs_hash(self):
+        "Rewriting an input file with the same content should hit"
+        cache = pxul.subprocess.Cache(self.cache.path, hash=True)
+        path = os.path.join(self.tmpdir, 'data')
+        for content in ['a', 'a', 'bb']:
+            with open(path, 'w') as fd:
+                fd.write(content)
+            pxul.subprocess.run(self.cmd, cache=cache, inputs=[path])
+        self.assertEqual(self.calls(), 2)
+
+    def test_failure_not_cached(self):
+        "Failing commands should not be cached"
+        cmd = self.cmd[:2] + [self.cmd[2] + '; exit 1']
+        for _ in xrange(2):
+            pxul.subprocess.run(cmd, raises=False, cache=self.cache)
+        self.assertEqual(self.calls(), 2)
+
+    def test_evict(self):
+        "The least recently used results should be evicted"
+        cache = pxul.subprocess.Cache(self.cache.path, max_entries=2)
+        for i in xrange(3):
+            pxul.subprocess.run(self.cmd + [str(i)], cache=cache)
+        self.assertEqual(len(list(cache._stats())), 1)
+        pxul.subprocess.run(self.cmd + ['2'], cache=cache)
+        self.assertEqual(self.calls(), 3)
+        pxul.subprocess.run(self.cmd + ['0'], cache=cache)
+        self.assertEqual(self.calls(), 4)
+
+    def test_evict_low_water(self):
+        "Evicting should leave room so the next results do not rescan"
+        cache = pxul.subprocess.Cache(self.cache.path, max_entries=10)
+        for i in xrange(11):
+            cache.put(str(i), pxul.subprocess.Result('', None, 0))
+        self.assertEqual(len(list(cache._stats())), 9)
+        scans = []
+        stats = cache._stats
+        cache._stats = lambda: scans.append(1) or stats()
+        cache.put('11', pxul.subprocess.Result('', None, 0))
+        self.assertEqual(scans, [])
+        self.assertEqual(len(list(stats())), 10)
+
+    def test_builder(self):
+        "Builders should use their cache"
+        builder = pxul.subprocess.Builder(self.cmd, capture='stdout',
+                                          cache=self.cache)
+        builder()
+        self.assertEqual(builder().out, 'hello\n')
+        self.assertEqual(self.calls(), 1)
+
+
+class launcher_Test(TestCase):
+    def launchers(self):
+        yield 'fork'
+        if pxul.subprocess._libc is not None:
+            yield 'posix_spawn'
+
+    def test_capture(self):
+        "Every launcher should connect the pipes"
+        for launcher in self.launchers():
+            res = pxul.subprocess.call(['cat'], input='hello',
+                                       stdout=pxul.subprocess.PIPE,
+                                       stderr=pxul.subprocess.PIPE,
+                                       launcher=launcher)
+            self.assertEqual(res.out, 'hello')
+            self.assertEqual(res.err, '')
+
+    def test_missing(self):
+        "Every launcher should fail to start a missing executable"
+        for launcher in self.launchers():
+            with self.assertRaises(OSError):
+                pxul.subprocess.run([uuid.uuid4().hex], launcher=launcher)
+
+    def test_unknown(self):
+        "Should throw if the launcher is unknown"
+        with self.assertRaises(ValueError):
+            pxul.subprocess.run(['true'], launcher='teleport')
+
+    def test_spawn_class(self):
+        "posix_spawn should be used when available"
+        if pxul.subprocess._libc is None:
+            return
+        proc = pxul.subprocess.acall(['true'], launcher='auto')
+        self.assertIsInstance(proc._proc, pxul.subprocess._SpawnPopen)
+        proc.wait()
+
+
+class ForkServer_Test(TestCase):
+    def setUp(self):
+        self.server = pxul.subprocess.ForkServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_run(self):
+        "Should run the command and return its result"
+        res = self.server.run(['echo', 'hello'], capture='both')
+        self.assertIsInstance(res, pxul.subprocess.Result)
+        self.assertEqual(res.out, 'hello\n')
+        self.assertIsInstance(res.usage, pxul.subprocess.Usage)
+
+    def test_env_cwd(self):
+        "Should pass along the environment and working directory"
+        res = self.server.run(['sh', '-c', 'echo $SPAM; pwd'],
+                              capture='stdout', env={'SPAM': 'eggs'},
+                              cwd='/')
+        self.assertEqual(res.out, 'eggs\n/\n')
+
+    def test_raises(self):
+        "Failures should follow the raises rules of run"
+        with self.assertRaises(pxul.subprocess.CalledProcessError):
+            self.server.run(['false'])
+        self.assertEqual(self.server.run(['false'], raises=False).ret, 1)
+        with self.assertRaises(OSError):
+            self.server.run([uuid.uuid4().hex])
+
+    def test_timeout(self):
+        "Should terminate commands that time out"
+        with self.assertRaises(pxul.subprocess.TimeoutExpired):
+            self.server.run(['sleep', '60'], timeout=0.1)
+
+    def test_concurrent(self):
+        "Submitted commands should run concurrently"
+        start = time.time()
+        idents = [self.server.submit(['sleep', '0.2']) for _ in xrange(10)]
+        for ident in reversed(idents):
+            self.assertEqual(self.server.result(ident).ret, 0)
+        self.assertLess(time.time() - start, 1)
+
+    def test_launcher(self):
+        "run should use the fork server when selected"
+        server = pxul.subprocess.start_forkserver()
+        try:
+            res = pxul.subprocess.run(['sh', '-c', 'echo $PPID'],
+                                      capture='stdout', launcher='forkserver')
+            self.assertEqual(int(res.out), server.pid)
+        finally:
+            server.stop()
+        self.assertIsNone(pxul.subprocess._forkserver)
+
+    def test_fallback(self):
+        "Commands the server cannot run should be logged and run directly"
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger = logging.getLogger('pxul')
+        logger.addHandler(handler)
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        server = pxul.subprocess.start_forkserver()
+        try:
+            res = pxul.subprocess.run(['sh', '-c', 'echo $PPID'],
+                                      capture='stdout', launcher='forkserver',
+                                      spill=1024)
+            pxul.subprocess.call(['true'], launcher='forkserver')
+        finally:
+            server.stop()
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+        self.assertEqual(int(str(res.out)), os.getpid())
+        self.assertEqual(len([m for m in messages
+                              if 'Not using the fork server' in m]), 2)
+
+    def test_cloexec(self):
+        "Children should not inherit the connection to the server"
+        fd = self.server._sock.fileno()
+        self.assertTrue(fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+        res = pxul.subprocess.run(['sh', '-c', 'ls /proc/$$/fd'],
+                                  capture='stdout', launcher='fork')
+        self.assertNotIn(str(fd), res.out.split())
+
+    def test_many_descriptors(self):
+        "The server should work with descriptors above 1024"
+        with many_fds(self):
+            server = pxul.subprocess.ForkServer().start()
+        try:
+            idents = [server.submit(['echo', str(i)], capture='stdout')
+                      for i in xrange(20)]
+            self.assertEqual([server.result(ident).out for ident in idents],
+                             ['{}\n'.format(i) for i in xrange(20)])
+        finally:
+            server.stop()
+
+
+class map_args_Test(TestCase):
+    def test_batches(self):
+        "Arguments should be packed into as few calls as allowed"
+        echo = pxul.subprocess.Builder(['echo'], capture='stdout')
+        args = [str(i) for i in xrange(100)]
+        results = echo.map_args(args, max_args=30)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(' '.join(r.out.strip() for r in results),
+                         ' '.join(args))
+
+    def test_arg_max(self):
+        "Calls should not exceed the system limit"
+        echo = pxul.subprocess.Builder(['echo'], capture='stdout')
+        args = ['{:0>100}'.format(i) for i in xrange(50000)]
+        results = echo.map_args(args, jobs=4)
+        self.assertGreater(len(results), 1)
+        self.assertEqual(' '.join(r.out.strip() for r in results).split(),
+                         args)
+
+    def test_merge(self):
+        "Merging should concatenate the output"
+        echo = pxul.subprocess.Builder(['echo'], capture='stdout')
+        res = echo.map_args(['a', 'b', 'c'], max_args=1, jobs=3, merge=True)
+        self.assertEqual(res.out, 'a\nb\nc\n')
+        self.assertEqual(res.ret, 0)
+
+    def test_merge_failure(self):
+        "Merging should report a failing call"
+        sh = pxul.subprocess.Builder(['sh', '-c', 'exit $1', 'sh'])
+        res = sh.map_args(['0', '3', '0'], max_args=1, merge=True,
+                          raises=False)
+        self.assertEqual(res.ret, 3)
+        with self.assertRaises(pxul.subprocess.CalledProcessError):
+            sh.map_args(['0', '3'], max_args=1)
+
+    def test_bad_args(self):
+        "Should throw if the arguments are a naked string"
+        echo = pxul.subprocess.Builder(['echo'])
+        with self.assertRaises(pxul.subprocess.ArgumentsError):
+            echo.map_args('hello')
+
+
+class Reactor_Test(TestCase):
+    def test_callbacks(self):
+        "Output should be handed to the callbacks as it arrives"
+        reactor = pxul.subprocess.Reactor()
+        output, exited = dict(), []
+
+        def on_stdout(proc, data):
+            output.setdefault(proc.pid, []).append(data)
+
+        for i in xrange(10):
+            proc = pxul.subprocess.acall(['seq', str(i * 1000)],
+                                         stdout=pxul.subprocess.PIPE)
+            reactor.add(proc, on_stdout=on_stdout, on_exit=exited.append)
+        reactor.run()
+        reactor.close()
+
+        self.assertEqual(len(exited), 10)
+        self.assertEqual(len(reactor), 0)
+        for proc in exited:
+            self.assertEqual(proc.result().out, '')
+            lines = ''.join(output.get(proc.pid, [])).split()
+            self.assertEqual(len(lines), int(proc.cmd.split()[1]))
+
+    def test_buffers(self):
+        "Output without callbacks should be collected in the results"
+        reactor = pxul.subprocess.Reactor()
+        procs = [pxul.subprocess.arun(['echo', str(i)], capture='both')
+                 for i in xrange(10)]
+        procs.append(pxul.subprocess.arun(['true']))
+        for proc in procs:
+            reactor.add(proc)
+        reactor.run()
+        reactor.close()
+        self.assertEqual([p.result().out for p in procs[:-1]],
+                         ['{}\n'.format(i) for i in xrange(10)])
+        self.assertEqual(procs[-1].result().ret, 0)
+
+    def test_many(self):
+        "Hundreds of children should be captured from one thread"
+        cmds = [['sh', '-c', 'sleep 0.2; echo $$']] * 300
+        start = time.time()
+        results = list(pxul.subprocess.run_many(cmds, jobs=300,
+                                                capture='both'))
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(len(set(r.out for r in results)), 300)
+
+    def test_timeout(self):
+        "Deadlines should be enforced while running"
+        reactor = pxul.subprocess.Reactor()
+        proc = pxul.subprocess.acall(['sleep', '60'], timeout=0.1)
+        reactor.add(proc)
+        reactor.run(timeout=10)
+        reactor.close()
+        with self.assertRaises(pxul.subprocess.TimeoutExpired):
+            proc.result()
+
+    def test_timeout_many_descriptors(self):
+        "Timed out children should be handled above 1024 descriptors"
+        with many_fds(self):
+            results = list(pxul.subprocess.run_many(
+                [['sleep', '60']] * 20, jobs=20, capture='both',
+                timeout=0.1, raises=False))
+        self.assertEqual(len(results), 20)
+        for result in results:
+            self.assertLess(result.ret, 0)
+
+
+class Scheduler_Test(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_order(self):
+        "Tasks should run after their dependencies"
+        log = self.path('log')
+        sh = pxul.subprocess.Builder(['sh', '-c'])
+        sched = pxul.subprocess.Scheduler(jobs=4)
+        sched.add('c', sh, ['echo c >> ' + log], deps=['a', 'b'])
+        sched.add('a', sh, ['sleep 0.1; echo a >> ' + log])
+        sched.add('b', sh, ['echo b >> ' + log], deps=['a'])
+        results = sched.run()
+        self.assertEqual(sorted(results), ['a', 'b', 'c'])
+        with open(log) as fd:
+            self.assertEqual(fd.read(), 'a\nb\nc\n')
+
+    def test_parallel(self):
+        "Independent tasks should run at the same time"
+        sleep = pxul.subprocess.Builder(['sleep'])
+        sched = pxul.subprocess.Scheduler(jobs=4)
+        for i in xrange(4):
+            sched.add(str(i), sleep, ['0.3'])
+        start = time.time()
+        sched.run()
+        self.assertLess(time.time() - start, 1)
+
+    def test_up_to_date(self):
+        "Tasks with outputs newer than their inputs should be skipped"
+        src, dst = self.path('src'), self.path('dst')
+        with open(src, 'w') as fd:
+            fd.write('data')
+        cp = pxul.subprocess.Builder(['cp'])
+        sched = pxul.subprocess.Scheduler()
+        sched.add('copy', cp, [src, dst], inputs=[src], outputs=[dst])
+        self.assertEqual(sched.run()['copy'].ret, 0)
+        self.assertEqual(sched.run()['copy'], None)
+
+        os.utime(src, (time.time() + 10, time.time() + 10))
+        self.assertEqual(sched.run()['copy'].ret, 0)
+
+    def test_failure(self):
+        "The first failure should stop the scheduler"
+        sh = pxul.subprocess.Builder(['sh', '-c'])
+        sched = pxul.subprocess.Scheduler(jobs=2)
+        sched.add('fail', sh, ['exit 3'])
+        sched.add('slow', sh, ['sleep 5'])
+        sched.add('after', sh, ['true'], deps=['fail'])
+        start = time.time()
+        with self.assertRaises(pxul.subprocess.CalledProcessError) as e:
+            sched.run()
+        self.assertEqual(e.exception.retcode, 3)
+        self.assertLess(time.time() - start, 2)
+
+    def test_keep_going(self):
+        "Independent tasks should run after a failure with keep_going"
+        sh = pxul.subprocess.Builder(['sh', '-c'])
+        sched = pxul.subprocess.Scheduler(jobs=1, keep_going=True)
+        sched.add('fail', sh, ['exit 3'])
+        sched.add('after', sh, ['true'], deps=['fail'])
+        sched.add('other', sh, ['true'])
+        results = sched.run(raises=False)
+        self.assertEqual(results['fail'].ret, 3)
+        self.assertEqual(results['other'].ret, 0)
+        self.assertNotIn('after', results)
+
+    def test_spawn_error(self):
+        "A task that cannot be started should fail like any other"
+        missing = pxul.subprocess.Builder(['/nonexistent/command'])
+        true = pxul.subprocess.Builder(['true'])
+        sched = pxul.subprocess.Scheduler(jobs=1, keep_going=True)
+        sched.add('missing', missing)
+        sched.add('after', true, deps=['missing'])
+        sched.add('other', true)
+        results = sched.run(raises=False)
+        self.assertIsNone(results['missing'].ret)
+        self.assertEqual(results['other'].ret, 0)
+        self.assertNotIn('after', results)
+        self.assertRaises(OSError, sched.run)
+
+    def test_cycle(self):
+        "Cyclic dependencies should be rejected"
+        true = pxul.subprocess.Builder(['true'])
+        sched = pxul.subprocess.Scheduler()
+        sched.add('a', true, deps=['b'])
+        sched.add('b', true, deps=['a'])
+        self.assertRaises(ValueError, sched.run)
+
+    def test_unknown(self):
+        "Unknown dependencies should be rejected"
+        sched = pxul.subprocess.Scheduler()
+        sched.add('a', pxul.subprocess.Builder(['true']), deps=['b'])
+        self.assertRaises(ValueError, sched.run)
+
+
+class Coprocess_Test(TestCase):
+    def setUp(self):
+        self.shell = pxul.subprocess.Coprocess().start()
+
+    def tearDown(self):
+        self.shell.close()
+
+    def test_run(self):
+        "Commands should return their output and exit status"
+        res = self.shell.run(['sh', '-c', 'echo out; echo err >&2'])
+        self.assertEqual(res.out, 'out\n')
+        self.assertEqual(res.err, 'err\n')
+        self.assertEqual(res.ret, 0)
+
+    def test_reuse(self):
+        "Commands should run in the same shell"
+        pid = self.shell.pid
+        for i in xrange(10):
+            self.assertEqual(self.shell.run(['echo', str(i)]).out,
+                             '{}\n'.format(i))
+        self.assertEqual(self.shell.pid, pid)
+
+    def test_quoting(self):
+        "Arguments should be passed unchanged"
+        args = ['a b', '$HOME', "it's", '`date`', ';', '"\\n"']
+        res = self.shell.run(['printf', '%s\\n'] + args)
+        self.assertEqual(res.out.splitlines(), args)
+
+    def test_no_newline(self):
+        "Output without a final newline should be kept as is"
+        self.assertEqual(self.shell.run(['printf', 'abc']).out, 'abc')
+
+    def test_failure(self):
+        "A failing command should raise CalledProcessError"
+        with self.assertRaises(pxul.subprocess.CalledProcessError) as e:
+            self.shell.script('echo oops >&2; exit 3')
+        self.assertEqual(e.exception.retcode, 3)
+        self.assertEqual(e.exception.stderr, 'oops\n')
+        self.assertEqual(self.shell.run(['true']).ret, 0)
+
+    def test_isolated(self):
+        "Commands should not change the state of the shell"
+        self.shell.script('cd /; FOO=bar')
+        self.assertEqual(self.shell.script('echo "$FOO"').out, '\n')
+        self.assertEqual(self.shell.script('pwd').out.strip(), os.getcwd())
+
+    def test_stdin(self):
+        "Commands should not read the input of the shell"
+        self.assertEqual(self.shell.run(['cat']).out, '')
+        self.assertEqual(self.shell.run(['echo', 'after']).out, 'after\n')
+
+    def test_restart(self):
+        "The shell should be restarted after it died"
+        pid = self.shell.pid
+        res = self.shell.script('kill -9 $$; sleep 1', raises=False)
+        self.assertNotEqual(res.ret, 0)
+        self.assertEqual(self.shell.run(['echo', 'hi']).out, 'hi\n')
+        self.assertNotEqual(self.shell.pid, pid)
+
+    def test_timeout(self):
+        "Code that does not finish in time should stop the shell"
+        pid = self.shell.pid
+        with self.assertRaises(pxul.subprocess.TimeoutExpired):
+            self.shell.script("echo 'unbalanced", timeout=0.2)
+        res = self.shell.run(['sleep', '60'], raises=False, timeout=0.2)
+        self.assertNotEqual(res.ret, 0)
+        self.assertEqual(self.shell.run(['echo', 'hi']).out, 'hi\n')
+        self.assertNotEqual(self.shell.pid, pid)
+
+    def test_many_descriptors(self):
+        "Should work with descriptors above 1024"
+        self.shell.close()
+        with many_fds(self):
+            with pxul.subprocess.Coprocess() as shell:
+                self.assertEqual(shell.run(['echo', 'hi']).out, 'hi\n')
+
+    def test_restart_idle(self):
+        "A shell that died between commands should be restarted"
+        os.kill(self.shell.pid, 9)
+        time.sleep(0.1)
+        self.assertEqual(self.shell.run(['echo', 'hi']).out, 'hi\n')
+
+
+class coalesce_Test(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, 'log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def concurrently(self, function, count=5):
+        results = [None] * count
+
+        def target(i):
+            results[i] = function()
+
+        threads = [threading.Thread(target=target, args=(i,))
+                   for i in xrange(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def starts(self):
+        with open(self.log) as fd:
+            return len(fd.readlines())
+
+    def test_run(self):
+        "Identical concurrent commands should run once"
+        cmd = ['sh', '-c', 'echo x >> {}; sleep 0.3; echo $$'.format(self.log)]
+        results = self.concurrently(
+            lambda: pxul.subprocess.run(cmd, capture='stdout', coalesce=True))
+        self.assertEqual(self.starts(), 1)
+        self.assertEqual(len(set(r.out for r in results)), 1)
+
+    def test_sequential(self):
+        "Commands that do not overlap should run again without a ttl"
+        cmd = ['sh', '-c', 'echo x >> {}'.format(self.log)]
+        for _ in xrange(3):
+            pxul.subprocess.run(cmd, coalesce=True)
+        self.assertEqual(self.starts(), 3)
+
+    def test_ttl(self):
+        "Results should be reused within the ttl"
+        cmd = ['sh', '-c', 'echo x >> {}'.format(self.log)]
+        for _ in xrange(3):
+            pxul.subprocess.run(cmd, coalesce=60)
+        self.assertEqual(self.starts(), 1)
+
+    def test_different(self):
+        "Commands with different inputs should not be shared"
+        cmd = ['sh', '-c', 'echo x >> {}; cat'.format(self.log)]
+        pxul.subprocess.run(cmd, input='a', coalesce=60)
+        pxul.subprocess.run(cmd, input='b', coalesce=60)
+        pxul.subprocess.run(cmd, input='b', coalesce=60, cwd='/')
+        self.assertEqual(self.starts(), 3)
+
+    def test_timeout(self):
+        "Commands with different time limits should not be shared"
+        cmd = ['sh', '-c', 'echo x >> {}; sleep 0.5'.format(self.log)]
+        outcomes = []
+
+        def limited():
+            try:
+                pxul.subprocess.run(cmd, timeout=0.1, coalesce=True)
+            except pxul.subprocess.TimeoutExpired:
+                outcomes.append('timeout')
+
+        thread = threading.Thread(target=limited)
+        thread.start()
+        outcomes.append(pxul.subprocess.run(cmd, coalesce=True).ret)
+        thread.join()
+        self.assertEqual(sorted(outcomes), [0, 'timeout'])
+        self.assertEqual(self.starts(), 2)
+
+    def test_error(self):
+        "Errors should be raised in every caller"
+        cmd = ['sh', '-c', 'echo x >> {}; sleep 0.3; exit 3'.format(self.log)]
+
+        def run():
+            try:
+                pxul.subprocess.run(cmd, coalesce=True)
+            except pxul.subprocess.CalledProcessError, e:
+                return e.retcode
+
+        self.assertEqual(self.concurrently(run), [3] * 5)
+        self.assertEqual(self.starts(), 1)
+
+    def test_builder(self):
+        "Builders should coalesce identical calls"
+        sh = pxul.subprocess.Builder(['sh', '-c'], capture='stdout',
+                                     coalesce=True)
+        script = 'echo x >> {}; sleep 0.3; echo $$'.format(self.log)
+        results = self.concurrently(lambda: sh(script))
+        self.assertEqual(self.starts(), 1)
+        self.assertEqual(len(set(r.out for r in results)), 1)
+
+
+class Sched_Test(TestCase):
+    status = ['sh', '-c', 'grep Cpus_allowed_list /proc/self/status']
+
+    def test_affinity(self):
+        "The child should only run on the given CPUs"
+        sched = pxul.subprocess.Sched(cpus=[0])
+        res = pxul.subprocess.run(self.status, capture='stdout', sched=sched)
+        self.assertEqual(res.out.split(), ['Cpus_allowed_list:', '0'])
+
+    def test_affinity_invalid(self):
+        "Failing to apply the settings should raise in the caller"
+        sched = pxul.subprocess.Sched(cpus=[4095])
+        self.assertRaises(OSError, pxul.subprocess.run, ['true'], sched=sched)
+
+    def test_nice(self):
+        "The child should run with a higher nice level"
+        sched = pxul.subprocess.Sched(nice=5)
+        res = pxul.subprocess.run(['nice'], capture='stdout', sched=sched)
+        self.assertEqual(int(res.out), os.nice(0) + 5)
+
+    def test_ionice(self):
+        "The child should run with the given I/O scheduling class"
+        sched = pxul.subprocess.Sched(ionice='idle')
+        res = pxul.subprocess.run(['sh', '-c', 'ionice -p $$'],
+                                  capture='stdout', sched=sched)
+        self.assertEqual(res.out.strip(), 'idle')
+
+    def test_ionice_unknown(self):
+        "Unknown I/O scheduling classes should be rejected"
+        self.assertRaises(ValueError, pxul.subprocess.Sched, ionice='fast')
+
+    def test_rlimits(self):
+        "The child should run with the given resource limits"
+        sched = pxul.subprocess.Sched(rlimits={resource.RLIMIT_NOFILE:
+                                               (64, 64)})
+        res = pxul.subprocess.run(['sh', '-c', 'ulimit -n'],
+                                  capture='stdout', sched=sched)
+        self.assertEqual(res.out.strip(), '64')
+
+    def test_parent(self):
+        "The parent should not be affected"
+        before = os.nice(0)
+        pxul.subprocess.run(['true'], sched=pxul.subprocess.Sched(nice=5))
+        self.assertEqual(os.nice(0), before)
+
+    def test_builder(self):
+        "Builders should apply their settings to every call"
+        nice = pxul.subprocess.Builder(['nice'], capture='stdout',
+                                       sched=pxul.subprocess.Sched(nice=3))
+        self.assertEqual(int(nice().out), os.nice(0) + 3)
+
+    def test_pin(self):
+        "Commands of a batch should be pinned to one CPU each"
+        sched = pxul.subprocess.Sched(cpus=[0], nice=1)
+        results = pxul.subprocess.run_many([self.status] * 4, jobs=2,
+                                           capture='stdout', sched=sched,
+                                           pin=True)
+        for res in results:
+            self.assertEqual(res.out.split()[-1], '0')
+
+
+class _FakeGovernor(pxul.subprocess.Governor):
+    "A governor on a machine with the given load and free memory"
+
+    def __init__(self, load, free, **kws):
+        self.fake_load = load
+        self.fake_free = free
+        super(_FakeGovernor, self).__init__(interval=0, **kws)
+
+    def load(self):
+        return self.fake_load
+
+    def free(self):
+        return self.fake_free
+
+
+class Governor_Test(TestCase):
+    def procs(self, count):
+        return [pxul.subprocess.acall(['sleep', '10']) for _ in xrange(count)]
+
+    def tearDown(self):
+        for proc in getattr(self, 'running', []):
+            proc.terminate()
+            proc._proc.wait()
+
+    def test_grow(self):
+        "More jobs should be allowed while there are resources"
+        governor = _FakeGovernor(0, 10 ** 12, jobs=2, max_load=8,
+                                 min_free=10 ** 9)
+        self.running = self.procs(2)
+        self.assertEqual(governor.update(self.running), 3)
+        self.assertEqual(governor.history[-1].action, 'grow')
+        self.assertGreater(governor.history[-1].rss, 0)
+
+    def test_idle(self):
+        "Jobs should not grow if they are not all used"
+        governor = _FakeGovernor(0, 10 ** 12, jobs=2, max_load=8)
+        self.assertEqual(governor.update([]), 2)
+        self.assertEqual(governor.history[-1].action, 'hold')
+
+    def test_load(self):
+        "Fewer jobs should be allowed when the load is too high"
+        governor = _FakeGovernor(10, 10 ** 12, jobs=4, max_load=8)
+        self.running = self.procs(3)
+        self.assertEqual(governor.update(self.running), 2)
+        self.assertEqual(governor.history[-1].action, 'shrink')
+
+    def test_memory(self):
+        "Fewer jobs should be allowed when memory is low"
+        governor = _FakeGovernor(0, 10, jobs=4, max_load=8, min_free=100)
+        self.running = self.procs(4)
+        self.assertEqual(governor.update(self.running), 3)
+
+    def test_bounds(self):
+        "The jobs should stay within the bounds"
+        governor = _FakeGovernor(100, 0, jobs=2, min_jobs=2, max_jobs=3)
+        self.assertEqual(governor.update([]), 2)
+        governor.fake_load, governor.fake_free = 0, None
+        governor.max_load = 100
+        self.running = self.procs(3)
+        self.assertEqual(governor.update(self.running), 3)
+
+    def test_interval(self):
+        "Decisions should be made at most once per interval"
+        governor = pxul.subprocess.Governor(interval=60)
+        governor.update([])
+        governor.update([])
+        self.assertEqual(len(governor.history), 1)
+
+    def test_machine(self):
+        "The state of the machine should be read"
+        governor = pxul.subprocess.Governor()
+        self.assertGreaterEqual(governor.load(), 0)
+        self.assertGreater(governor.free(), 0)
+        self.assertGreater(governor.rss([os.getpid()]), 0)
+
+    def test_run_many(self):
+        "Batches should run with a governor"
+        governor = _FakeGovernor(0, 10 ** 12, jobs=1, max_load=8)
+        cmds = [['sleep', '0.05']] * 10
+        results = list(pxul.subprocess.run_many(cmds, jobs=governor))
+        self.assertEqual(len(results), 10)
+        self.assertGreater(max(d.jobs for d in governor.history), 1)
+
+
+class Journal_Test(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'journal')
+        self.log = os.path.join(self.tmpdir, 'log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def cmds(self, fail=()):
+        return [['sh', '-c', 'echo {} >> {}; echo {}; exit {}'
+                 .format(i, self.log, i, 3 if i in fail else 0)]
+                for i in xrange(5)]
+
+    def started(self):
+        with open(self.log) as fd:
+            return [int(line) for line in fd]
+
+    def test_resume(self):
+        "Commands that succeeded should not run again"
+        with pxul.subprocess.Journal(self.path) as journal:
+            list(pxul.subprocess.run_many(self.cmds(fail=[1, 3]),
+                                          journal=journal, raises=False))
+        os.unlink(self.log)
+
+        with pxul.subprocess.Journal(self.path) as journal:
+            results = list(pxul.subprocess.run_many(self.cmds(), jobs=2,
+                                                    journal=journal,
+                                                    capture='stdout'))
+        self.assertEqual(sorted(self.started()), [1, 3])
+        self.assertEqual([r.ret for r in results], [0] * 5)
+        self.assertIsInstance(results[0], pxul.subprocess.JournaledResult)
+        self.assertEqual(results[1].out, '1\n')
+
+    def test_digest(self):
+        "The digest of the output should be recorded"
+        cmd = ['echo', 'hello']
+        with pxul.subprocess.Journal(self.path, digest=True) as journal:
+            list(pxul.subprocess.run_many([cmd], capture='stdout',
+                                          journal=journal))
+        journal = pxul.subprocess.Journal(self.path)
+        self.assertEqual(journal.succeeded(cmd).digest,
+                         hashlib.sha1('hello\n').hexdigest())
+        journal.close()
+
+    def test_torn(self):
+        "An incomplete last line should be ignored"
+        cmd = ['true']
+        with pxul.subprocess.Journal(self.path) as journal:
+            key = journal.key(cmd)
+        with open(self.path, 'w') as fd:
+            fd.write('{} 0'.format(key))
+        with pxul.subprocess.Journal(self.path) as journal:
+            self.assertIsNone(journal.succeeded(cmd))
+            journal.record(cmd, pxul.subprocess.Result(out=None, err=None,
+                                                       ret=0))
+        with pxul.subprocess.Journal(self.path) as journal:
+            self.assertEqual(journal.succeeded(cmd).ret, 0)
+        with open(self.path) as fd:
+            self.assertEqual(fd.read(), '{} 0 -\n'.format(key))
+
+    def test_sync(self):
+        "Records should be flushed in batches"
+        with pxul.subprocess.Journal(self.path, sync_every=2,
+                                     sync_interval=60) as journal:
+            result = pxul.subprocess.Result(out=None, err=None, ret=0)
+            journal.record(['a'], result)
+            self.assertEqual(os.path.getsize(self.path), 0)
+            journal.record(['b'], result)
+            with open(self.path) as fd:
+                self.assertEqual(len(fd.readlines()), 2)